@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the NWP preparation on synthetic GRIB files, and compare with earlier runs."""
+
+import argparse
+import logging
+import sys
+import tempfile
+
+from nwcsafpps_runner.grib_utils import get_crop_area, get_packing
+from nwcsafpps_runner.logger import setup_logging
+from nwcsafpps_runner.nwp_benchmark import (NHSP_LEVELS, BenchmarkSetup, find_regressions, format_record,
+                                            make_record, read_results, run_benchmark, store_result)
+
+LOG = logging.getLogger('nwp-benchmark')
+
+
+def get_arguments():
+    """Get command line arguments."""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-l", "--log-config",
+                        help="Log config file to use instead of the standard logging.")
+    parser.add_argument("-r", "--results", type=str, dest="results", default='nwp_benchmark.jsonl',
+                        help="The file the results are appended to and compared with, \n" +
+                        "default = ./nwp_benchmark.jsonl")
+    parser.add_argument("-d", "--workdir", type=str, dest="workdir", default=None,
+                        help="Directory for the synthetic GRIB files, default is the system temporary directory")
+    parser.add_argument("--resolution", type=float, default=0.25,
+                        help="Grid spacing of the synthetic fields in degrees, default = 0.25")
+    parser.add_argument("--nlevels", type=int, default=len(NHSP_LEVELS),
+                        help="Number of pressure levels in the nhsp file, default = %d" % len(NHSP_LEVELS))
+    parser.add_argument("--crop-area", type=str, default=None,
+                        help="Crop the prepared fields to north,west,south,east in degrees")
+    parser.add_argument("--packing", type=str, default=None,
+                        help="Packing of the prepared fields, e.g. default:grid_ccsds:16")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each stage, the fastest is kept, default = 3")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Throughput drop, as a fraction, reported as a regression, default = 0.2")
+    parser.add_argument("-v", "--verbose", dest="verbosity", action="count", default=0,
+                        help="Verbosity (between 1 and 2 occurrences with more leading to more "
+                        "verbose logging). WARN=0, INFO=1, "
+                        "DEBUG=2. This is overridden by the log config file if specified.")
+
+    args = parser.parse_args()
+    setup_logging(args)
+    return args
+
+
+def main():
+    """Run the benchmark, store the results and report regressions."""
+    args = get_arguments()
+    setup = BenchmarkSetup(resolution=args.resolution, nlevels=args.nlevels,
+                           area=get_crop_area(args.crop_area),
+                           packing=get_packing(args.packing))
+
+    previous = read_results(args.results)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        stages = run_benchmark(workdir, setup, repeat=args.repeat)
+    record = make_record(stages, setup)
+    store_result(args.results, record)
+    print(format_record(record))
+
+    regressions = find_regressions(previous, record, args.tolerance)
+    for stage, before, after in regressions:
+        print("Regression in %s: %.1f MB/s before, %.1f MB/s now" % (stage, before, after))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,24 +24,38 @@
 """Posttroll runner for the NWCSAF/PPS v2018.
 """
 
+import asyncio
 import logging
 import os
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from glob import glob
 from subprocess import PIPE, Popen
 
+from posttroll.publisher import Publish
 from six.moves.queue import Empty, Queue
 
+from nwcsafpps_runner.async_engine import (AsyncScheduler, QueuePublisher, receive_messages, run_process,
+                                           wait_until_nwp_ready)
+from nwcsafpps_runner.backlog import recover_backlog
 from nwcsafpps_runner.config import CONFIG_FILE, CONFIG_PATH, MODE, get_config
+from nwcsafpps_runner.nwp_retention import NwpRetention
+from nwcsafpps_runner.nwp_service import NwpPrepareService, get_nwp_output_pattern
+from nwcsafpps_runner.output_pump import pump_output
+from nwcsafpps_runner.pge_graph import (PgeSlots, get_failed_pges, get_pge_settings, run_scene_pges,
+                                        run_scene_pges_in_threads)
 from nwcsafpps_runner.prepare_nwp import update_nwp
-from nwcsafpps_runner.publish_and_listen import FileListener, FilePublisher
+from nwcsafpps_runner.publish_and_listen import FileListener, FilePublisher, NwpListener
+from nwcsafpps_runner.resources import ResourceMonitor
+from nwcsafpps_runner.scene_assembler import ProcessedScenes, SceneAssembler
+from nwcsafpps_runner.scheduler import SceneScheduler, get_platform_priorities
 from nwcsafpps_runner.utils import (METOP_NAME_LETTER, SATELLITE_NAME,
-                                    SENSOR_LIST, NwpPrepareError, PpsRunError,
+                                    SENSOR_LIST, NwpPrepareError, PpsRunError, SceneId,
                                     create_pps2018_call_command,
                                     get_outputfiles, get_pps_inputfile,
-                                    get_sceneid, logreader, message_uid,
                                     prepare_pps_arguments, publish_pps_files,
                                     ready2run, terminate_process)
 
@@ -62,41 +76,92 @@ LOG.debug("PYTHONPATH: " + str(sys.path))
 SATNAME = {'Aqua': 'EOS-Aqua'}
 
 
-class ThreadPool(object):
-
-    def __init__(self, max_nthreads=None):
-
-        self.jobs = set()
-        self.sema = threading.Semaphore(max_nthreads)
-        self.lock = threading.Lock()
-
-    def new_thread(self, job_id, group=None, target=None, name=None, args=(), kwargs={}):
-
-        def new_target(*args, **kwargs):
-            with self.sema:
-                result = target(*args, **kwargs)
-
-            self.jobs.remove(job_id)
-            return result
-
-        with self.lock:
-            if job_id in self.jobs:
-                LOG.info("Job with id %s already running!", str(job_id))
-                return
-
-            self.jobs.add(job_id)
-
-        thread = threading.Thread(group, new_target, name, args, kwargs)
-        thread.start()
-
-
-def pps_worker(scene, publish_q, input_msg, options):
+def get_pps_commands(scene, options):
+    """Get the commands running PPS on the *scene*, as lists of arguments, in the order they are to be run."""
+    py_exec = options.get('python', '/bin/python')
+    cmd = create_pps2018_call_command(py_exec, options.get('run_all_script'), scene)
+    run_cpp = options.get('run_pps_cpp', None)
+    if not run_cpp:
+        cmd.append('--no_cpp')
+    commands = [cmd]
+    if options['run_cmask_prob']:
+        commands.append(create_pps2018_call_command(py_exec, options.get('run_cmaprob_script'), scene))
+    return commands
+
+
+def publish_pps_statistics(scene, publish_q, input_msg, options):
+    """Generate the XML summary of the PPS processing times of the *scene*, and publish it."""
+    my_env = os.environ.copy()
+    # Now try perform some time statistics editing with ppsTimeControl.py from
+    # pps:
+    do_time_control = True
+    try:
+        from pps_time_control import PPSTimeControl
+    except ImportError:
+        LOG.warning("Failed to import the PPSTimeControl from pps")
+        do_time_control = False
+    #: Create the start time (format dateTtime) to be used in file findings
+    if SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) == 'seviri':
+        st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S.%f")
+    elif (SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) in ['viirs', 'modis'] or
+          'avhrr/3' in SENSOR_LIST.get(scene['platform_name'], scene['platform_name'])):
+        st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S")
+    else:
+        st_time = ''
+    pps_control_path = my_env.get('STATISTICS_DIR', options.get('pps_statistics_dir', './'))
+    if do_time_control:
+        LOG.info("Read time control ascii file and generate XML")
+        platform_id = SATELLITE_NAME.get(
+            scene['platform_name'], scene['platform_name'])
+        LOG.info("pps platform_id = " + str(platform_id))
+        txt_time_file = (os.path.join(pps_control_path, 'S_NWC_timectrl_') +
+                         str(METOP_NAME_LETTER.get(platform_id, platform_id)) +
+                         '_' + '%.5d' % scene['orbit_number'] + '_' +
+                         st_time +
+                         '*.txt')
+        LOG.info("glob string = " + str(txt_time_file))
+        infiles = glob(txt_time_file)
+        LOG.info(
+            "Time control ascii file candidates: " + str(infiles))
+        if len(infiles) == 1:
+            infile = str(infiles[0])
+            LOG.info("Time control ascii file: " + str(infile))
+            ppstime_con = PPSTimeControl(infile)
+            ppstime_con.sum_up_processing_times()
+            try:
+                ppstime_con.write_xml()
+            except Exception as e:  # TypeError as e:
+                LOG.warning('Not able to write time control xml file')
+                LOG.warning(e)
+    # The PPS post-hooks takes care of publishing the PPS cloud products
+    # For the XML files we keep the publishing from here:
+    xml_files = get_outputfiles(pps_control_path,
+                                SATELLITE_NAME[scene['platform_name']],
+                                scene['orbit_number'],
+                                st_time=st_time,
+                                xml_output=True)
+
+    LOG.info("PPS summary statistics files: " + str(xml_files))
+
+    # Now publish:
+    publish_pps_files(input_msg, publish_q, scene, xml_files,
+                      environment=MODE, servername=options['servername'],
+                      station=options['station'])
+
+
+def pps_worker(scene, publish_q, input_msg, options, resources=None, pge_slots=None):
     """Start PPS on a scene.
 
     scene = {'platform_name': platform_name,
              'orbit_number': orbit_number,
              'satday': satday, 'sathour': sathour,
              'starttime': starttime, 'endtime': endtime}
+
+    The PPS processes are followed by the *resources* monitor, if given. If
+    the config option *pps_execution* is pge_graph, the PGEs are run as a
+    dependency graph, each from its own thread, within the *pge_slots*, and
+    nothing is published if one of them failed. Return True if all the PPS
+    processes succeeded.
     """
 
     try:
@@ -114,23 +179,7 @@ def pps_worker(scene, publish_q, input_msg, options):
 
         min_thr = options['maximum_pps_processing_time_in_minutes']
         LOG.debug("Maximum allowed  PPS processing time in minutes: %d", min_thr)
-        # # Run core PPS PGEs in a serial fashion
-        # LOG.info("Run PPS module: pps_run_all_serial")
-        # pps_run_all_serial(**kwargs)
-
-        # # Run the PPS CmaskProb (probabilistic Cloudmask):
-        # if CMA_PROB:
-        #     LOG.info("Run PPS module: pps_cmask_prob")
-        #     pps_cmask_prob(**kwargs)
-        # else:
-        #     LOG.info("Will skip running the PPS module: pps_cmask_prob (probablistic cloud mask)")
-
-        py_exec = options.get('python', '/bin/python')
-        pps_script = options.get('run_all_script')
-        cmd_str = create_pps2018_call_command(py_exec, pps_script, scene, sequence=False)
-        run_cpp = options.get('run_pps_cpp', None)
-        if not run_cpp:
-            cmd_str = cmd_str + ' --no_cpp'
+
         my_env = os.environ.copy()
         for envkey in my_env:
             LOG.debug("ENV: " + str(envkey) + " " + str(my_env[envkey]))
@@ -139,113 +188,90 @@ def pps_worker(scene, publish_q, input_msg, options):
         LOG.debug("PPS_OUTPUT_DIR = " + str(pps_output_dir))
         LOG.debug("...from config file = " + str(options['pps_outdir']))
 
-        LOG.debug("Run command: " + str(cmd_str))
-        try:
-            pps_all_proc = Popen(cmd_str, shell=True, stderr=PIPE, stdout=PIPE)
-        except PpsRunError:
-            LOG.exception("Failed in PPS...")
-
-        t__ = threading.Timer(min_thr * 60.0, terminate_process, args=(pps_all_proc, scene, ))
-        t__.start()
-
-        out_reader = threading.Thread(
-            target=logreader, args=(pps_all_proc.stdout, LOG.info))
-        err_reader = threading.Thread(
-            target=logreader, args=(pps_all_proc.stderr, LOG.info))
-        out_reader.start()
-        err_reader.start()
-        out_reader.join()
-        err_reader.join()
+        scene_tag = str(SceneId(scene['platform_name'], scene['orbit_number'], scene['starttime']))
+        timers = []
+        success = True
+        if options['pps_execution'] == 'pge_graph':
+            timings = run_scene_pges_in_threads(scene, scene_tag, options, slots=pge_slots,
+                                                on_start=resources and resources.process_adder())
+            failed = get_failed_pges(timings)
+            if failed:
+                LOG.error("PPS failed in %s on scene %s, nothing published", ', '.join(failed), str(scene))
+                return False
+        else:
+            for cmd in get_pps_commands(scene, options):
+                LOG.debug("Run command: " + str(cmd))
+                try:
+                    pps_proc = Popen(cmd, stderr=PIPE, stdout=PIPE)
+                except PpsRunError:
+                    LOG.exception("Failed in PPS...")
+                if resources is not None:
+                    resources.add_process(pps_proc.pid)
+
+                timer = threading.Timer(min_thr * 60.0, terminate_process, args=(pps_proc, scene, ))
+                timer.start()
+                timers.append(timer)
+
+                pump_output(pps_proc, scene_tag, LOG.info).wait()
+                returncode = pps_proc.wait()
+                if returncode != 0:
+                    LOG.error("PPS failed with return code %d on scene %s", returncode, str(scene))
+                    success = False
 
         LOG.info("Ready with PPS level-2 processing on scene: " + str(scene))
 
-        if options['run_cmask_prob']:
-            pps_script = options.get('run_cmaprob_script')
-            cmdl = create_pps2018_call_command(py_exec, pps_script, scene, sequence=False)
-
-            LOG.debug("Run command: " + str(cmdl))
-            try:
-                pps_cmaprob_proc = Popen(cmdl, shell=True, stderr=PIPE, stdout=PIPE)
-            except PpsRunError:
-                LOG.exception("Failed when trying to run the PPS Cma-prob")
-            timer_cmaprob = threading.Timer(min_thr * 60.0, terminate_process, args=(pps_cmaprob_proc, scene, ))
-            timer_cmaprob.start()
-
-            out_reader2 = threading.Thread(
-                target=logreader, args=(pps_cmaprob_proc.stdout, LOG.info))
-            err_reader2 = threading.Thread(
-                target=logreader, args=(pps_cmaprob_proc.stderr, LOG.info))
-            out_reader2.start()
-            err_reader2.start()
-            out_reader2.join()
-            err_reader2.join()
-
-        # Now try perform some time statistics editing with ppsTimeControl.py from
-        # pps:
-        do_time_control = True
-        try:
-            from pps_time_control import PPSTimeControl
-        except ImportError:
-            LOG.warning("Failed to import the PPSTimeControl from pps")
-            do_time_control = False
-        #: Create the start time (format dateTtime) to be used in file findings
-        if SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) == 'seviri':
-            st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S.%f")
-        elif (SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) in ['viirs', 'modis'] or
-              'avhrr/3' in SENSOR_LIST.get(scene['platform_name'], scene['platform_name'])):
-            st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S")
-        else:
-            st_time = ''
-        pps_control_path = my_env.get('STATISTICS_DIR', options.get('pps_statistics_dir', './'))
-        if do_time_control:
-            LOG.info("Read time control ascii file and generate XML")
-            platform_id = SATELLITE_NAME.get(
-                scene['platform_name'], scene['platform_name'])
-            LOG.info("pps platform_id = " + str(platform_id))
-            txt_time_file = (os.path.join(pps_control_path, 'S_NWC_timectrl_') +
-                             str(METOP_NAME_LETTER.get(platform_id, platform_id)) +
-                             '_' + '%.5d' % scene['orbit_number'] + '_' +
-                             st_time +
-                             '*.txt')
-            LOG.info("glob string = " + str(txt_time_file))
-            infiles = glob(txt_time_file)
-            LOG.info(
-                "Time control ascii file candidates: " + str(infiles))
-            if len(infiles) == 1:
-                infile = str(infiles[0])
-                LOG.info("Time control ascii file: " + str(infile))
-                ppstime_con = PPSTimeControl(infile)
-                ppstime_con.sum_up_processing_times()
-                try:
-                    ppstime_con.write_xml()
-                except Exception as e:  # TypeError as e:
-                    LOG.warning('Not able to write time control xml file')
-                    LOG.warning(e)
-        # The PPS post-hooks takes care of publishing the PPS cloud products
-        # For the XML files we keep the publishing from here:
-        xml_files = get_outputfiles(pps_control_path,
-                                    SATELLITE_NAME[scene['platform_name']],
-                                    scene['orbit_number'],
-                                    st_time=st_time,
-                                    xml_output=True)
-
-        LOG.info("PPS summary statistics files: " + str(xml_files))
-
-        # Now publish:
-        publish_pps_files(input_msg, publish_q, scene, xml_files,
-                          environment=MODE, servername=options['servername'],
-                          station=options['station'])
+        publish_pps_statistics(scene, publish_q, input_msg, options)
 
         dt_ = datetime.utcnow() - job_start_time
         LOG.info("PPS on scene " + str(scene) + " finished. It took: " + str(dt_))
 
-        t__.cancel()
-        if options['run_cmask_prob']:
-            timer_cmaprob.cancel()
+        for timer in timers:
+            timer.cancel()
+
+    except Exception:
+        LOG.exception('Failed in pps_worker...')
+        raise
+    return success
+
+
+async def async_pps_worker(scene, publish_q, input_msg, options, pge_slots=None):
+    """Start PPS on a scene, in the event loop.
+
+    The PPS processes still running after *maximum_pps_processing_time_in_minutes*
+    are killed. If the config option *pps_execution* is pge_graph, the PGEs
+    are run as a dependency graph, within the *pge_slots*, and nothing is
+    published if one of them failed. Return True if all the PPS processes
+    succeeded.
+    """
+    try:
+        LOG.info("Starting pps runner for scene %s", str(scene))
+        job_start_time = datetime.utcnow()
+        timeout = options['maximum_pps_processing_time_in_minutes'] * 60.0
+        scene_tag = str(SceneId(scene['platform_name'], scene['orbit_number'], scene['starttime']))
+        success = True
+        if options['pps_execution'] == 'pge_graph':
+            timings = await run_scene_pges(scene, scene_tag, options, slots=pge_slots)
+            failed = get_failed_pges(timings)
+            if failed:
+                LOG.error("PPS failed in %s on scene %s, nothing published", ', '.join(failed), str(scene))
+                return False
+        else:
+            for cmd in get_pps_commands(scene, options):
+                returncode = await run_process(cmd, scene_tag, timeout=timeout)
+                if returncode != 0:
+                    LOG.error("PPS failed with return code %d on scene %s", returncode, str(scene))
+                    success = False
+
+        LOG.info("Ready with PPS level-2 processing on scene: " + str(scene))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, publish_pps_statistics, scene, publish_q, input_msg, options)
 
+        dt_ = datetime.utcnow() - job_start_time
+        LOG.info("PPS on scene " + str(scene) + " finished. It took: " + str(dt_))
     except Exception:
         LOG.exception('Failed in pps_worker...')
         raise
+    return success
 
 
 def check_threads(threads):
@@ -262,15 +288,84 @@ def check_threads(threads):
             threads.remove(thread)
 
 
-def run_nwp_and_pps(scene, flens, publish_q, input_msg, options, nwp_handeling_module):
-    """Run first the nwp-preparation and then pps. No parallel running here."""
+def run_nwp_and_pps(scene, flens, publish_q, input_msg, options, nwp_handeling_module, nwp_service=None,
+                    nwp_retention=None, resources=None, pge_slots=None):
+    """Run first the nwp-preparation and then pps. No parallel running here.
 
-    prepare_nwp4pps(flens, nwp_handeling_module)
-    pps_worker(scene, publish_q, input_msg, options)
+    If the NWP preparation is running as a background service, only wait
+    until the NWP data covering the scene are ready. If the config option
+    *nwp_prepare_scene_steps_first* is set, the lead times covering the scene
+    are prepared first, and the other lead times after pps. The NWP files
+    covering the scene are kept by the *nwp_retention* until pps is done.
+    The PPS processes are followed by the *resources* monitor, if given, and
+    the PGEs run within the *pge_slots* in pge_graph execution. Return True
+    if PPS succeeded.
+    """
+
+    scene_window = get_scene_window(scene)
+    if nwp_retention is None:
+        return _run_nwp_and_pps(scene, scene_window, flens, publish_q, input_msg, options, nwp_handeling_module,
+                                nwp_service, resources, pge_slots)
+    with nwp_retention.in_flight(*scene_window):
+        return _run_nwp_and_pps(scene, scene_window, flens, publish_q, input_msg, options, nwp_handeling_module,
+                                nwp_service, resources, pge_slots)
+
+
+def _run_nwp_and_pps(scene, scene_window, flens, publish_q, input_msg, options, nwp_handeling_module,
+                     nwp_service, resources=None, pge_slots=None):
+    """Wait for or prepare the NWP data for the scene, and run pps."""
+    if nwp_service is not None:
+        if not nwp_service.wait_until_ready(scene['starttime'],
+                                            options['maximum_nwp_wait_in_minutes'] * 60.0,
+                                            endtime=scene_window[1]):
+            LOG.warning("No NWP data covering the scene start time %s. Run PPS anyway...",
+                        str(scene['starttime']))
+    elif options['nwp_prepare_scene_steps_first']:
+        prepare_nwp4pps(flens, nwp_handeling_module, scene_window=scene_window)
+    else:
+        prepare_nwp4pps(flens, nwp_handeling_module)
+    success = pps_worker(scene, publish_q, input_msg, options, resources, pge_slots)
 
+    if nwp_service is None and options['nwp_prepare_scene_steps_first']:
+        prepare_nwp4pps(flens, nwp_handeling_module)
+    return success
 
-def prepare_nwp4pps(flens, nwp_handeling_module):
-    """Prepare NWP data for pps."""
+
+def get_scene(record):
+    """Get the scene to process from the :class:`SceneRecord` of the level-1 files gathered.
+
+    scene = {'platform_name': platform_name,
+             'orbit_number': orbit_number,
+             'satday': satday, 'sathour': sathour,
+             'starttime': starttime, 'endtime': endtime,
+             'sensor': sensors, 'file4pps': file4pps}
+
+    A batch of granules spans the start time of the first granule to the
+    end time of the last one.
+    """
+    return {'platform_name': record.platform_name,
+            'orbit_number': record.orbit_number,
+            'satday': record.starttime.strftime('%Y%m%d'),
+            'sathour': record.starttime.strftime('%H%M'),
+            'starttime': record.starttime,
+            'endtime': record.endtime if record.endtime is not None else 99999,
+            'sensor': SENSOR_LIST.get(record.platform_name, None),
+            'file4pps': get_pps_inputfile(record.platform_name, record.files)}
+
+
+def get_scene_window(scene):
+    """Get the start and end time of the *scene*, the end time being the start time if unknown."""
+    if isinstance(scene['endtime'], datetime):
+        return scene['starttime'], scene['endtime']
+    return scene['starttime'], scene['starttime']
+
+
+def prepare_nwp4pps(flens, nwp_handeling_module, scene_window=None):
+    """Prepare NWP data for pps.
+
+    If a *scene_window* (start, end) is given, only the lead times needed for
+    the NWP data covering the scene are prepared.
+    """
 
     starttime = datetime.utcnow() - timedelta(days=1)
     if nwp_handeling_module:
@@ -289,6 +384,7 @@ def prepare_nwp4pps(flens, nwp_handeling_module):
             params['starttime'] = starttime
             params['nlengths'] = flens
             params['options'] = OPTIONS
+            params['scene_window'] = scene_window
             getattr(module, name)(params)
         except AttributeError:
             LOG.debug("Could not get attribute %s from %s", str(name), str(module))
@@ -296,7 +392,7 @@ def prepare_nwp4pps(flens, nwp_handeling_module):
         LOG.debug("No custom nwp_handeling_function provided in config file...")
         LOG.debug("Use build in.")
         try:
-            update_nwp(starttime, flens)
+            update_nwp(starttime, flens, scene_window=scene_window)
         except (NwpPrepareError, IOError):
             LOG.exception("Something went wrong in update_nwp...")
             raise
@@ -305,6 +401,102 @@ def prepare_nwp4pps(flens, nwp_handeling_module):
     LOG.debug("Leaving prepare_nwp4pps...")
 
 
+def start_nwp_preparation(options, nwp_handeling_module):
+    """Start the NWP preparation in the background, or prepare the NWP data once now.
+
+    Return the NWP preparation service, None if not running in the background.
+    """
+    nwp_service = None
+    if options['nwp_prepare_in_background']:
+        LOG.info("Start the NWP preparation in the background")
+        nwp_service = NwpPrepareService(partial(prepare_nwp4pps, NWP_FLENS, nwp_handeling_module),
+                                        options['nwp_outdir'], get_nwp_output_pattern(options),
+                                        interval=options['nwp_prepare_interval_minutes'] * 60.0,
+                                        scene_steps_first=options['nwp_prepare_scene_steps_first'])
+        nwp_service.start()
+        if options.get('nwp_subscribe_topics'):
+            nwp_listen_thread = NwpListener(nwp_service, options['nwp_subscribe_topics'])
+            nwp_listen_thread.start()
+    else:
+        LOG.info("First check if NWP data should be downloaded and prepared")
+        prepare_nwp4pps(NWP_FLENS, nwp_handeling_module)
+    return nwp_service
+
+
+def start_nwp_retention(options):
+    """Start cleaning up the NWP output directory."""
+    nwp_retention = NwpRetention(options['nwp_outdir'], get_nwp_output_pattern(options),
+                                 max_age=options['nwp_retention_hours'],
+                                 max_size=options['nwp_outdir_max_size_gb'] and options['nwp_outdir_max_size_gb'] * 1e9,
+                                 tmp_max_age=options['nwp_tmp_max_age_minutes'] * 60.0,
+                                 interval=options['nwp_cleanup_interval_minutes'] * 60.0)
+    nwp_retention.start()
+    return nwp_retention
+
+
+def get_scene_stores(options):
+    """Get the :class:`SceneAssembler` gathering the level-1 files, and the :class:`ProcessedScenes`."""
+    granule_processing = options.get('sdr_processing') == 'granules'
+    batch_size = options['sdr_granule_batch_size'] if granule_processing else 1
+    batch_wait = options['sdr_granule_batch_wait_seconds'] if batch_size > 1 else None
+    scenes = SceneAssembler(expiry=options['scene_expiry_minutes'] * 60.0,
+                            time_tolerance=options['scene_time_tolerance_minutes'] * 60.0,
+                            orbit_tolerance=options['scene_orbit_tolerance'],
+                            batch_size=batch_size, batch_wait=batch_wait)
+    processed = ProcessedScenes(maxsize=options['processed_scenes_max'],
+                                ttl=options['processed_scenes_ttl_hours'] * 3600.0,
+                                time_tolerance=options['scene_time_tolerance_minutes'] * 60.0,
+                                orbit_tolerance=options['scene_orbit_tolerance'],
+                                policy=options['duplicate_policy'])
+    return scenes, processed
+
+
+def recover_level1_backlog(options, scenes, process_scene):
+    """Pass on to *process_scene* the level-1 files arrived while the runner was down, if configured."""
+    if not options['level1_backlog_patterns']:
+        return
+    LOG.info("Catch up with the level-1 files arrived while the runner was down")
+    since = datetime.utcnow() - timedelta(hours=options['level1_backlog_max_age_hours'])
+    nscenes = recover_backlog(options['level1_backlog_patterns'], scenes, process_scene,
+                              os.environ.get('SM_PRODUCT_DIR', options.get('pps_outdir', './')),
+                              since=since,
+                              stream_tag_name=options.get('stream_tag_name', 'variant'),
+                              stream_name=options.get('stream_name', 'EARS'),
+                              sdr_granule_processing=options.get('sdr_processing') == 'granules')
+    LOG.info("Number of scenes to catch up with: %d", nscenes)
+
+
+def get_ready_scene(msg, scenes, processed, options):
+    """Add the level-1 files of the *msg* to the *scenes*, and get the record of the scene if ready to run.
+
+    Return None if the scene is still waiting for level-1 files, or if the
+    level-1 data were already processed.
+    """
+    if 'sensor' in msg.data and isinstance(msg.data['sensor'], list):
+        msg.data['sensor'] = msg.data['sensor'][0]
+    if 'orbit_number' not in msg.data:
+        msg.data.update({'orbit_number': 99999})
+    if 'end_time' not in msg.data:
+        msg.data.update({'end_time': 99999})
+
+    orbit_number = int(msg.data['orbit_number'])
+    platform_name = msg.data['platform_name']
+    starttime = msg.data['start_time']
+
+    if processed.is_duplicate(msg):
+        LOG.info("Level-1 data of %s %d %s already processed, skip the message",
+                 platform_name, orbit_number, str(starttime))
+        return None
+
+    status = ready2run(msg, scenes,
+                       stream_tag_name=options.get('stream_tag_name', 'variant'),
+                       stream_name=options.get('stream_name', 'EARS'),
+                       sdr_granule_processing=options.get('sdr_processing') == 'granules')
+    if not status:
+        return None
+    return scenes.pop(scenes.get_sceneid(platform_name, orbit_number, starttime))
+
+
 def pps(options):
     """The PPS runner.
 
@@ -312,15 +504,36 @@ def pps(options):
     is ready with a level-1 file
     """
 
+    if options['engine'] == 'asyncio':
+        asyncio.run(async_pps(options))
+        return
+
     LOG.info("*** Start the PPS level-2 runner:")
 
-    LOG.info("First check if NWP data should be downloaded and prepared")
     nwp_handeling_module = options.get("nwp_handeling_module", None)
-    prepare_nwp4pps(NWP_FLENS, nwp_handeling_module)
-
-    files4pps = {}
+    nwp_service = start_nwp_preparation(options, nwp_handeling_module)
+    nwp_retention = start_nwp_retention(options)
+
+    scenes, processed = get_scene_stores(options)
+    resources = None
+    if options['memory_budget_gb'] or options['cpu_budget']:
+        LOG.info("Admit the scenes within the memory budget %s GB and the CPU budget %s",
+                 str(options['memory_budget_gb']), str(options['cpu_budget']))
+        resources = ResourceMonitor(memory_budget=options['memory_budget_gb'] and options['memory_budget_gb'] * 1e9,
+                                    cpu_budget=options['cpu_budget'],
+                                    default_memory=options['scene_memory_estimate_gb'] * 1e9,
+                                    default_cpu=options['scene_cpu_estimate'],
+                                    interval=options['resource_sample_seconds'])
+        resources.start()
+    pge_slots = PgeSlots(get_pge_settings(options['pge_max_concurrent'], int))
     LOG.info("Number of threads: %d", options['number_of_threads'])
-    thread_pool = ThreadPool(options['number_of_threads'])
+    scheduler = SceneScheduler(options['number_of_threads'],
+                               priorities=get_platform_priorities(options['scene_priorities']),
+                               max_age=options['scene_max_age_minutes'] and options['scene_max_age_minutes'] * 60.0,
+                               stale_policy=options['stale_scene_policy'],
+                               max_pending=options['max_pending_scenes'],
+                               resources=resources)
+    scheduler.start()
 
     listener_q = Queue()
     publisher_q = Queue()
@@ -330,76 +543,160 @@ def pps(options):
     listen_thread = FileListener(listener_q, options['subscribe_topics'])
     listen_thread.start()
 
+    def process_scene(record, msg):
+        if not processed.should_process(record):
+            LOG.info("Scene %s already processed, skip it", record.sceneid)
+            return
+        # Remembered before the job can fail and forget it, forgotten if not queued or dropped
+        processed.add(record)
+        scene = get_scene(record)
+        LOG.info('Queue the scene for preparing the nwp data and run pps...')
+        if not scheduler.submit(SceneId(record.platform_name, record.orbit_number, record.starttime), scene,
+                                processed.run, args=(record, run_nwp_and_pps, scene, NWP_FLENS, publisher_q, msg,
+                                                     options, nwp_handeling_module, nwp_service, nwp_retention,
+                                                     resources, pge_slots),
+                                on_drop=partial(processed.forget, record)):
+            processed.forget(record)
+        stats = scheduler.get_stats()
+        LOG.debug("Number of scenes waiting for a worker: %d, waited %.1f s on average and %.1f s at most",
+                  stats['pending'], stats['mean_wait'], stats['max_wait'])
+        LOG.debug(
+            "Number of threads currently alive: " +
+            str(threading.active_count()))
+        LOG.debug("Number of scenes waiting for more level-1 files: %d", len(scenes))
+
+    recover_level1_backlog(options, scenes, process_scene)
+
+    batch_wait = scenes.batch_wait
     while True:
+        for record in scenes.pop_waited_batches():
+            process_scene(record, record.message)
         try:
-            msg = listener_q.get()
+            msg = listener_q.get(timeout=batch_wait and min(batch_wait, 10.0))
         except Empty:
             continue
 
+        scenes.expire()
         LOG.debug(
             "Number of threads currently alive: " + str(threading.active_count()))
-        if 'sensor' in msg.data and isinstance(msg.data['sensor'], list):
-            msg.data['sensor'] = msg.data['sensor'][0]
-        if 'orbit_number' not in msg.data:
-            msg.data.update({'orbit_number': 99999})
-        if 'end_time' not in msg.data:
-            msg.data.update({'end_time': 99999})
-
-        orbit_number = int(msg.data['orbit_number'])
-        platform_name = msg.data['platform_name']
-        starttime = msg.data['start_time']
-        endtime = msg.data['end_time']
-
-        satday = starttime.strftime('%Y%m%d')
-        sathour = starttime.strftime('%H%M')
-        sensors = SENSOR_LIST.get(platform_name, None)
-        scene = {'platform_name': platform_name,
-                 'orbit_number': orbit_number,
-                 'satday': satday, 'sathour': sathour,
-                 'starttime': starttime, 'endtime': endtime,
-                 'sensor': sensors
-                 }
-
-        status = ready2run(msg, files4pps,
-                           stream_tag_name=options.get('stream_tag_name', 'variant'),
-                           stream_name=options.get('stream_name', 'EARS'),
-                           sdr_granule_processing=options.get('sdr_processing') == 'granules')
-        if status:
-            sceneid = get_sceneid(platform_name, orbit_number, starttime)
-            scene['file4pps'] = get_pps_inputfile(platform_name, files4pps[sceneid])
-
-            LOG.info('Start a thread preparing the nwp data and run pps...')
-
-            if options['number_of_threads'] == 1:
-                run_nwp_and_pps(scene, NWP_FLENS, publisher_q,
-                                msg, options, nwp_handeling_module)
-            else:
-                thread_pool.new_thread(message_uid(msg),
-                                       target=run_nwp_and_pps, args=(scene, NWP_FLENS,
-                                                                     publisher_q,
-                                                                     msg, options,
-                                                                     nwp_handeling_module))
-
-            LOG.debug(
-                "Number of threads currently alive: " +
-                str(threading.active_count()))
-
-            # Clean the files4pps dict:
-            LOG.debug("files4pps: " + str(files4pps))
-            try:
-                files4pps.pop(sceneid)
-            except KeyError:
-                LOG.warning("Failed trying to remove key " + str(sceneid) +
-                            " from dictionary files4pps")
-
-            LOG.debug("After cleaning: files4pps = " + str(files4pps))
-
-    # FIXME! Should I clean up the thread_pool (open threads?) here at the end!?
+        record = get_ready_scene(msg, scenes, processed, options)
+        if record is not None:
+            process_scene(record, msg)
 
+    scheduler.stop()
     pub_thread.stop()
     listen_thread.stop()
 
 
+async def async_run_nwp_and_pps(scene, flens, publish_q, input_msg, options, nwp_handeling_module,
+                                nwp_service=None, nwp_retention=None, pge_slots=None, nwp_executor=None):
+    """Wait for or prepare the NWP data for the scene, and run pps, in the event loop.
+
+    Like :func:`run_nwp_and_pps`, but the NWP preparation not running as a
+    background service is run in the *nwp_executor*, by default the default
+    executor of the loop.
+    """
+    scene_window = get_scene_window(scene)
+    if nwp_retention is None:
+        return await _async_run_nwp_and_pps(scene, scene_window, flens, publish_q, input_msg, options,
+                                            nwp_handeling_module, nwp_service, pge_slots, nwp_executor)
+    with nwp_retention.in_flight(*scene_window):
+        return await _async_run_nwp_and_pps(scene, scene_window, flens, publish_q, input_msg, options,
+                                            nwp_handeling_module, nwp_service, pge_slots, nwp_executor)
+
+
+async def _async_run_nwp_and_pps(scene, scene_window, flens, publish_q, input_msg, options, nwp_handeling_module,
+                                 nwp_service, pge_slots=None, nwp_executor=None):
+    """Wait for or prepare the NWP data for the scene, and run pps, in the event loop."""
+    loop = asyncio.get_running_loop()
+    if nwp_service is not None:
+        if not await wait_until_nwp_ready(nwp_service, scene['starttime'], endtime=scene_window[1],
+                                          timeout=options['maximum_nwp_wait_in_minutes'] * 60.0):
+            LOG.warning("No NWP data covering the scene start time %s. Run PPS anyway...",
+                        str(scene['starttime']))
+    elif options['nwp_prepare_scene_steps_first']:
+        await loop.run_in_executor(nwp_executor, partial(prepare_nwp4pps, flens, nwp_handeling_module,
+                                                         scene_window=scene_window))
+    else:
+        await loop.run_in_executor(nwp_executor, prepare_nwp4pps, flens, nwp_handeling_module)
+    success = await async_pps_worker(scene, publish_q, input_msg, options, pge_slots)
+
+    if nwp_service is None and options['nwp_prepare_scene_steps_first']:
+        await loop.run_in_executor(nwp_executor, prepare_nwp4pps, flens, nwp_handeling_module)
+    return success
+
+
+async def async_pps(options):
+    """The PPS runner, with the messages, the scenes and the PPS processes handled in one event loop."""
+    LOG.info("*** Start the PPS level-2 runner, in an event loop:")
+
+    nwp_handeling_module = options.get("nwp_handeling_module", None)
+    nwp_service = start_nwp_preparation(options, nwp_handeling_module)
+    nwp_retention = start_nwp_retention(options)
+
+    scenes, processed = get_scene_stores(options)
+
+    async def run_scene(record, *args):
+        try:
+            success = await async_run_nwp_and_pps(*args)
+        except Exception:
+            processed.forget(record)
+            raise
+        if not success:
+            LOG.warning("Processing of the scene %s failed, it will be processed again if received again",
+                        record.sceneid)
+            processed.forget(record)
+
+    LOG.info("Number of scenes processed at once: %d", options['number_of_threads'])
+    scheduler = AsyncScheduler(run_scene, options['number_of_threads'],
+                               max_pending=options['max_pending_scenes'],
+                               priorities=get_platform_priorities(options['scene_priorities']))
+    scheduler.start()
+    pge_slots = PgeSlots(get_pge_settings(options['pge_max_concurrent'], int))
+    # The scenes share the NWP files prepared under their locks, so one preparation at a time, not
+    # holding up the default executor of the loop
+    nwp_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='NwpPreparation')
+
+    with Publish('pps2018_runner', 0, options['publish_topic']) as publisher:
+        publisher_q = QueuePublisher(publisher, asyncio.get_running_loop())
+
+        async def process_scene(record, msg):
+            if not processed.should_process(record):
+                LOG.info("Scene %s already processed, skip it", record.sceneid)
+                return
+            processed.add(record)
+            scene = get_scene(record)
+            LOG.info('Queue the scene for preparing the nwp data and run pps...')
+            if not await scheduler.submit(SceneId(record.platform_name, record.orbit_number, record.starttime),
+                                          scene, record, scene, NWP_FLENS, publisher_q, msg, options,
+                                          nwp_handeling_module, nwp_service, nwp_retention, pge_slots,
+                                          nwp_executor):
+                processed.forget(record)
+            LOG.debug("Number of scenes waiting for a worker: %d", scheduler.pending)
+            LOG.debug("Number of scenes waiting for more level-1 files: %d", len(scenes))
+
+        backlog = []
+        recover_level1_backlog(options, scenes, lambda record, msg: backlog.append((record, msg)))
+        for record, msg in backlog:
+            await process_scene(record, msg)
+
+        batch_wait = scenes.batch_wait
+        try:
+            async for msg in receive_messages(options['subscribe_topics'],
+                                              timeout=batch_wait and min(batch_wait, 10.0) or 1.0):
+                for record in scenes.pop_waited_batches():
+                    await process_scene(record, record.message)
+                if msg is None:
+                    continue
+                scenes.expire()
+                record = get_ready_scene(msg, scenes, processed, options)
+                if record is not None:
+                    await process_scene(record, msg)
+        finally:
+            await scheduler.stop()
+            nwp_executor.shutdown(wait=False)
+
+
 if __name__ == "__main__":
 
     from logging import handlers
@@ -29,6 +29,7 @@ from subprocess import Popen, PIPE
 import threading
 from six.moves.queue import Queue
 from datetime import datetime, timedelta
+from functools import partial
 
 from nwcsafpps_runner.config import get_config
 from nwcsafpps_runner.config import MODE
@@ -37,12 +38,16 @@ from nwcsafpps_runner.config import CONFIG_PATH
 from nwcsafpps_runner.utils import ready2run, publish_pps_files
 from nwcsafpps_runner.utils import (terminate_process,
                                     create_pps_call_command_sequence,
-                                    PpsRunError, logreader, get_outputfiles,
+                                    PpsRunError, get_outputfiles,
                                     message_uid)
 from nwcsafpps_runner.utils import (SENSOR_LIST,
                                     SATELLITE_NAME,
                                     METOP_NAME_LETTER)
+from nwcsafpps_runner.output_pump import pump_output
 from nwcsafpps_runner.publish_and_listen import FileListener, FilePublisher
+from nwcsafpps_runner.resources import ResourceMonitor
+from nwcsafpps_runner.scene_assembler import ProcessedScenes, SceneAssembler
+from nwcsafpps_runner.scheduler import SceneScheduler, get_platform_priorities
 
 from nwcsafpps_runner.prepare_nwp import update_nwp
 
@@ -65,41 +70,16 @@ _DEFAULT_LOG_FORMAT = '[%(levelname)s: %(asctime)s : %(name)s] %(message)s'
 LOG.debug("PYTHONPATH: %s", str(sys.path))
 
 
-class ThreadPool(object):
-
-    def __init__(self, max_nthreads=None):
-
-        self.jobs = set()
-        self.sema = threading.Semaphore(max_nthreads)
-        self.lock = threading.Lock()
-
-    def new_thread(self, job_id, group=None, target=None, name=None, args=(), kwargs={}):
-
-        def new_target(*args, **kwargs):
-            with self.sema:
-                result = target(*args, **kwargs)
-
-            self.jobs.remove(job_id)
-            return result
-
-        with self.lock:
-            if job_id in self.jobs:
-                LOG.info("Job with id %s already running!", str(job_id))
-                return
-
-            self.jobs.add(job_id)
-
-        thread = threading.Thread(group, new_target, name, args, kwargs)
-        thread.start()
-
-
-def pps_worker(scene, publish_q, input_msg, options):
+def pps_worker(scene, publish_q, input_msg, options, resources=None):
     """Start PPS on a scene
 
         scene = {'platform_name': platform_name,
                  'orbit_number': orbit_number,
                  'satday': satday, 'sathour': sathour,
                  'starttime': starttime, 'endtime': endtime}
+
+    The PPS process is followed by the *resources* monitor, if given.
+    Return True if PPS succeeded.
     """
 
     try:
@@ -126,19 +106,17 @@ def pps_worker(scene, publish_q, input_msg, options):
             pps_proc = Popen(pps_call_args, shell=False, stderr=PIPE, stdout=PIPE)
         except PpsRunError:
             LOG.exception("Failed in PPS...")
+        if resources is not None:
+            resources.add_process(pps_proc.pid)
 
         min_thr = options.get('maximum_pps_processing_time_in_minutes', 20)
         t__ = threading.Timer(min_thr * 60.0, terminate_process, args=(pps_proc, scene, ))
         t__.start()
 
-        out_reader = threading.Thread(
-            target=logreader, args=(pps_proc.stdout, LOG.info))
-        err_reader = threading.Thread(
-            target=logreader, args=(pps_proc.stderr, LOG.info))
-        out_reader.start()
-        err_reader.start()
-        out_reader.join()
-        err_reader.join()
+        pump_output(pps_proc, str(message_uid(input_msg)), LOG.info).wait()
+        returncode = pps_proc.wait()
+        if returncode != 0:
+            LOG.error("PPS failed with return code %d on scene %s", returncode, str(scene))
 
         LOG.info("Ready with PPS level-2 processing on scene: %s", str(scene))
 
@@ -201,21 +179,34 @@ def pps_worker(scene, publish_q, input_msg, options):
     except Exception:
         LOG.exception('Failed in pps_worker...')
         raise
+    return returncode == 0
+
 
+def run_nwp_and_pps(scene, flens, publish_q, input_msg, options, resources=None):
+    """Run first the nwp-preparation and then pps. No parallel running here!
+
+    If the config option *nwp_prepare_scene_steps_first* is set, the lead
+    times covering the scene are prepared first, and the other lead times
+    after pps. Return True if PPS succeeded.
+    """
 
-def run_nwp_and_pps(scene, flens, publish_q, input_msg, options):
-    """Run first the nwp-preparation and then pps. No parallel running here!"""
+    if not options['nwp_prepare_scene_steps_first']:
+        prepare_nwp4pps(flens)
+        return pps_worker(scene, publish_q, input_msg, options, resources)
 
+    endtime = scene['endtime'] if isinstance(scene['endtime'], datetime) else scene['starttime']
+    prepare_nwp4pps(flens, scene_window=(scene['starttime'], endtime))
+    success = pps_worker(scene, publish_q, input_msg, options, resources)
     prepare_nwp4pps(flens)
-    pps_worker(scene, publish_q, input_msg, options)
+    return success
 
 
-def prepare_nwp4pps(flens):
+def prepare_nwp4pps(flens, scene_window=None):
     """Prepare NWP data for pps"""
 
     starttime = datetime.utcnow() - timedelta(days=1)
     try:
-        update_nwp(starttime, flens)
+        update_nwp(starttime, flens, scene_window=scene_window)
         LOG.info("Ready with nwp preparation")
         LOG.debug("Leaving prepare_nwp4pps...")
     except Exception:
@@ -242,8 +233,29 @@ def pps(options):
     listen_thread = FileListener(listener_q, options['subscribe_topics'])
     listen_thread.start()
 
-    files4pps = {}
-    thread_pool = ThreadPool(options['number_of_threads'])
+    scenes = SceneAssembler(expiry=options['scene_expiry_minutes'] * 60.0,
+                            time_tolerance=options['scene_time_tolerance_minutes'] * 60.0,
+                            orbit_tolerance=options['scene_orbit_tolerance'])
+    processed = ProcessedScenes(maxsize=options['processed_scenes_max'],
+                                ttl=options['processed_scenes_ttl_hours'] * 3600.0,
+                                time_tolerance=options['scene_time_tolerance_minutes'] * 60.0,
+                                orbit_tolerance=options['scene_orbit_tolerance'],
+                                policy=options['duplicate_policy'])
+    resources = None
+    if options['memory_budget_gb'] or options['cpu_budget']:
+        resources = ResourceMonitor(memory_budget=options['memory_budget_gb'] and options['memory_budget_gb'] * 1e9,
+                                    cpu_budget=options['cpu_budget'],
+                                    default_memory=options['scene_memory_estimate_gb'] * 1e9,
+                                    default_cpu=options['scene_cpu_estimate'],
+                                    interval=options['resource_sample_seconds'])
+        resources.start()
+    scheduler = SceneScheduler(options['number_of_threads'],
+                               priorities=get_platform_priorities(options['scene_priorities']),
+                               max_age=options['scene_max_age_minutes'] and options['scene_max_age_minutes'] * 60.0,
+                               stale_policy=options['stale_scene_policy'],
+                               max_pending=options['max_pending_scenes'],
+                               resources=resources)
+    scheduler.start()
     while True:
 
         try:
@@ -251,6 +263,7 @@ def pps(options):
         except Queue.Empty:
             continue
 
+        scenes.expire()
         LOG.debug(
             "Number of threads currently alive: " + str(threading.active_count()))
 
@@ -268,18 +281,33 @@ def pps(options):
                  'starttime': starttime, 'endtime': endtime,
                  'sensor': sensors}
 
-        status = ready2run(msg, files4pps)
-        if status:
-
-            LOG.info('Start a thread preparing the nwp data and run pps...')
-            thread_pool.new_thread(message_uid(msg),
-                                   target=run_nwp_and_pps, args=(scene, NWP_FLENS,
-                                                                 publisher_q,
-                                                                 msg, options))
+        if processed.is_duplicate(msg):
+            LOG.info("Level-1 data of %s %d %s already processed, skip the message",
+                     platform_name, orbit_number, str(starttime))
+            continue
 
+        status = ready2run(msg, scenes)
+        if status:
+            record = scenes.pop(scenes.get_sceneid(platform_name, orbit_number, starttime))
+            if not processed.should_process(record):
+                LOG.info("Scene %s already processed, skip it", record.sceneid)
+                continue
+            # Remembered before the job can fail and forget it, forgotten if not queued or dropped
+            processed.add(record)
+
+            LOG.info('Queue the scene for preparing the nwp data and run pps...')
+            if not scheduler.submit(message_uid(msg), scene, processed.run,
+                                    args=(record, run_nwp_and_pps, scene, NWP_FLENS, publisher_q, msg, options,
+                                          resources),
+                                    on_drop=partial(processed.forget, record)):
+                processed.forget(record)
+            stats = scheduler.get_stats()
+            LOG.debug("Number of scenes waiting for a worker: %d, waited %.1f s on average and %.1f s at most",
+                      stats['pending'], stats['mean_wait'], stats['max_wait'])
             LOG.debug(
                 "Number of threads currently alive: " + str(threading.active_count()))
 
+    scheduler.stop()
     pub_thread.stop()
     listen_thread.stop()
 
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Running the PPS processing of the scenes in one asyncio event loop.
+
+Instead of a thread for the listener, the publisher, every scene, and the
+timer and output readers of every subprocess, the asyncio engine mode of
+the runner handles the message intake, the waits for the NWP data, the PPS
+subprocesses with their timeouts and output, and the publishing as tasks
+of one event loop. The scenes are processed by a fixed number of worker
+tasks, from a bounded queue ordered like the scenes of the
+:class:`nwcsafpps_runner.scheduler.SceneScheduler`.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import posttroll.subscriber
+
+from nwcsafpps_runner.output_pump import MAX_LINE_LENGTH, READ_SIZE, decode_line, pop_lines
+from nwcsafpps_runner.publish_and_listen import check_message
+from nwcsafpps_runner.scheduler import get_priority_key
+
+LOG = logging.getLogger(__name__)
+
+
+async def receive_messages(subscribe_topics, timeout=1.0):
+    """Get the level-1 messages on the *subscribe_topics*, and None every *timeout* seconds without any.
+
+    The posttroll subscriber is set up, polled and closed from one thread of
+    its own, the zmq sockets not being safe to move between threads, and the
+    message intake not waiting for the other blocking jobs of the loop.
+    """
+    loop = asyncio.get_running_loop()
+    LOG.debug("Subscribe topics = %s", str(subscribe_topics))
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='MessageReceiver')
+    subscribe = posttroll.subscriber.Subscribe("", subscribe_topics, True)
+    try:
+        subscr = await loop.run_in_executor(executor, subscribe.__enter__)
+        try:
+            messages = await loop.run_in_executor(executor, partial(subscr.recv, timeout=timeout))
+            while True:
+                msg = await loop.run_in_executor(executor, next, messages)
+                if msg is None:
+                    yield None
+                elif check_message(msg):
+                    LOG.debug("Message = " + str(msg))
+                    yield msg
+        finally:
+            executor.submit(subscribe.__exit__, None, None, None)
+    finally:
+        executor.shutdown(wait=False)
+
+
+async def log_stream(stream, tag, log_func=LOG.info, max_line_length=MAX_LINE_LENGTH):
+    """Log the lines read from the *stream* tagged with *tag*, until its end."""
+    buffer = bytearray()
+    while True:
+        data = await stream.read(READ_SIZE)
+        if not data:
+            break
+        buffer.extend(data)
+        for line in pop_lines(buffer, max_line_length):
+            log_func("[%s] %s", tag, decode_line(line))
+    if buffer:
+        log_func("[%s] %s", tag, decode_line(bytes(buffer)))
+
+
+async def run_process(cmd, tag, timeout=None, log_func=LOG.info, on_start=None):
+    """Run the command *cmd*, a list of arguments, logging its output tagged with *tag*.
+
+    The process is killed if still running after *timeout* seconds, or when
+    cancelled. The *on_start* function, if given, is called with the pid of
+    the process. Return the return code of the process.
+    """
+    LOG.debug("Run command: %s", str(cmd))
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE)
+    readers = asyncio.gather(log_stream(proc.stdout, tag, log_func), log_stream(proc.stderr, tag, log_func))
+    try:
+        if on_start is not None:
+            on_start(proc.pid)
+        try:
+            await asyncio.wait_for(asyncio.shield(readers), timeout)
+        except asyncio.TimeoutError:
+            LOG.info("Process timed out and pre-maturely terminated. Scene: %s", tag)
+            proc.kill()
+        await readers
+        return await proc.wait()
+    finally:
+        if proc.returncode is None:
+            LOG.info("Process cancelled and terminated. Scene: %s", tag)
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await asyncio.gather(readers, return_exceptions=True)
+            await proc.wait()
+
+
+async def wait_until_nwp_ready(nwp_service, starttime, endtime=None, timeout=None, poll_interval=5.0):
+    """Wait until the *nwp_service* has the NWP data covering *starttime* to *endtime*, at most *timeout* seconds.
+
+    Return True if the NWP data are ready.
+    """
+    if nwp_service.is_ready(starttime, endtime):
+        return True
+    LOG.info("Waiting for NWP data covering %s...", str(starttime))
+    nwp_service.ask_for(starttime, endtime)
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while not nwp_service.is_ready(starttime, endtime):
+        if deadline is None:
+            await asyncio.sleep(poll_interval)
+            continue
+        left = deadline - loop.time()
+        if left <= 0:
+            return False
+        await asyncio.sleep(min(poll_interval, left))
+    return True
+
+
+class QueuePublisher(object):
+    """Publish the messages put, from any thread, with the *publisher* of the event *loop*."""
+
+    def __init__(self, publisher, loop):
+        self.publisher = publisher
+        self.loop = loop
+
+    def put(self, msg):
+        """Publish the *msg* from the event loop."""
+        self.loop.call_soon_threadsafe(self._send, msg)
+
+    def _send(self, msg):
+        LOG.info("Publish the files...")
+        self.publisher.send(msg)
+
+
+class AsyncScheduler(object):
+    """Process the scenes with *nworkers* worker tasks, the most urgent first.
+
+    The scenes are processed by awaiting *process_scene* with the arguments
+    given at submission. At most *max_pending* scenes wait in the queue, and
+    the platforms have the *priorities* given (see
+    :func:`nwcsafpps_runner.scheduler.get_platform_priorities`).
+    """
+
+    def __init__(self, process_scene, nworkers=1, max_pending=None, priorities=None):
+        self.process_scene = process_scene
+        self.nworkers = nworkers
+        self.priorities = priorities or {}
+        self._queue = asyncio.PriorityQueue(max_pending or 0)
+        self._jobs = set()
+        self._counter = itertools.count()
+        self._workers = []
+
+    @property
+    def pending(self):
+        """The number of scenes waiting for a worker."""
+        return self._queue.qsize()
+
+    def start(self):
+        """Start the worker tasks."""
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.nworkers)]
+
+    async def stop(self):
+        """Stop the worker tasks, cancelling the scenes being processed."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def join(self):
+        """Wait until all the scenes submitted are processed."""
+        await self._queue.join()
+
+    async def submit(self, job_id, scene, *args):
+        """Queue the *scene*, to be processed with *args*, waiting for a free place if the queue is full.
+
+        Return False if a scene with the same *job_id* is already waiting or
+        being processed.
+        """
+        if job_id in self._jobs:
+            LOG.info("Job with id %s already running!", str(job_id))
+            return False
+        self._jobs.add(job_id)
+        key = get_priority_key(self.priorities, scene['platform_name'], scene['starttime'])
+        await self._queue.put((key, next(self._counter), job_id, args))
+        return True
+
+    async def _work(self):
+        while True:
+            _, _, job_id, args = await self._queue.get()
+            try:
+                await self.process_scene(*args)
+            except Exception:
+                LOG.exception("Failed processing the scene %s", str(job_id))
+            finally:
+                self._jobs.discard(job_id)
+                self._queue.task_done()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Catching up with the level-1 files arrived while the runner was down.
+
+The level-1 files are found from the trollsift patterns of the config, and
+passed to :func:`nwcsafpps_runner.utils.ready2run` as if announced by file
+messages, so that they are gathered into scenes by the same rules as the
+files received live. A pattern is either a string, or a dict with the
+pattern and the metadata not found in the file names, e.g.::
+
+  level1_backlog_patterns:
+    - pattern: /data/hrpt_{platform_name}_{start_time:%Y%m%d_%H%M}_{orbit_number:05d}.l1b
+      sensor: avhrr/3
+
+The processing level of the files, if not given, is taken from the
+extension of the AAPP level-1 files, like .l1c for the level 1C.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta
+from glob import glob
+
+from posttroll.message import Message
+from trollsift import Parser
+
+from nwcsafpps_runner.utils import (METOP_NAME, METOP_NAME_LETTER, SATELLITE_NAME,
+                                    get_outputfiles, ready2run)
+
+LOG = logging.getLogger(__name__)
+
+#: The processing levels of the level-1 files by extension
+PROCESSING_LEVELS = {'.l1a': '1A', '.l1b': '1B', '.l1c': '1C', '.l1d': '1D'}
+
+#: The platform names as found in the level-1 file names
+PLATFORM_NAMES = dict([(value, key) for key, value in SATELLITE_NAME.items()] +
+                      [(value, METOP_NAME[key]) for key, value in METOP_NAME_LETTER.items()])
+
+
+def get_platform_name(name):
+    """Get the platform name of the messages from the *name* found in a file name."""
+    if name in SATELLITE_NAME:
+        return name
+    return PLATFORM_NAMES.get(name.lower(), name)
+
+
+def get_file_metadata(filename, parser, extra):
+    """Get the metadata of the level-1 *filename* parsed with *parser*, or None if not matching."""
+    try:
+        metadata = parser.parse(filename)
+    except ValueError:
+        return None
+    metadata.update(extra)
+    if (not isinstance(metadata.get('start_time'), datetime) or
+            not all(key in metadata for key in ['platform_name', 'orbit_number', 'sensor'])):
+        LOG.warning("Platform, orbit number, sensor or start time missing for %s, skip it", filename)
+        return None
+    metadata['platform_name'] = get_platform_name(str(metadata['platform_name']))
+    starttime = metadata['start_time']
+    endtime = metadata.get('end_time')
+    if isinstance(endtime, datetime) and endtime.year == 1900:
+        endtime = datetime.combine(starttime.date(), endtime.time())
+        if endtime < starttime:
+            endtime += timedelta(days=1)
+        metadata['end_time'] = endtime
+    return metadata
+
+
+def find_level1_files(patterns, since=None):
+    """Find the level-1 files matching the *patterns*, starting after *since*.
+
+    The *patterns* are a list of trollsift patterns, or of dicts with the
+    pattern and the metadata not found in the file names, or a comma
+    separated string of patterns. Return the (filename, metadata) of the
+    files, in start time order.
+    """
+    if isinstance(patterns, str):
+        patterns = [pattern.strip() for pattern in patterns.split(',') if pattern.strip()]
+    found = []
+    for pattern in patterns:
+        extra = {}
+        if isinstance(pattern, dict):
+            extra = dict(pattern)
+            pattern = extra.pop('pattern')
+        parser = Parser(pattern)
+        for filename in glob(parser.globify()):
+            metadata = get_file_metadata(filename, parser, extra)
+            if metadata is None:
+                continue
+            if since is not None and metadata['start_time'] < since:
+                continue
+            found.append((filename, metadata))
+    return sorted(found, key=lambda item: item[1]['start_time'])
+
+
+def make_file_message(filename, metadata):
+    """Make the file message announcing the level-1 *filename*."""
+    data = dict(metadata)
+    level = PROCESSING_LEVELS.get(os.path.splitext(filename)[1].lower())
+    if level is not None:
+        data.setdefault('data_processing_level', level)
+    data['uri'] = os.path.abspath(filename)
+    data['uid'] = os.path.basename(filename)
+    return Message('/backlog/level1', 'file', data)
+
+
+def has_pps_output(outdir, platform_name, orbit_number, starttime):
+    """Check if there are PPS products of the scene in *outdir*, however old."""
+    filelist = get_outputfiles(outdir, SATELLITE_NAME.get(platform_name, platform_name), orbit_number,
+                               st_time=starttime.strftime('%Y%m%dT%H%M'),
+                               h5_output=True, nc_output=True, max_age=None)
+    return len(filelist) > 0
+
+
+def recover_backlog(patterns, scenes, process_scene, outdir, since=None, **kwargs):
+    """Process the scenes of the level-1 files found with the *patterns*.
+
+    The files are added to the *scenes* (a
+    :class:`nwcsafpps_runner.scene_assembler.SceneAssembler`) with
+    :func:`nwcsafpps_runner.utils.ready2run`, which takes the *kwargs*. The
+    complete scenes without PPS products in *outdir* are passed to
+    *process_scene* with the message of their last file, the others are
+    left to be completed by the files received later. Return the number of
+    scenes passed on.
+    """
+    nscenes = 0
+    for filename, metadata in find_level1_files(patterns, since):
+        msg = make_file_message(filename, metadata)
+        if not ready2run(msg, scenes, **kwargs):
+            continue
+        record = scenes.pop(scenes.get_sceneid(msg.data['platform_name'], int(msg.data['orbit_number']),
+                                               msg.data['start_time']))
+        if has_pps_output(outdir, record.platform_name, record.orbit_number, record.starttime):
+            LOG.info("Scene %s already processed before the restart, skip it", record.sceneid)
+            continue
+        LOG.info("Catch up with the scene %s", record.sceneid)
+        process_scene(record, msg)
+        nscenes += 1
+    return nscenes
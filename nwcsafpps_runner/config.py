@@ -94,6 +94,39 @@ def get_config_init_cfg(configfile, service=MODE):
     options['station'] = options.get('station', 'unknown')
     options['run_cmask_prob'] = options.get('run_cmask_prob', True)
     options['run_pps_cpp'] = options.get('run_pps_cpp', True)
+    options['run_pps_precip'] = options.get('run_pps_precip', False)
+    options['pps_execution'] = options.get('pps_execution', 'run_all')
+    options['pge_script_dir'] = options.get('pge_script_dir', None)
+    for key in ['pge_scripts', 'pge_arguments', 'pge_timeouts_minutes', 'pge_max_concurrent']:
+        options[key] = options.get(key, None)
+    options['nwp_prepare_in_background'] = options.get('nwp_prepare_in_background', False)
+    options['nwp_prepare_interval_minutes'] = int(options.get('nwp_prepare_interval_minutes', 10))
+    options['maximum_nwp_wait_in_minutes'] = int(options.get('maximum_nwp_wait_in_minutes', 30))
+    options['nwp_prepare_scene_steps_first'] = options.get('nwp_prepare_scene_steps_first', False)
+    for key in ['nwp_retention_hours', 'nwp_outdir_max_size_gb']:
+        options[key] = options.get(key) and float(options[key])
+    options['nwp_tmp_max_age_minutes'] = int(options.get('nwp_tmp_max_age_minutes', 60))
+    options['nwp_cleanup_interval_minutes'] = int(options.get('nwp_cleanup_interval_minutes', 60))
+    options['scene_expiry_minutes'] = int(options.get('scene_expiry_minutes', 180))
+    options['scene_time_tolerance_minutes'] = float(options.get('scene_time_tolerance_minutes', 5))
+    options['scene_orbit_tolerance'] = int(options.get('scene_orbit_tolerance', 1))
+    options['sdr_granule_batch_size'] = int(options.get('sdr_granule_batch_size', 1))
+    options['sdr_granule_batch_wait_seconds'] = float(options.get('sdr_granule_batch_wait_seconds', 300))
+    options['processed_scenes_max'] = int(options.get('processed_scenes_max', 1000))
+    options['processed_scenes_ttl_hours'] = float(options.get('processed_scenes_ttl_hours', 12))
+    options['duplicate_policy'] = options.get('duplicate_policy', 'drop')
+    options['scene_priorities'] = options.get('scene_priorities', None)
+    options['scene_max_age_minutes'] = options.get('scene_max_age_minutes') and float(options['scene_max_age_minutes'])
+    options['stale_scene_policy'] = options.get('stale_scene_policy', 'defer')
+    options['max_pending_scenes'] = int(options.get('max_pending_scenes', 100))
+    for key in ['memory_budget_gb', 'cpu_budget']:
+        options[key] = options.get(key) and float(options[key])
+    options['scene_memory_estimate_gb'] = float(options.get('scene_memory_estimate_gb', 2))
+    options['scene_cpu_estimate'] = float(options.get('scene_cpu_estimate', 1))
+    options['resource_sample_seconds'] = float(options.get('resource_sample_seconds', 10))
+    options['engine'] = options.get('engine', 'threads')
+    options['level1_backlog_patterns'] = options.get('level1_backlog_patterns', [])
+    options['level1_backlog_max_age_hours'] = float(options.get('level1_backlog_max_age_hours', 24))
     #: Change yes to True and no to False to match .yaml
     for arname, val in options.items():
         if val == 'yes':
@@ -138,5 +171,38 @@ def get_config_yaml(configfile, service=MODE, procenv=''):
     options['station'] = options.get('station', 'unknown')
     options['run_cmask_prob'] = options.get('run_cmask_prob', True)
     options['run_pps_cpp'] = options.get('run_pps_cpp', True)
+    options['run_pps_precip'] = options.get('run_pps_precip', False)
+    options['pps_execution'] = options.get('pps_execution', 'run_all')
+    options['pge_script_dir'] = options.get('pge_script_dir', None)
+    for key in ['pge_scripts', 'pge_arguments', 'pge_timeouts_minutes', 'pge_max_concurrent']:
+        options[key] = options.get(key, None)
+    options['nwp_prepare_in_background'] = options.get('nwp_prepare_in_background', False)
+    options['nwp_prepare_interval_minutes'] = int(options.get('nwp_prepare_interval_minutes', 10))
+    options['maximum_nwp_wait_in_minutes'] = int(options.get('maximum_nwp_wait_in_minutes', 30))
+    options['nwp_prepare_scene_steps_first'] = options.get('nwp_prepare_scene_steps_first', False)
+    for key in ['nwp_retention_hours', 'nwp_outdir_max_size_gb']:
+        options[key] = options.get(key) and float(options[key])
+    options['nwp_tmp_max_age_minutes'] = int(options.get('nwp_tmp_max_age_minutes', 60))
+    options['nwp_cleanup_interval_minutes'] = int(options.get('nwp_cleanup_interval_minutes', 60))
+    options['scene_expiry_minutes'] = int(options.get('scene_expiry_minutes', 180))
+    options['scene_time_tolerance_minutes'] = float(options.get('scene_time_tolerance_minutes', 5))
+    options['scene_orbit_tolerance'] = int(options.get('scene_orbit_tolerance', 1))
+    options['sdr_granule_batch_size'] = int(options.get('sdr_granule_batch_size', 1))
+    options['sdr_granule_batch_wait_seconds'] = float(options.get('sdr_granule_batch_wait_seconds', 300))
+    options['processed_scenes_max'] = int(options.get('processed_scenes_max', 1000))
+    options['processed_scenes_ttl_hours'] = float(options.get('processed_scenes_ttl_hours', 12))
+    options['duplicate_policy'] = options.get('duplicate_policy', 'drop')
+    options['scene_priorities'] = options.get('scene_priorities', None)
+    options['scene_max_age_minutes'] = options.get('scene_max_age_minutes') and float(options['scene_max_age_minutes'])
+    options['stale_scene_policy'] = options.get('stale_scene_policy', 'defer')
+    options['max_pending_scenes'] = int(options.get('max_pending_scenes', 100))
+    for key in ['memory_budget_gb', 'cpu_budget']:
+        options[key] = options.get(key) and float(options[key])
+    options['scene_memory_estimate_gb'] = float(options.get('scene_memory_estimate_gb', 2))
+    options['scene_cpu_estimate'] = float(options.get('scene_cpu_estimate', 1))
+    options['resource_sample_seconds'] = float(options.get('resource_sample_seconds', 10))
+    options['engine'] = options.get('engine', 'threads')
+    options['level1_backlog_patterns'] = options.get('level1_backlog_patterns', [])
+    options['level1_backlog_max_age_hours'] = float(options.get('level1_backlog_max_age_hours', 24))
 
     return options
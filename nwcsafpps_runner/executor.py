@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Running jobs with a fixed number of workers.
+
+The jobs wait in a bounded queue until a worker is free, so a backlog
+holds only the jobs, not one parked thread each. A job is identified by its
+id, and a job with the same id as one waiting or running is refused, until
+that one is done whatever its outcome.
+
+The jobs are run in the worker threads, or, with the process backend, each
+worker thread hands its job over to a pool of as many processes, started
+from a fork server not to inherit the threads and locks of the runner. A
+job of the process backend is then a module-level function called with
+plain, picklable, arguments, its result being sent back in the *results*
+queue rather than through shared objects.
+"""
+
+import collections
+import logging
+import multiprocessing
+import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+LOG = logging.getLogger(__name__)
+
+#: Where the jobs are run: in the worker threads, or in a pool of as many processes
+BACKENDS = ('thread', 'process')
+
+
+class Job(object):
+    """A job waiting to be run by calling *func* with *args*, *on_drop* being called if it is dropped instead."""
+
+    __slots__ = ('job_id', 'func', 'args', 'on_drop', 'submitted')
+
+    def __init__(self, job_id, func, args, on_drop=None):
+        self.job_id = job_id
+        self.func = func
+        self.args = args
+        self.on_drop = on_drop
+        self.submitted = time.monotonic()
+
+
+class JobExecutor(object):
+    """Run the jobs with *nworkers* workers, at most *max_pending* jobs waiting.
+
+    The jobs are run in the worker threads, or in a process pool, depending
+    on the *backend*. If a *results* queue is given, the (job id, result) of
+    every job done is put in it.
+    """
+
+    def __init__(self, nworkers=1, max_pending=None, backend='thread', results=None):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown executor backend %s, should be one of %s" %
+                             (backend, str(BACKENDS)))
+        self.nworkers = nworkers
+        self.max_pending = max_pending
+        self.backend = backend
+        self.results = results
+        self.loop = True
+        self._queue = collections.deque()
+        self._jobs = set()
+        self._running = 0
+        self._cond = threading.Condition()
+        self._workers = []
+        self._pool = None
+        self._stats = collections.Counter()
+        self._max_wait = 0.0
+        #: Seconds between the checks for a job to start, when the queue holds jobs not to start yet
+        self.retry_interval = None
+
+    @property
+    def pending(self):
+        """The number of jobs waiting for a worker."""
+        return len(self._queue)
+
+    @property
+    def running(self):
+        """The number of jobs being run."""
+        return self._running
+
+    def get_stats(self):
+        """Get the numbers of jobs submitted, refused, dropped, done and failed, and the queue waits."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._queue)
+            stats['running'] = self._running
+            stats['max_wait'] = self._max_wait
+            started = self._stats['started']
+            stats['mean_wait'] = self._stats['total_wait'] / started if started else 0.0
+        return stats
+
+    def start(self):
+        """Start the workers."""
+        if self.backend == 'process':
+            self._pool = ProcessPoolExecutor(self.nworkers, mp_context=multiprocessing.get_context('forkserver'))
+        for idx in range(self.nworkers):
+            worker = threading.Thread(target=self._work, name='%s-%d' % (self.__class__.__name__, idx),
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """Stop the workers once done with the jobs being run."""
+        with self._cond:
+            self.loop = False
+            self._cond.notify_all()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def join(self, timeout=None):
+        """Wait for the workers to stop."""
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def submit(self, job_id, func, args=(), timeout=None, on_drop=None):
+        """Queue the job *job_id* calling *func* with *args*.
+
+        If the queue is full, wait at most *timeout* seconds for a free
+        place, forever if None. Return False if the job was not queued. If
+        the job is dropped from the queue later on, *on_drop* is called, if
+        given. With the process backend, *func* has to be a module-level
+        function and *args* picklable, or TypeError is raised.
+        """
+        return self._enqueue(Job(job_id, func, args, on_drop), timeout)
+
+    def _check_picklable(self, job):
+        try:
+            pickle.dumps((job.func, job.args))
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            raise TypeError("Job %s cannot be run by the process backend, it should be a module-level function "
+                            "with picklable arguments: %s" % (str(job.job_id), str(err)))
+
+    def _enqueue(self, job, timeout=None):
+        if self.backend == 'process':
+            self._check_picklable(job)
+        with self._cond:
+            if not self._cond.wait_for(lambda: job.job_id in self._jobs or not self._is_full(), timeout):
+                LOG.warning("Job queue full, %d jobs waiting, refuse job %s", len(self._queue), str(job.job_id))
+                self._stats['refused'] += 1
+                return False
+            if job.job_id in self._jobs:
+                LOG.info("Job with id %s already running!", str(job.job_id))
+                self._stats['refused'] += 1
+                return False
+            if not self._admit(job):
+                self._stats['dropped'] += 1
+                return False
+            self._jobs.add(job.job_id)
+            self._push(job)
+            self._stats['submitted'] += 1
+            self._cond.notify_all()
+        return True
+
+    def _is_full(self):
+        return self.max_pending is not None and len(self._queue) >= self.max_pending
+
+    def _is_saturated(self):
+        return self._running + len(self._queue) >= self.nworkers
+
+    def _admit(self, job):
+        """Check if the *job* is to be queued, the lock being held."""
+        return True
+
+    def _push(self, job):
+        self._queue.append(job)
+
+    def _pop(self):
+        """Get the next job to run from the non-empty queue.
+
+        Return None if the jobs left were dropped, or are not to start yet.
+        """
+        return self._queue.popleft()
+
+    def _drop(self, job):
+        """Forget the queued *job* not to be run."""
+        self._jobs.discard(job.job_id)
+        self._stats['dropped'] += 1
+        self._cond.notify_all()
+        if job.on_drop is not None:
+            try:
+                job.on_drop()
+            except Exception:
+                LOG.exception("Failed cleaning up the dropped job %s", str(job.job_id))
+
+    def _next_job(self):
+        """Wait for the next job to run, None if stopped."""
+        with self._cond:
+            while self.loop:
+                job = self._pop() if self._queue else None
+                if job is None:
+                    self._cond.wait(self.retry_interval if self._queue else None)
+                    continue
+                self._running += 1
+                wait = time.monotonic() - job.submitted
+                self._stats['started'] += 1
+                self._stats['total_wait'] += wait
+                self._max_wait = max(self._max_wait, wait)
+                self._cond.notify_all()
+                LOG.debug("Start job %s after %.1f s in the queue, %d jobs waiting",
+                          str(job.job_id), wait, len(self._queue))
+                return job
+            return None
+
+    def _run(self, job):
+        if self._pool is None:
+            return job.func(*job.args)
+        return self._pool.submit(job.func, *job.args).result()
+
+    def _work(self):
+        """Run the jobs until stopped."""
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            outcome = 'done'
+            try:
+                result = self._run(job)
+                if self.results is not None:
+                    self.results.put((job.job_id, result))
+            except Exception:
+                LOG.exception("Job %s failed", str(job.job_id))
+                outcome = 'failed'
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._jobs.discard(job.job_id)
+                    self._stats[outcome] += 1
+                    self._cond.notify_all()
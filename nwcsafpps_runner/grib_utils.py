@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reading, filtering and writing GRIB files for the PPS NWP preparation.
+"""
+
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from math import ceil, floor
+
+import eccodes as ecc
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+#: Buffer size used when writing the assembled GRIB files
+WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+
+#: The GRIB keys describing a field in the PPS NWP requirements file
+ENTRY_KEYS = ('paramId', 'name', 'level', 'typeOfLevel')
+
+#: Number of files for which the GRIB header index is cached
+HEADER_CACHE_SIZE = 64
+
+#: The GRIB keys describing a regular lat-lon grid
+GRID_KEYS = ('Ni', 'Nj', 'latitudeOfFirstGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees',
+             'iDirectionIncrementInDegrees', 'jDirectionIncrementInDegrees', 'jScansPositively')
+
+#: Tolerance in grid steps when matching the crop area to the grid points
+GRID_EPSILON = 1e-6
+
+_HEADER_CACHE = OrderedDict()
+_REQUIREMENTS_CACHE = {}
+_STATIC_FIELDS_CACHE = {}
+#: The caches are shared by the NWP preparation and the scene worker threads
+_CACHE_LOCK = threading.Lock()
+
+
+def clear_caches():
+    """Forget the cached GRIB headers, NWP requirements and static fields."""
+    with _CACHE_LOCK:
+        _HEADER_CACHE.clear()
+        _REQUIREMENTS_CACHE.clear()
+        _STATIC_FIELDS_CACHE.clear()
+
+
+def read_nwp_requirements(filename):
+    """Read the list of fields mandatory for PPS from the NWP requirements file.
+
+    The parsed requirements are cached until the file is modified.
+    """
+    mtime = os.stat(filename).st_mtime
+    with _CACHE_LOCK:
+        cached = _REQUIREMENTS_CACHE.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return list(cached[1])
+
+    with open(filename, 'r') as fpt:
+        lines = fpt.readlines()
+
+    required_fields = [ll.strip('M ').strip('\n') for ll in lines if str(ll).startswith('M')]
+    with _CACHE_LOCK:
+        _REQUIREMENTS_CACHE[filename] = (mtime, tuple(required_fields))
+    return required_fields
+
+
+def index_grib_messages(filename):
+    """Get the offset and length of every GRIB message in *filename*.
+
+    The file is memory mapped and only the first bytes of each message are
+    read, so the data sections are never touched.
+    """
+    index = []
+    if os.path.getsize(filename) == 0:
+        return index
+
+    with open(filename, 'rb') as fin:
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm_:
+            offset = mm_.find(b'GRIB')
+            while offset >= 0:
+                edition = mm_[offset + 7]
+                if edition == 1:
+                    length = int.from_bytes(mm_[offset + 4:offset + 7], 'big')
+                    if length & 0x800000:
+                        # Large GRIB 1 message, the length is not in section 0
+                        length = _get_total_length(fin, offset)
+                elif edition == 2:
+                    length = int.from_bytes(mm_[offset + 8:offset + 16], 'big')
+                else:
+                    raise IOError("Unknown GRIB edition %d at offset %d in %s" % (edition, offset, filename))
+                if mm_[offset + length - 4:offset + length] != b'7777':
+                    raise IOError("Corrupt GRIB message at offset %d in %s" % (offset, filename))
+                index.append((offset, length))
+                offset = mm_.find(b'GRIB', offset + length)
+
+    return index
+
+
+def _get_total_length(fin, offset):
+    """Get the total length of the GRIB message at *offset* in the open file *fin*, using eccodes."""
+    fin.seek(offset)
+    gid = ecc.codes_grib_new_from_file(fin, headers_only=True)
+    try:
+        return ecc.codes_get(gid, 'totalLength')
+    finally:
+        ecc.codes_release(gid)
+
+
+def read_grib_headers(filename, keys=ENTRY_KEYS):
+    """Read the *keys* from the headers of all GRIB messages in *filename*.
+
+    Return a list of (offset, length, values) tuples, one per message, where
+    values is a tuple with the values of the *keys*. Only the header sections
+    of the messages are decoded. The result is cached for as long as the file
+    is not modified.
+    """
+    stat = os.stat(filename)
+    cache_key = (filename, tuple(keys))
+    with _CACHE_LOCK:
+        cached = _HEADER_CACHE.get(cache_key)
+        if cached is not None and cached[0] == (stat.st_size, stat.st_mtime):
+            _HEADER_CACHE.move_to_end(cache_key)
+            return cached[1]
+
+    headers = []
+    with open(filename, 'rb') as fin:
+        for offset, length in index_grib_messages(filename):
+            fin.seek(offset)
+            gid = ecc.codes_grib_new_from_file(fin, headers_only=True)
+            try:
+                headers.append((offset, length, tuple(ecc.codes_get(gid, key) for key in keys)))
+            finally:
+                ecc.codes_release(gid)
+
+    with _CACHE_LOCK:
+        _HEADER_CACHE[cache_key] = ((stat.st_size, stat.st_mtime), headers)
+        _HEADER_CACHE.move_to_end(cache_key)
+        if len(_HEADER_CACHE) > HEADER_CACHE_SIZE:
+            _HEADER_CACHE.popitem(last=False)
+    return headers
+
+
+def get_grib_entries(filename):
+    """Get the descriptions of the fields in *filename* as listed in the PPS NWP requirements file."""
+    return ["%s %s %s %s" % values for _, _, values in read_grib_headers(filename)]
+
+
+def parse_nwp_requirement(item):
+    """Split a field description from the PPS NWP requirements file into its parts."""
+    parts = item.split()
+    return {'paramId': parts[0],
+            'name': ' '.join(parts[1:-2]),
+            'level': parts[-2],
+            'typeOfLevel': parts[-1]}
+
+
+def get_missing_fields(entries, required_fields):
+    """Get a report of the *required_fields* not found among the field *entries*.
+
+    Return a list of dicts with the paramId, name, level and typeOfLevel of
+    each missing field.
+    """
+    entries = set(entries)
+    return [parse_nwp_requirement(item) for item in required_fields if item not in entries]
+
+
+def append_file(infile, fout, ranges=None):
+    """Append the content of *infile* to the open file object *fout*.
+
+    If given, only the (offset, length) byte *ranges* are appended, otherwise
+    the full file. The data are copied by the kernel (zero-copy) where the
+    platform supports it, otherwise with a buffered copy.
+    """
+    fout.flush()
+    if ranges is None:
+        ranges = [(0, os.path.getsize(infile))]
+    with open(infile, 'rb') as fin:
+        for offset, length in _merge_ranges(ranges):
+            _copy_range(fin, fout, offset, length)
+
+
+def _merge_ranges(ranges):
+    """Merge adjacent (offset, length) byte ranges."""
+    merged = []
+    for offset, length in ranges:
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def _copy_range(fin, fout, offset, length):
+    """Copy *length* bytes from *offset* in the open file *fin* to the end of *fout*."""
+    end = offset + length
+    try:
+        while offset < end:
+            sent = os.sendfile(fout.fileno(), fin.fileno(), offset, end - offset)
+            if sent == 0:
+                break
+            offset = offset + sent
+    except (AttributeError, OSError):
+        LOG.debug("Zero-copy not possible, use a buffered copy of %s", fin.name)
+        fin.seek(offset)
+        while offset < end:
+            data = fin.read(min(WRITE_BUFFER_SIZE, end - offset))
+            if not data:
+                break
+            fout.write(data)
+            offset = offset + len(data)
+
+
+def get_crop_area(value):
+    """Get the crop area from the config *value*.
+
+    The area is given as a list, or a comma separated string, of the north,
+    west, south and east bounds in degrees (like the MARS area keyword). The
+    west bound may be east of the east bound, for an area crossing the
+    antimeridian. Return None if no area is given.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    area = tuple(float(bound) for bound in value)
+    if len(area) != 4:
+        raise ValueError("The crop area should be given as north, west, south, east: %s" % str(value))
+    if area[0] < area[2]:
+        raise ValueError("The north bound of the crop area is south of the south bound: %s" % str(value))
+    return area
+
+
+def get_crop_indices(grid, area):
+    """Get the rows and columns of the regular lat-lon *grid* inside the crop *area*.
+
+    *grid* is a dict with the values of the :data:`GRID_KEYS`, and *area* the
+    (north, west, south, east) bounds in degrees. Return the slice of rows,
+    the first column and the number of columns to keep, and a dict of the
+    GRIB keys describing the cropped grid. On a global grid the columns wrap
+    around, so the first column plus the number of columns may exceed the
+    number of grid columns.
+    """
+    north, west, south, east = area
+    ni, nj = grid['Ni'], grid['Nj']
+    lat0 = grid['latitudeOfFirstGridPointInDegrees']
+    lon0 = grid['longitudeOfFirstGridPointInDegrees']
+    dlat = grid['jDirectionIncrementInDegrees']
+    dlon = grid['iDirectionIncrementInDegrees']
+
+    if grid['jScansPositively']:
+        first_row = ceil((south - lat0) / dlat - GRID_EPSILON)
+        last_row = floor((north - lat0) / dlat + GRID_EPSILON)
+        lat_sign = 1
+    else:
+        first_row = ceil((lat0 - north) / dlat - GRID_EPSILON)
+        last_row = floor((lat0 - south) / dlat + GRID_EPSILON)
+        lat_sign = -1
+    first_row = max(first_row, 0)
+    last_row = min(last_row, nj - 1)
+
+    span = east - west
+    if span < 0:
+        span = span + 360
+    is_global = ni * dlon >= 360 - dlon * GRID_EPSILON
+    if span >= 360 - dlon * GRID_EPSILON or (span == 0 and west != east):
+        first_col, last_col = 0, ni - 1
+    else:
+        west_offset = (west - lon0) % 360
+        first_col = ceil(west_offset / dlon - GRID_EPSILON)
+        last_col = floor((west_offset + span) / dlon + GRID_EPSILON)
+        if is_global:
+            last_col = min(last_col, first_col + ni - 1)
+        else:
+            if first_col > ni - 1 and west_offset + span >= 360:
+                # The area starts west of the grid and ends inside it
+                first_col, last_col = 0, floor((west_offset + span - 360) / dlon + GRID_EPSILON)
+            last_col = min(last_col, ni - 1)
+
+    if last_row < first_row or last_col < first_col:
+        raise ValueError("The crop area %s is outside the grid" % str(area))
+
+    ncols = last_col - first_col + 1
+    first_col = first_col % ni
+    lon_first = (lon0 + first_col * dlon) % 360
+    crop_keys = {'Ni': ncols,
+                 'Nj': last_row - first_row + 1,
+                 'latitudeOfFirstGridPointInDegrees': lat0 + lat_sign * first_row * dlat,
+                 'latitudeOfLastGridPointInDegrees': lat0 + lat_sign * last_row * dlat,
+                 'longitudeOfFirstGridPointInDegrees': lon_first,
+                 'longitudeOfLastGridPointInDegrees': (lon_first + (ncols - 1) * dlon) % 360}
+    return slice(first_row, last_row + 1), first_col, ncols, crop_keys
+
+
+def crop_values(values, shape, rows, first_col, ncols):
+    """Crop the flat field *values* of the grid *shape* to the *rows* and columns.
+
+    The cropping is done on views of *values*, and the cropped field is
+    copied once into the flat contiguous array returned. The columns wrap
+    around the grid if needed.
+    """
+    field = values.reshape(shape)[rows]
+    if first_col + ncols <= shape[1]:
+        field = field[:, first_col:first_col + ncols]
+        return np.ascontiguousarray(field).ravel()
+    columns = np.arange(first_col, first_col + ncols)
+    return np.take(field, columns, axis=1, mode='wrap').ravel()
+
+
+def get_packing(value):
+    """Get the GRIB packing of the prepared NWP fields from the config *value*.
+
+    The packing is given as a list, or a comma separated string, of
+    *paramId:packingType:bitsPerValue* items, like ``167:grid_ccsds:16``.
+    The paramId *default* applies to all other parameters, and the
+    bitsPerValue may be left out to keep those of the input. Return a dict
+    with the (packingType, bitsPerValue) of each paramId, where the default
+    has the key None, or None if no packing is given.
+    """
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    packing = {}
+    for item in value:
+        parts = str(item).strip().split(':')
+        if len(parts) not in (2, 3):
+            raise ValueError("The packing should be given as paramId:packingType:bitsPerValue: %s" % str(item))
+        param = None if parts[0] == 'default' else int(parts[0])
+        bits_per_value = int(parts[2]) if len(parts) == 3 else None
+        packing[param] = (parts[1], bits_per_value)
+    return packing
+
+
+def set_packing(gid, packing_type, bits_per_value=None):
+    """Set the *packing_type* and *bits_per_value* of the GRIB message *gid*.
+
+    If eccodes does not support the packing type (like CCSDS without AEC
+    support), the packing type of the message is kept.
+    """
+    try:
+        ecc.codes_set(gid, 'packingType', packing_type)
+    except ecc.CodesInternalError:
+        LOG.warning("GRIB packing %s not supported, keep %s", packing_type, ecc.codes_get(gid, 'packingType'))
+    if bits_per_value is not None:
+        ecc.codes_set(gid, 'bitsPerValue', bits_per_value)
+
+
+def encode_grib_message(gid, area=None, packing=None):
+    """Encode the GRIB message *gid* cropped to the *area* and with the *packing* of its parameter.
+
+    *area* is a crop area as given by :func:`get_crop_area` and *packing* a
+    dict as given by :func:`get_packing`. Return the handle of a new message,
+    or None if there is nothing to change: no packing for the parameter,
+    and no area or a message not on a regular lat-lon grid scanning
+    eastwards. The caller should release the new message.
+    """
+    param_packing = None
+    if packing:
+        param_packing = packing.get(ecc.codes_get(gid, 'paramId'), packing.get(None))
+    can_crop = (area is not None and ecc.codes_get(gid, 'gridType') == 'regular_ll' and
+                not ecc.codes_get(gid, 'iScansNegatively'))
+    if not can_crop and param_packing is None:
+        return None
+
+    values = ecc.codes_get_values(gid)
+    clone_id = ecc.codes_clone(gid)
+    if param_packing is not None:
+        set_packing(clone_id, *param_packing)
+    if can_crop:
+        grid = dict((key, ecc.codes_get(gid, key)) for key in GRID_KEYS)
+        rows, first_col, ncols, crop_keys = get_crop_indices(grid, area)
+        values = crop_values(values, (grid['Nj'], grid['Ni']), rows, first_col, ncols)
+        for key, value in crop_keys.items():
+            ecc.codes_set(clone_id, key, value)
+    ecc.codes_set_values(clone_id, values)
+    return clone_id
+
+
+def get_encoded_message(gid, area=None, packing=None):
+    """Get the GRIB message *gid* as bytes, encoded with the *area* and *packing* (see :func:`encode_grib_message`)."""
+    clone_id = encode_grib_message(gid, area, packing)
+    if clone_id is None:
+        return ecc.codes_get_message(gid)
+    try:
+        return ecc.codes_get_message(clone_id)
+    finally:
+        ecc.codes_release(clone_id)
+
+
+def write_grib_message(gid, fout, area=None, packing=None):
+    """Write the GRIB message *gid*, encoded with the *area* and *packing*, to the open file *fout*.
+
+    Messages that need no change are written as they are (see
+    :func:`encode_grib_message`).
+    """
+    fout.write(get_encoded_message(gid, area, packing))
+
+
+def append_grib_messages(infile, fout, offsets=None, area=None, packing=None):
+    """Append the GRIB messages of *infile*, encoded with the *area* and *packing*, to the open file *fout*.
+
+    If given, only the messages starting at the byte *offsets* are appended.
+    """
+    if offsets is None:
+        offsets = [offset for offset, _ in index_grib_messages(infile)]
+    with open(infile, 'rb') as fin:
+        for offset in offsets:
+            fin.seek(offset)
+            gid = ecc.codes_grib_new_from_file(fin)
+            try:
+                write_grib_message(gid, fout, area, packing)
+            finally:
+                ecc.codes_release(gid)
+
+
+def read_static_fields(filename, area=None, packing=None):
+    """Read the encoded GRIB messages of the static fields in *filename*.
+
+    The fields are cropped to the *area* and packed with the *packing*, if
+    given (see :func:`encode_grib_message`). Return a list of (paramId, level,
+    message) tuples, in the order of the file, where message is the encoded
+    GRIB message as bytes. The static fields are read, and encoded, once
+    and kept in memory until the file is modified.
+    """
+    mtime = os.stat(filename).st_mtime
+    cache_key = (filename, area, packing and tuple(sorted(packing.items(), key=str)))
+    with _CACHE_LOCK:
+        cached = _STATIC_FIELDS_CACHE.get(cache_key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    LOG.debug("Read the static fields from %s", filename)
+    fields = []
+    with open(filename, 'rb') as fin:
+        for offset, length, (param, level) in read_grib_headers(filename, ('paramId', 'level')):
+            fin.seek(offset)
+            if area is None and packing is None:
+                fields.append((param, level, fin.read(length)))
+                continue
+            gid = ecc.codes_grib_new_from_file(fin)
+            try:
+                fields.append((param, level, get_encoded_message(gid, area, packing)))
+            finally:
+                ecc.codes_release(gid)
+
+    with _CACHE_LOCK:
+        _STATIC_FIELDS_CACHE[cache_key] = (mtime, fields)
+    return fields
+
+
+def assemble_nwp_file(outfile, nhsp_file, nhsf_file, static_file,
+                      grid_type='regular_ll', required_fields=None, area=None, packing=None):
+    """Assemble the NWP file for PPS from the GRIB message headers of the input files.
+
+    The *grid_type* messages of the *nhsp_file* are followed by all messages
+    of the *nhsf_file* and the *static_file* with land-sea mask and
+    topography. The messages are selected from their headers only, and
+    copied as they are unless a crop *area* or a *packing* is given (see
+    :func:`encode_grib_message`). The static fields are kept in memory
+    between calls (see :func:`read_static_fields`). If a list of
+    *required_fields* is given, return a report of the required fields
+    missing in *outfile* (see :func:`get_missing_fields`).
+    """
+    entries = []
+    ranges = []
+    for offset, length, values in read_grib_headers(nhsp_file, ENTRY_KEYS + ('gridType', )):
+        if grid_type is None or values[-1] == grid_type:
+            ranges.append((offset, length))
+            entries.append("%s %s %s %s" % values[:-1])
+
+    with open(outfile, 'wb', buffering=WRITE_BUFFER_SIZE) as fout:
+        if area is None and packing is None:
+            append_file(nhsp_file, fout, ranges)
+            append_file(nhsf_file, fout)
+        else:
+            append_grib_messages(nhsp_file, fout, [offset for offset, _ in ranges], area, packing)
+            append_grib_messages(nhsf_file, fout, None, area, packing)
+        for _, _, message in read_static_fields(static_file, area, packing):
+            fout.write(message)
+
+    if required_fields is None:
+        return []
+
+    entries.extend(get_grib_entries(nhsf_file))
+    entries.extend(get_grib_entries(static_file))
+    return get_missing_fields(entries, required_fields)
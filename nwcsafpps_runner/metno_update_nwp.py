@@ -28,11 +28,28 @@ import tempfile
 from glob import glob
 import os
 from datetime import datetime
-import numpy as np
+from functools import partial
+from heapq import merge
+from operator import itemgetter
+from multiprocessing import Pool
 import eccodes as ecc
 
+from nwcsafpps_runner.grib_utils import get_crop_area
+from nwcsafpps_runner.grib_utils import get_packing
+from nwcsafpps_runner.grib_utils import read_grib_headers
+from nwcsafpps_runner.grib_utils import read_static_fields
+from nwcsafpps_runner.nwp_lock import NwpLockTimeout, NwpOutputLock, get_hidden_filename
+from nwcsafpps_runner.nwp_service import get_scene_lead_times
+from nwcsafpps_runner.grib_utils import write_grib_message
+
 LOG = logging.getLogger(__name__)
 
+#: The area the fields are cropped to if no nwp_crop_area is configured: the northern hemisphere
+METNO_CROP_AREA = (90., -180., 0., 180.)
+
+#: The paramIds of the fields needed by PPS, if no nwp_parameters are configured
+METNO_PARAMETERS = [172, 129, 235, 167, 168, 137, 130, 131, 132, 133, 134, 157]
+
 
 class WrongLengthError:
     pass
@@ -42,42 +59,87 @@ class NoOptionError:
     pass
 
 
-def product(*args, **kwds):
-    # product('ABCD', 'xy') --> Ax Ay Bx By Cx Cy Dx Dy
-    # product(range(2), repeat=3) --> 000 001 010 011 100 101 110 111
-    pools = list(map(tuple, args)) * kwds.get('repeat', 1)
-    result = [[]]
-    for pool in pools:
-        result = [x + [y] for x in result for y in pool]
-    for prod in result:
-        yield tuple(prod)
-
-
-def copy_needed_field(gid, fout):
-    """Copy the needed field"""
-
-    nx = ecc.codes_get(gid, 'Ni')
-    ny = ecc.codes_get(gid, 'Nj')
-    first_lat = ecc.codes_get(gid, 'latitudeOfFirstGridPointInDegrees')
-    north_south_step = ecc.codes_get(gid, 'jDirectionIncrementInDegrees')
-
-    filter_north = 0
-    new_ny = int((first_lat - filter_north)/north_south_step) + 1
-
-    values = ecc.codes_get_values(gid)
-    values_r = np.reshape(values, (ny, nx))
-
-    new_values = values_r[:new_ny, :]
-
-    clone_id = ecc.codes_clone(gid)
-
-    ecc.codes_set(clone_id, 'latitudeOfLastGridPointInDegrees', (filter_north))
-    ecc.codes_set(clone_id, 'Nj', new_ny)
+def get_parameters(options):
+    """Get the paramIds of the fields needed by PPS from the config *options*."""
+    parameters = options.get('nwp_parameters')
+    if parameters is None:
+        return set(METNO_PARAMETERS)
+    if isinstance(parameters, str):
+        parameters = parameters.split(',')
+    return set(int(param) for param in parameters)
+
+
+def get_needed_fields(filenames, parameters):
+    """Get the GRIB messages of the *parameters* in the files *filenames*.
+
+    Each file is read once, and only the headers of the messages. Return a
+    list of (paramId, level, filename, offset) tuples, sorted on paramId and
+    level, and then on the order of the files and messages.
+    """
+    fields = []
+    for file_number, filename in enumerate(filenames):
+        for offset, _, (param, level) in read_grib_headers(filename, ('paramId', 'level')):
+            if param in parameters:
+                fields.append((param, level, file_number, offset))
+    fields.sort()
+    return [(param, level, filenames[file_number], offset) for param, level, file_number, offset in fields]
+
+
+def get_static_filename(options):
+    """Get the name of the file with the static fields from the config *options*."""
+    static_filename = options['ecmwf_static_surface']
+    if not os.path.exists(static_filename):
+        static_filename = static_filename.replace("storeB", "storeA")
+        LOG.warning("Need to replace storeB with storeA")
+    return static_filename
+
+
+def get_static_fields(options, parameters, area=METNO_CROP_AREA, packing=None):
+    """Get the needed static fields, cropped to the *area* and with the *packing*.
+
+    The static fields are read from file once, and kept in memory, encoded
+    and cropped, until the file is modified (see
+    :func:`nwcsafpps_runner.grib_utils.read_static_fields`). Return a list of
+    (paramId, level, filename, message) tuples sorted on paramId and level,
+    where message is the encoded GRIB message.
+    """
+    static_filename = get_static_filename(options)
+    fields = [(param, level, static_filename, message)
+              for param, level, message in read_static_fields(static_filename, area, packing) if param in parameters]
+    return sorted(fields, key=itemgetter(0, 1))
+
+
+def write_needed_fields(fields, fout, area=METNO_CROP_AREA, packing=None):
+    """Write the needed *fields*, cropped to the *area* and with the *packing*, to the open file *fout*.
+
+    The *fields* are (paramId, level, filename, offset) tuples, or, for
+    static fields already cropped and encoded, (paramId, level, filename,
+    message) tuples.
+    """
+    infiles = {}
+    try:
+        for param, level, filename, offset in fields:
+            LOG.debug("Doing param: %d level: %s", param, str(level))
+            if isinstance(offset, bytes):
+                fout.write(offset)
+                continue
+            if filename not in infiles:
+                infiles[filename] = open(filename, 'rb')
+            fin = infiles[filename]
+            fin.seek(offset)
+            gid = ecc.codes_grib_new_from_file(fin)
+            try:
+                copy_needed_field(gid, fout, area, packing)
+            finally:
+                ecc.codes_release(gid)
+    finally:
+        for fin in infiles.values():
+            fin.close()
 
-    ecc.codes_set_values(clone_id, new_values.flatten())
 
-    ecc.codes_write(clone_id, fout)
-    ecc.codes_release(clone_id)
+def copy_needed_field(gid, fout, area=METNO_CROP_AREA, packing=None):
+    """Copy the needed field, cropped to the *area* and with the *packing*"""
+    write_grib_message(gid, fout, area, packing)
 
 
 def update_nwp(params):
@@ -97,166 +159,140 @@ def update_nwp(params):
                  str(os.path.join(ecmwf_path,  params['options']['ecmwf_prefix'] + "*")))
         return
 
-    from trollsift import Parser, compose
     filelist.sort()
-    for filename in filelist:
-        if params['options']['ecmwf_file_name_sift'] is not None:
-            try:
-                parser = Parser(params['options']['ecmwf_file_name_sift'])
-            except NoOptionError as noe:
-                LOG.error("NoOptionError {}".format(noe))
-                continue
-            if not parser.validate(os.path.basename(filename)):
-                LOG.error("Parser validate on filename: {} failed.".format(filename))
-                continue
-            res = parser.parse("{}".format(os.path.basename(filename)))
-
-            time_now = datetime.utcnow()
-            if 'analysis_time' in res:
-                if res['analysis_time'].year == 1900:
-                    # This is tricky. Filename is missing year in name
-                    # Need to guess the year from a compination of year now
-                    # and month now and month of the analysis time taken from the filename
-                    # If the month now is 1(January) and the analysis month is 12,
-                    # then the time has passed New Year, but the NWP analysis time is previous year.
-                    if time_now.month == 1 and res['analysis_time'].month == 12:
-                        analysis_year = time_now.year-1
-                    else:
-                        analysis_year = time_now.year
-
-                    res['analysis_time'] = res['analysis_time'].replace(year=analysis_year)
-            else:
-                LOG.error("Can not parse analysis_time in file name. Check config and filename timestamp")
-
-            if 'forecast_time' in res:
-                if res['forecast_time'].year == 1900:
-                    # See above for explanation
-                    if res['analysis_time'].month == 12 and res['forecast_time'].month == 1:
-                        forecast_year = res['analysis_time'].year+1
-                    else:
-                        forecast_year = res['analysis_time'].year
-
-                    res['forecast_time'] = res['forecast_time'].replace(year=forecast_year)
-            else:
-                LOG.error("Can not parse forecast_time in file name. Check config and filename timestamp")
-
-            forecast_time = res['forecast_time']
-            analysis_time = res['analysis_time']
-            step_delta = forecast_time - analysis_time
-            step = "{:03d}H{:02d}M".format(int(step_delta.days*24 + step_delta.seconds/3600), 0)
-        else:
-            LOG.error("Not sift pattern given. Can not parse input NWP files")
+    nworkers = int(params['options'].get('nwp_prepare_workers', 1))
+    LOG.info("Prepare NWP files using %d worker(s)", nworkers)
+    if nworkers > 1 and len(filelist) > 1:
+        # Read the static fields before starting the workers, which then inherit them
+        get_static_fields(params['options'], get_parameters(params['options']),
+                          get_crop_area(params['options'].get('nwp_crop_area')) or METNO_CROP_AREA,
+                          get_packing(params['options'].get('nwp_packing')))
+        with Pool(min(nworkers, len(filelist))) as pool:
+            pool.map(partial(prepare_nwp_file, params=params), filelist)
+    else:
+        for filename in filelist:
+            prepare_nwp_file(filename, params)
+    return
 
-        if analysis_time < params['starttime']:
-            # LOG.debug("skip analysis time {} older than search time {}".format(analysis_time, params['starttime']))
-            continue
 
-        if int(step[:3]) not in params['nlengths']:
-            # LOG.debug("Skip step {}, not in {}".format(int(step[:3]), params['nlengths']))
-            continue
+def prepare_nwp_file(filename, params):
+    """Prepare the NWP file for PPS from one ECMWF input file.
 
-        output_parameters = {}
-        output_parameters['analysis_time'] = analysis_time
-        output_parameters['step_hour'] = int(step_delta.days*24 + step_delta.seconds/3600)
-        output_parameters['step_min'] = 0
-        try:
-            if not os.path.exists(params['options']['nwp_outdir']):
-                os.makedirs(params['options']['nwp_outdir'])
-        except OSError as e:
-            LOG.error("Failed to create directory: %s", e)
-        result_file = ""
+    The output is written to a hidden file and renamed into place when ready,
+    under the lock shared by all processes preparing NWP files (see
+    :mod:`nwcsafpps_runner.nwp_lock`).
+    """
+    from trollsift import Parser, compose
+    if params['options']['ecmwf_file_name_sift'] is not None:
         try:
-            result_file = os.path.join(params['options']['nwp_outdir'], compose(
-                params['options']['nwp_output'], output_parameters))
-            _result_file = os.path.join(params['options']['nwp_outdir'], compose(
-                "."+params['options']['nwp_output'], output_parameters))
-            _result_file_lock = os.path.join(params['options']['nwp_outdir'], compose(
-                "."+params['options']['nwp_output']+".lock", output_parameters))
-        except Exception as e:
-            LOG.error("Joining outdir with output for nwp failed with: {}".format(e))
-
-        LOG.info("Result file: {}".format(result_file))
-        if os.path.exists(result_file):
-            LOG.info("File: " + str(result_file) + " already there...")
-            continue
-
-        import fcntl
-        import errno
-        import time
-        rfl = open(_result_file_lock, 'w+')
-        # do some locking
-        while True:
-            try:
-                fcntl.flock(rfl, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                LOG.debug("1Got lock for NWP outfile: {}".format(result_file))
-                break
-            except IOError as e:
-                if e.errno != errno.EAGAIN:
-                    raise
+            parser = Parser(params['options']['ecmwf_file_name_sift'])
+        except NoOptionError as noe:
+            LOG.error("NoOptionError {}".format(noe))
+            return
+        if not parser.validate(os.path.basename(filename)):
+            LOG.error("Parser validate on filename: {} failed.".format(filename))
+            return
+        res = parser.parse("{}".format(os.path.basename(filename)))
+
+        time_now = datetime.utcnow()
+        if 'analysis_time' in res:
+            if res['analysis_time'].year == 1900:
+                # This is tricky. Filename is missing year in name
+                # Need to guess the year from a compination of year now
+                # and month now and month of the analysis time taken from the filename
+                # If the month now is 1(January) and the analysis month is 12,
+                # then the time has passed New Year, but the NWP analysis time is previous year.
+                if time_now.month == 1 and res['analysis_time'].month == 12:
+                    analysis_year = time_now.year-1
                 else:
-                    LOG.debug("Waiting for lock ... {}".format(result_file))
-                    time.sleep(1)
+                    analysis_year = time_now.year
 
-        if os.path.exists(result_file):
-            LOG.info("File: " + str(result_file) + " already there...")
-            # Need to release the lock
-            fcntl.flock(rfl, fcntl.LOCK_UN)
-            rfl.close()
-            continue
+                res['analysis_time'] = res['analysis_time'].replace(year=analysis_year)
+        else:
+            LOG.error("Can not parse analysis_time in file name. Check config and filename timestamp")
 
-        fout = open(_result_file, 'wb')
+        if 'forecast_time' in res:
+            if res['forecast_time'].year == 1900:
+                # See above for explanation
+                if res['analysis_time'].month == 12 and res['forecast_time'].month == 1:
+                    forecast_year = res['analysis_time'].year+1
+                else:
+                    forecast_year = res['analysis_time'].year
+
+                res['forecast_time'] = res['forecast_time'].replace(year=forecast_year)
+        else:
+            LOG.error("Can not parse forecast_time in file name. Check config and filename timestamp")
+
+        forecast_time = res['forecast_time']
+        analysis_time = res['analysis_time']
+        step_delta = forecast_time - analysis_time
+        step = "{:03d}H{:02d}M".format(int(step_delta.days*24 + step_delta.seconds/3600), 0)
+    else:
+        LOG.error("Not sift pattern given. Can not parse input NWP files")
+
+    if analysis_time < params['starttime']:
+        # LOG.debug("skip analysis time {} older than search time {}".format(analysis_time, params['starttime']))
+        return
+
+    if int(step[:3]) not in params['nlengths']:
+        # LOG.debug("Skip step {}, not in {}".format(int(step[:3]), params['nlengths']))
+        return
+
+    if params.get('scene_window') is not None and int(step[:3]) not in get_scene_lead_times(
+            analysis_time, params['nlengths'], params['scene_window']):
+        return
+
+    output_parameters = {}
+    output_parameters['analysis_time'] = analysis_time
+    output_parameters['step_hour'] = int(step_delta.days*24 + step_delta.seconds/3600)
+    output_parameters['step_min'] = 0
+    try:
+        if not os.path.exists(params['options']['nwp_outdir']):
+            os.makedirs(params['options']['nwp_outdir'])
+    except OSError as e:
+        LOG.error("Failed to create directory: %s", e)
+    result_file = ""
+    try:
+        result_file = os.path.join(params['options']['nwp_outdir'], compose(
+            params['options']['nwp_output'], output_parameters))
+        _result_file = get_hidden_filename(result_file)
+    except Exception as e:
+        LOG.error("Joining outdir with output for nwp failed with: {}".format(e))
+
+    LOG.info("Result file: {}".format(result_file))
+    if os.path.exists(result_file):
+        LOG.info("File: " + str(result_file) + " already there...")
+        return
+
+    timeout = float(params['options'].get('nwp_lock_timeout_minutes', 30)) * 60
+    try:
+        with NwpOutputLock(result_file, timeout=timeout) as producer:
+            if not producer:
+                LOG.info("File: " + str(result_file) + " already there...")
+                return
+            write_nwp_file(filename, _result_file, params)
+            os.rename(_result_file, result_file)
+    except NwpLockTimeout:
+        LOG.exception("Failed getting the NWP file %s", result_file)
+    return
+
+
+def write_nwp_file(filename, outfile, params):
+    """Write the NWP file for PPS from the ECMWF input file *filename* to *outfile*."""
+    with open(outfile, 'wb') as fout:
         try:
+            area = get_crop_area(params['options'].get('nwp_crop_area')) or METNO_CROP_AREA
+            packing = get_packing(params['options'].get('nwp_packing'))
+            parameters = get_parameters(params['options'])
+            filename_n1s = filename.replace('N2D', 'N1S')
+            LOG.debug("Handeling files: %s %s", filename, filename_n1s)
+            fields = get_needed_fields([filename, filename_n1s], parameters)
 
             # Do the static fields
             # Note: field not in the filename variable, but a configured filename for static fields
-            static_filename = params['options']['ecmwf_static_surface']
-            if not os.path.exists(static_filename):
-                static_filename = static_filename.replace("storeB", "storeA")
-                LOG.warning("Need to replace storeB with storeA")
-
-            index_vals = []
-            index_keys = ['paramId', 'level']
-            LOG.debug("Start building index")
-            LOG.debug("Handeling file: %s", filename)
-            iid = ecc.codes_index_new_from_file(filename, index_keys)
-            filename_n1s = filename.replace('N2D', 'N1S')
-            LOG.debug("Add to index %s", filename_n1s)
-            ecc.codes_index_add_file(iid, filename_n1s)
-            LOG.debug("Add to index %s", static_filename)
-            ecc.codes_index_add_file(iid, static_filename)
-            LOG.debug("Done index")
-            for key in index_keys:
-                key_vals = ecc.codes_index_get(iid, key)
-                key_vals = tuple(x for x in key_vals if x != 'undef')
-                index_vals.append(key_vals)
-
-            for prod in product(*index_vals):
-                for i in range(len(index_keys)):
-                    ecc.codes_index_select(iid, index_keys[i], prod[i])
-
-                while 1:
-                    gid = ecc.codes_new_from_index(iid)
-                    if gid is None:
-                        break
-
-                    param = ecc.codes_get(gid, index_keys[0])
-                    parameters = [172, 129, 235, 167, 168, 137, 130, 131, 132, 133, 134, 157]
-                    if param in parameters:
-                        LOG.debug("Doing param: %d", param)
-                        copy_needed_field(gid, fout)
-
-                    ecc.codes_release(gid)
-            ecc.codes_index_release(iid)
-
-            fout.close()
-            os.rename(_result_file, result_file)
+            static_fields = get_static_fields(params['options'], parameters, area, packing)
+            write_needed_fields(merge(fields, static_fields, key=itemgetter(0, 1)), fout, area, packing)
 
         except WrongLengthError as wle:
             LOG.error("Something wrong with the data: %s", wle)
             raise
-
-        # In the end release the lock
-        fcntl.flock(rfl, fcntl.LOCK_UN)
-        rfl.close()
-        os.remove(_result_file_lock)
-    return
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarking the NWP preparation on synthetic GRIB files.
+
+Synthetic nhsp, nhsf and static GRIB files of realistic size are built from
+the eccodes samples, so no NWP data or network access is needed. Every stage
+of the NWP preparation is timed on them: the header scan selecting the
+fields (filter), the assembly of the NWP file (merge), the check of its
+content (validate), the rename into place (rename) and the metno copy of the
+needed fields (metno_copy). The rename moves no data, so it is reported as
+the latency of the operation, and left out of the comparison. The results are
+appended to a file of JSON lines, one per run, so the throughput of different
+versions can be compared.
+"""
+
+import json
+import logging
+import os
+import platform
+import socket
+import time
+from datetime import datetime
+
+import eccodes as ecc
+import numpy as np
+
+from nwcsafpps_runner.grib_utils import (ENTRY_KEYS, assemble_nwp_file, clear_caches,
+                                         get_grib_entries, get_missing_fields, read_grib_headers)
+from nwcsafpps_runner.metno_update_nwp import get_needed_fields, write_needed_fields
+
+LOG = logging.getLogger(__name__)
+
+#: The stages of the NWP preparation timed, in order
+STAGES = ('filter', 'merge', 'validate', 'rename', 'metno_copy')
+
+#: The stages timing file system operations rather than the data handled, reported as latencies
+OPERATION_STAGES = ('rename', )
+
+#: Pressure levels of the upper air fields in the synthetic nhsp file
+NHSP_LEVELS = [1000, 950, 925, 900, 850, 800, 700, 600, 500, 400, 300, 250, 200, 150, 100, 70, 50]
+
+#: paramIds of the upper air fields in the synthetic nhsp file: t, u, v, q and z
+NHSP_PARAMETERS = [130, 131, 132, 133, 129]
+
+#: paramIds of the surface fields in the synthetic nhsf file
+NHSF_PARAMETERS = [134, 151, 164, 167, 168, 235, 137, 31, 34, 228]
+
+#: paramIds of the static fields: land-sea mask and surface geopotential
+STATIC_PARAMETERS = [172, 129]
+
+#: Number of extra reduced gaussian fields in the nhsp file, to be filtered out
+NHSP_REDUCED_FIELDS = 5
+
+#: Stages faster than this, in seconds, are too noisy to be compared between runs
+MIN_COMPARED_SECONDS = 0.01
+
+
+class BenchmarkSetup(object):
+    """The size of the synthetic NWP input files.
+
+    The fields cover the northern hemisphere with a grid spacing of
+    *resolution* degrees. The nhsp file holds every field of
+    :data:`NHSP_PARAMETERS` on the first *nlevels* of :data:`NHSP_LEVELS`.
+    The prepared file is cropped to the *area* (north, west, south, east)
+    and packed with the *packing* if given (see
+    :func:`nwcsafpps_runner.grib_utils.assemble_nwp_file`).
+    """
+
+    def __init__(self, resolution=0.25, nlevels=len(NHSP_LEVELS), area=None, packing=None):
+        self.resolution = resolution
+        self.nlevels = nlevels
+        self.area = None if area is None else tuple(area)
+        self.packing = packing
+
+    @property
+    def shape(self):
+        """Get the (Nj, Ni) shape of the fields."""
+        return int(round(90. / self.resolution)) + 1, int(round(360. / self.resolution))
+
+    def as_dict(self):
+        """Get the setup as a dict, stored with the results."""
+        packing = None
+        if self.packing is not None:
+            packing = sorted(["%s:%s:%s" % (param or 'default', packing_type, bits)
+                              for param, (packing_type, bits) in self.packing.items()])
+        return {'resolution': self.resolution,
+                'nlevels': self.nlevels,
+                'area': None if self.area is None else list(self.area),
+                'packing': packing}
+
+
+def make_synthetic_field(shape, param, level, rng):
+    """Make a smooth field with some noise, which packs like real NWP data."""
+    nrows, ncols = shape
+    lats = np.linspace(np.pi / 2, 0, nrows)[:, np.newaxis]
+    lons = np.linspace(0, 2 * np.pi, ncols, endpoint=False)[np.newaxis, :]
+    field = np.cos(lats * (1 + param % 5)) * np.sin(lons * (1 + level % 7)) * 10.
+    return (field + rng.normal(scale=0.5, size=shape) + param % 300).ravel()
+
+
+def write_synthetic_grib(filename, fields, shape, rng=None):
+    """Write a regular lat-lon GRIB file with the (paramId, typeOfLevel, level) *fields*.
+
+    The fields are created from the eccodes samples and cover the northern
+    hemisphere with the *shape* (Nj, Ni). Return the number of messages
+    written.
+    """
+    if rng is None:
+        rng = np.random.default_rng(0)
+    nrows, ncols = shape
+    with open(filename, 'wb') as fout:
+        for param, type_of_level, level in fields:
+            sample = 'regular_ll_pl_grib2' if type_of_level == 'isobaricInhPa' else 'regular_ll_sfc_grib2'
+            gid = ecc.codes_grib_new_from_samples(sample)
+            try:
+                ecc.codes_set_long(gid, 'Ni', ncols)
+                ecc.codes_set_long(gid, 'Nj', nrows)
+                ecc.codes_set(gid, 'latitudeOfFirstGridPointInDegrees', 90.)
+                ecc.codes_set(gid, 'latitudeOfLastGridPointInDegrees', 0.)
+                ecc.codes_set(gid, 'longitudeOfFirstGridPointInDegrees', 0.)
+                ecc.codes_set(gid, 'longitudeOfLastGridPointInDegrees', 360. - 360. / ncols)
+                ecc.codes_set(gid, 'iDirectionIncrementInDegrees', 360. / ncols)
+                ecc.codes_set(gid, 'jDirectionIncrementInDegrees', 90. / (nrows - 1))
+                ecc.codes_set(gid, 'paramId', param)
+                ecc.codes_set(gid, 'typeOfLevel', type_of_level)
+                ecc.codes_set(gid, 'level', level)
+                ecc.codes_set_long(gid, 'bitsPerValue', 16)
+                ecc.codes_set_values(gid, make_synthetic_field(shape, param, level, rng))
+                ecc.codes_write(gid, fout)
+            finally:
+                ecc.codes_release(gid)
+    return len(fields)
+
+
+def write_reduced_fields(filename, nfields):
+    """Append *nfields* reduced gaussian fields to the GRIB file *filename*."""
+    with open(filename, 'ab') as fout:
+        for _ in range(nfields):
+            gid = ecc.codes_grib_new_from_samples('reduced_gg_pl_320_grib2')
+            try:
+                ecc.codes_set(gid, 'paramId', 130)
+                ecc.codes_write(gid, fout)
+            finally:
+                ecc.codes_release(gid)
+
+
+def make_benchmark_files(workdir, setup):
+    """Write the synthetic nhsp, nhsf and static files to *workdir*.
+
+    Return the filenames of the nhsp, nhsf and static files.
+    """
+    rng = np.random.default_rng(0)
+    nhsp_file = os.path.join(workdir, 'NHSP_benchmark')
+    nhsf_file = os.path.join(workdir, 'NHSF_benchmark')
+    static_file = os.path.join(workdir, 'static_benchmark')
+    write_synthetic_grib(nhsp_file, [(param, 'isobaricInhPa', level) for level in NHSP_LEVELS[:setup.nlevels]
+                                     for param in NHSP_PARAMETERS], setup.shape, rng)
+    write_reduced_fields(nhsp_file, NHSP_REDUCED_FIELDS)
+    write_synthetic_grib(nhsf_file, [(param, 'surface', 0) for param in NHSF_PARAMETERS], setup.shape, rng)
+    write_synthetic_grib(static_file, [(param, 'surface', 0) for param in STATIC_PARAMETERS], setup.shape, rng)
+    return nhsp_file, nhsf_file, static_file
+
+
+def get_throughput(seconds, nbytes, nmessages):
+    """Get the stage statistics, with the throughput in MB/s and messages/s."""
+    seconds = max(seconds, 1e-9)
+    return {'seconds': seconds,
+            'bytes': nbytes,
+            'messages': nmessages,
+            'mb_per_s': nbytes / 1e6 / seconds,
+            'messages_per_s': nmessages / seconds}
+
+
+def get_latency(seconds, noperations):
+    """Get the statistics of a stage of *noperations* file system operations, with their latency and rate."""
+    seconds = max(seconds, 1e-9)
+    return {'seconds': seconds,
+            'operations': noperations,
+            'latency_ms': seconds / noperations * 1e3,
+            'operations_per_s': noperations / seconds}
+
+
+def time_stage(func, repeat):
+    """Run *func* *repeat* times, from cold caches, and return the fastest time and the last result."""
+    best = None
+    for _ in range(repeat):
+        clear_caches()
+        _start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - _start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_benchmark(workdir, setup=None, repeat=3):
+    """Time each stage of the NWP preparation on synthetic files written to *workdir*.
+
+    Return a dict with the statistics of each stage (see :func:`get_throughput`,
+    and :func:`get_latency` for the :data:`OPERATION_STAGES`).
+    """
+    if setup is None:
+        setup = BenchmarkSetup()
+    _start = time.time()
+    nhsp_file, nhsf_file, static_file = make_benchmark_files(workdir, setup)
+    LOG.info("Wrote the synthetic input files in %f seconds", time.time() - _start)
+    input_files = (nhsp_file, nhsf_file, static_file)
+    input_bytes = sum(os.path.getsize(filename) for filename in input_files)
+    outfile = os.path.join(workdir, 'tmp_benchmark')
+    result_file = os.path.join(workdir, 'PPS_ECMWF_benchmark')
+    stages = {}
+
+    def filter_fields():
+        return sum(len(read_grib_headers(filename, ENTRY_KEYS + ('gridType', ))) for filename in input_files)
+
+    seconds, nmessages = time_stage(filter_fields, repeat)
+    stages['filter'] = get_throughput(seconds, input_bytes, nmessages)
+
+    def merge():
+        return assemble_nwp_file(outfile, nhsp_file, nhsf_file, static_file, grid_type='regular_ll',
+                                 area=setup.area, packing=setup.packing)
+
+    seconds, _ = time_stage(merge, repeat)
+    required_fields = get_grib_entries(outfile)
+    output_bytes = os.path.getsize(outfile)
+    stages['merge'] = get_throughput(seconds, output_bytes, len(required_fields))
+
+    def validate():
+        return get_missing_fields(get_grib_entries(outfile), required_fields)
+
+    seconds, missing_fields = time_stage(validate, repeat)
+    if missing_fields:
+        raise AssertionError("Fields missing in the assembled benchmark file: %s" % str(missing_fields))
+    stages['validate'] = get_throughput(seconds, output_bytes, len(required_fields))
+
+    def rename():
+        os.rename(outfile, result_file)
+        os.rename(result_file, outfile)
+
+    seconds, _ = time_stage(rename, repeat)
+    stages['rename'] = get_latency(seconds, 2)
+
+    def metno_copy():
+        fields = get_needed_fields([nhsp_file, nhsf_file], set(NHSP_PARAMETERS + NHSF_PARAMETERS))
+        with open(outfile, 'wb') as fout:
+            write_needed_fields(fields, fout, setup.area, setup.packing)
+        return len(fields)
+
+    seconds, nmessages = time_stage(metno_copy, repeat)
+    stages['metno_copy'] = get_throughput(seconds, os.path.getsize(outfile), nmessages)
+
+    for filename in input_files + (outfile, ):
+        os.remove(filename)
+    return stages
+
+
+def get_version():
+    """Get the version of the installed nwcsafpps_runner, or 'unknown'."""
+    import nwcsafpps_runner
+    return getattr(nwcsafpps_runner, '__version__', 'unknown')
+
+
+def make_record(stages, setup):
+    """Make the record of one benchmark run to be stored."""
+    return {'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+            'version': get_version(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'eccodes': ecc.codes_get_api_version(),
+            'setup': setup.as_dict(),
+            'stages': stages}
+
+
+def read_results(filename):
+    """Read the benchmark records stored in *filename*, oldest first."""
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as fpt:
+        return [json.loads(line) for line in fpt if line.strip()]
+
+
+def store_result(filename, record):
+    """Append the benchmark *record* to the results *filename*."""
+    with open(filename, 'a') as fpt:
+        fpt.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def find_regressions(previous, record, tolerance=0.2):
+    """Compare the benchmark *record* with the latest *previous* one run with the same setup and host.
+
+    Return a list of (stage, previous MB/s, current MB/s) for the stages
+    whose throughput dropped by more than the *tolerance* fraction. Stages
+    faster than :data:`MIN_COMPARED_SECONDS` in both runs, and the
+    :data:`OPERATION_STAGES`, are not compared.
+    """
+    reference = None
+    for candidate in previous:
+        if candidate['setup'] == record['setup'] and candidate['host'] == record['host']:
+            reference = candidate
+    if reference is None:
+        return []
+
+    regressions = []
+    for stage, stats in record['stages'].items():
+        if stage in OPERATION_STAGES or stage not in reference['stages']:
+            continue
+        if max(stats['seconds'], reference['stages'][stage]['seconds']) < MIN_COMPARED_SECONDS:
+            continue
+        before = reference['stages'][stage]['mb_per_s']
+        if stats['mb_per_s'] < before * (1 - tolerance):
+            regressions.append((stage, before, stats['mb_per_s']))
+    return regressions
+
+
+def format_record(record):
+    """Format the stage statistics of the benchmark *record* as a table."""
+    lines = ["nwcsafpps_runner %s, eccodes %s, setup %s" % (record['version'], record['eccodes'],
+                                                            json.dumps(record['setup'], sort_keys=True)),
+             "%-12s %10s %10s %10s %12s" % ('stage', 'seconds', 'MB', 'MB/s', 'messages/s')]
+    for stage in STAGES:
+        stats = record['stages'][stage]
+        if stage in OPERATION_STAGES:
+            lines.append("%-12s %10.4f %10s %10s %12s   %.3f ms per operation" %
+                         (stage, stats['seconds'], '-', '-', '-', stats['latency_ms']))
+            continue
+        lines.append("%-12s %10.4f %10.1f %10.1f %12.1f" % (stage, stats['seconds'], stats['bytes'] / 1e6,
+                                                            stats['mb_per_s'], stats['messages_per_s']))
+    return '\n'.join(lines)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A persistent ledger of the NWP input files handled by the NWP preparation.
+
+The ledger keeps, for every NWP input file, the analysis time and forecast
+step parsed from the filename and whether the corresponding PPS NWP file has
+been prepared. An input file is identified by its path, size and
+modification time, so only new or changed files need to be parsed again.
+"""
+
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+LOG = logging.getLogger(__name__)
+
+LEDGER_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class NwpLedger(object):
+    """The ledger of NWP input files, stored in an SQLite database file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.con = sqlite3.connect(filename, timeout=60)
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS inputs ("
+                             "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                             "analysis_time TEXT, forecast_step INTEGER, timeinfo TEXT, "
+                             "prepared INTEGER DEFAULT 0)")
+            self.con.execute("CREATE INDEX IF NOT EXISTS pending ON inputs (prepared, analysis_time)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the ledger database."""
+        self.con.close()
+
+    def update(self, filelist, parse_func, starttime=None):
+        """Update the ledger with the input files in *filelist*.
+
+        The files not seen before, or changed since last seen, are parsed
+        with *parse_func*, which should return the analysis time, forecast
+        step and time info of the file, or None if the file should never be
+        prepared. If a *starttime* is given, the known files with older
+        analysis times are not looked at again. Files no longer in *filelist*
+        are removed from the ledger. Return the number of files parsed.
+        """
+        known = set(path for path, in self.con.execute("SELECT path FROM inputs"))
+        if starttime is None:
+            rows = self.con.execute("SELECT path, size, mtime FROM inputs WHERE analysis_time IS NOT NULL")
+        else:
+            rows = self.con.execute("SELECT path, size, mtime FROM inputs WHERE analysis_time >= ?",
+                                    (starttime.strftime(LEDGER_TIME_FORMAT), ))
+        in_window = dict(((path, (size, mtime)) for path, size, mtime in rows))
+        updates = []
+        for filename in filelist:
+            # Known files out of the window, or never to be prepared, need no stat
+            if filename in known and filename not in in_window:
+                continue
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if in_window.get(filename) == (stat.st_size, stat.st_mtime):
+                continue
+            nhsf_info = parse_func(filename)
+            if nhsf_info is None:
+                updates.append((filename, stat.st_size, stat.st_mtime, None, None, None))
+            else:
+                analysis_time, forecast_step, timeinfo = nhsf_info
+                updates.append((filename, stat.st_size, stat.st_mtime,
+                                analysis_time.strftime(LEDGER_TIME_FORMAT), forecast_step, timeinfo))
+
+        gone = known.difference(filelist)
+        with self.con:
+            self.con.executemany("INSERT OR REPLACE INTO inputs (path, size, mtime, analysis_time, "
+                                 "forecast_step, timeinfo, prepared) VALUES (?, ?, ?, ?, ?, ?, 0)", updates)
+            self.con.executemany("DELETE FROM inputs WHERE path = ?", ((path, ) for path in gone))
+
+        LOG.debug("NWP ledger: %d new or changed input files, %d removed", len(updates), len(gone))
+        return len(updates)
+
+    def get_pending(self, starttime, nlengths, result_func=None):
+        """Get the input files not yet prepared, with analysis times newer than *starttime*.
+
+        Only the forecast steps in *nlengths* are considered. If *result_func*
+        is given, it should return the name of the prepared file from the
+        analysis time and forecast step, and the files prepared but whose
+        result is gone since (cleaned up, or removed by hand) are pending
+        again. Return a list of (filename, (analysis_time, forecast_step,
+        timeinfo)) tuples.
+        """
+        if result_func is None:
+            query = ("SELECT path, analysis_time, forecast_step, timeinfo, prepared FROM inputs "
+                     "WHERE prepared = 0 AND analysis_time >= ? ORDER BY path")
+        else:
+            query = ("SELECT path, analysis_time, forecast_step, timeinfo, prepared FROM inputs "
+                     "WHERE analysis_time >= ? ORDER BY path")
+        pending = []
+        for path, analysis_time, forecast_step, timeinfo, prepared in self.con.execute(
+                query, (starttime.strftime(LEDGER_TIME_FORMAT), )):
+            if forecast_step not in nlengths:
+                continue
+            analysis_time = datetime.strptime(analysis_time, LEDGER_TIME_FORMAT)
+            if prepared and os.path.exists(result_func(analysis_time, forecast_step)):
+                continue
+            pending.append((path, (analysis_time, forecast_step, timeinfo)))
+        return pending
+
+    def set_prepared(self, filename):
+        """Mark the input *filename* as prepared."""
+        with self.con:
+            self.con.execute("UPDATE inputs SET prepared = 1 WHERE path = ?", (filename, ))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Locking the prepared NWP files, shared by all processes writing to the NWP output directory.
+
+Every prepared NWP file has a hidden lock file next to it. The one process
+getting the exclusive lock on it produces the file: it writes a temporary
+file, renames it into place, removes the lock file and releases the lock.
+All other processes wanting the same file block on a shared lock, and are
+woken up as soon as the lock is released. When waiting with a timeout, they
+block on inotify events of the NWP output directory instead, and are woken
+up as soon as the file is renamed into place or the lock file removed,
+checking the lock itself now and then in case its holder died. They then
+find the file in place, or, if the producer failed, try to produce it
+themselves. Without inotify, the lock is polled with a backoff.
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import functools
+import logging
+import os
+import select
+import time
+
+from nwcsafpps_runner.utils import NwpPrepareError
+
+LOG = logging.getLogger(__name__)
+
+#: Suffix of the lock files, which are named after the hidden file they lock
+LOCK_SUFFIX = '.lock'
+
+#: Suffix of the hidden name in the temporary files a prepared NWP file is written to, before their random part
+TEMP_SUFFIX = '.tmp'
+
+#: Bounds of the interval in seconds between the polls of a lock waited for with a timeout, without inotify
+MIN_POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 1.0
+
+#: Seconds between the checks of a lock waited for on inotify events, in case its holder died
+LOCK_CHECK_INTERVAL = 5.0
+
+#: The inotify events of a file renamed into, written to, or removed from the NWP output directory
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+
+
+class NwpLockTimeout(NwpPrepareError):
+    pass
+
+
+def get_hidden_filename(result_file):
+    """Get the name of the hidden file the prepared NWP *result_file* is written to before renamed into place."""
+    dirname, basename = os.path.split(result_file)
+    return os.path.join(dirname, '.' + basename)
+
+
+def get_lock_filename(result_file):
+    """Get the name of the lock file of the prepared NWP *result_file*."""
+    return get_hidden_filename(result_file) + LOCK_SUFFIX
+
+
+def get_temp_prefix(result_file):
+    """Get the prefix of the temporary files the prepared NWP *result_file* is written to."""
+    return os.path.basename(get_hidden_filename(result_file)) + TEMP_SUFFIX
+
+
+def get_result_basename(basename):
+    """Get the name of the prepared NWP file the hidden, lock or temporary file *basename* is for.
+
+    Return None if *basename* is none of those.
+    """
+    if not basename.startswith('.'):
+        return None
+    name = basename[1:]
+    if name.endswith(LOCK_SUFFIX):
+        return name[:-len(LOCK_SUFFIX)]
+    head, sep, _ = name.rpartition(TEMP_SUFFIX)
+    return head if sep else name
+
+
+class NwpOutputLock(object):
+    """The lock on one prepared NWP file, making sure it is produced by one process only.
+
+    Use it as a context manager::
+
+        with NwpOutputLock(result_file, timeout=600) as producer:
+            if producer:
+                # write a temporary file and rename it to result_file
+
+    The context manager gives True if this process should produce the file,
+    and False if it was already produced, maybe by another process waited
+    for. :class:`NwpLockTimeout` is raised if the file is neither produced
+    nor the lock acquired within *timeout* seconds.
+    """
+
+    def __init__(self, result_file, timeout=None):
+        self.result_file = result_file
+        self.lock_file = get_lock_filename(result_file)
+        self.timeout = timeout
+        self._fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        """Get the exclusive lock if the result file is not there.
+
+        Return True if the lock is acquired and the result file should be
+        produced, False if the result file is there.
+        """
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            if os.path.exists(self.result_file):
+                return False
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                LOG.debug("Waiting for %s to be produced by another process", self.result_file)
+                remaining = None if deadline is None else deadline - time.time()
+                if not wait_for_lock(fd, remaining, self.result_file):
+                    raise NwpLockTimeout("Timeout waiting for %s to be produced" % self.result_file)
+                continue
+            if not _is_current(fd, self.lock_file) or os.path.exists(self.result_file):
+                # The lock file was removed by a producer done meanwhile
+                os.close(fd)
+                continue
+            LOG.debug("Got lock for NWP outfile: %s", self.result_file)
+            self._fd = fd
+            return True
+
+    def release(self):
+        """Remove the lock file and release the lock, if held."""
+        if self._fd is None:
+            return
+        try:
+            os.remove(self.lock_file)
+        except OSError:
+            pass
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+def _is_current(fd, lock_file):
+    """Check that the open file *fd* is still the *lock_file* on disk."""
+    try:
+        return os.stat(lock_file).st_ino == os.fstat(fd).st_ino
+    except OSError:
+        return False
+
+
+def wait_for_lock(fd, timeout=None, result_file=None):
+    """Wait until the lock held by another process on the file *fd* is released, or *timeout* seconds.
+
+    Without a *timeout* the wait blocks on a shared lock. Otherwise it
+    blocks until the *result_file* is renamed into place or the locked file
+    removed, watching their directory with inotify, or polls the lock with a
+    growing interval if inotify is not available. The file *fd* is closed
+    when done. Return True if the lock was released, or the *result_file*
+    produced, within the *timeout*.
+    """
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return True
+        deadline = time.monotonic() + timeout
+        watch = None if result_file is None else watch_directory(os.path.dirname(result_file) or '.')
+        try:
+            return _wait_until_released(fd, deadline, result_file, watch)
+        finally:
+            if watch is not None:
+                os.close(watch)
+    finally:
+        os.close(fd)
+
+
+def _wait_until_released(fd, deadline, result_file, watch):
+    interval = MIN_POLL_INTERVAL
+    while not _is_released(fd, result_file):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if watch is None:
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+            continue
+        readable, _, _ = select.select([watch], [], [], min(LOCK_CHECK_INTERVAL, remaining))
+        if readable:
+            _read_events(watch)
+    return True
+
+
+def _is_released(fd, result_file):
+    """Check if the lock on *fd* is released, its file removed, or the *result_file* produced."""
+    if os.fstat(fd).st_nlink == 0 or (result_file is not None and os.path.exists(result_file)):
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _get_libc():
+    """Get the C library providing inotify, None if not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if not (hasattr(libc, 'inotify_init1') and hasattr(libc, 'inotify_add_watch')):
+        return None
+    return libc
+
+
+def watch_directory(dirname):
+    """Get a non-blocking inotify file descriptor watching the files renamed into, or removed from, *dirname*.
+
+    Return None if inotify is not available.
+    """
+    libc = _get_libc()
+    if libc is None:
+        return None
+    watch = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if watch < 0:
+        LOG.debug("No inotify: %s", os.strerror(ctypes.get_errno()))
+        return None
+    if libc.inotify_add_watch(watch, os.fsencode(dirname), IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE) < 0:
+        LOG.debug("Cannot watch %s: %s", dirname, os.strerror(ctypes.get_errno()))
+        os.close(watch)
+        return None
+    return watch
+
+
+def _read_events(watch):
+    """Read all the pending events of the inotify file descriptor *watch*."""
+    while True:
+        try:
+            if not os.read(watch, 4096):
+                return
+        except BlockingIOError:
+            return
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cleaning the NWP output directory.
+
+The prepared NWP files are removed when their analysis is too old, and the
+oldest ones when the directory is larger than its size budget, except for
+the files covering the scenes being processed. Temporary and lock files
+left behind by failed or killed NWP preparations are removed too.
+"""
+
+import fcntl
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from trollsift import Parser
+
+from nwcsafpps_runner.nwp_lock import LOCK_SUFFIX, get_lock_filename, get_result_basename
+from nwcsafpps_runner.nwp_service import get_nwp_files, get_scene_lead_times
+
+LOG = logging.getLogger(__name__)
+
+
+def get_protected_files(nwp_files, scene_windows):
+    """Get the NWP files needed by the scenes with the (start, end) *scene_windows*.
+
+    *nwp_files* is a list of (analysis_time, lead_time, filename) tuples as
+    given by :func:`nwcsafpps_runner.nwp_service.get_nwp_files`. For every
+    analysis, the files bracketing the scenes are protected.
+    """
+    lead_times = {}
+    for analysis_time, lead_time, filename in nwp_files:
+        lead_times.setdefault(analysis_time, {})[lead_time.total_seconds() / 3600.] = filename
+
+    protected = set()
+    for scene_window in scene_windows:
+        for analysis_time, files in lead_times.items():
+            for lead_time in get_scene_lead_times(analysis_time, files.keys(), scene_window):
+                protected.add(files[lead_time])
+    return protected
+
+
+def select_nwp_files_to_evict(nwp_files, sizes, protected, oldest_analysis=None, max_size=None):
+    """Select the NWP files to remove.
+
+    All files with an analysis time before *oldest_analysis* are selected,
+    and then the files of the oldest analyses until the total size of the
+    files left is at most *max_size* bytes. The *protected* files are never
+    selected. *sizes* is a dict with the size of every file.
+    """
+    evict = []
+    total_size = sum(sizes.values())
+    for analysis_time, lead_time, filename in sorted(nwp_files):
+        if filename in protected:
+            continue
+        expired = oldest_analysis is not None and analysis_time < oldest_analysis
+        too_large = max_size is not None and total_size > max_size
+        if not expired and not too_large:
+            continue
+        evict.append(filename)
+        total_size = total_size - sizes[filename]
+    return evict
+
+
+def remove_orphan_lock(lock_file):
+    """Remove the *lock_file* if no process holds it.
+
+    The file is removed while locked, so a process opening it meanwhile
+    notices and opens a new lock file (see
+    :class:`nwcsafpps_runner.nwp_lock.NwpOutputLock`). Return True if the file
+    was removed.
+    """
+    try:
+        fd = os.open(lock_file, os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.remove(lock_file)
+    except (BlockingIOError, OSError):
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def is_orphan_lock(lock_file):
+    """Check if no process holds the *lock_file*."""
+    try:
+        fd = os.open(lock_file, os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+class NwpRetention(threading.Thread):
+    """Keep the NWP output directory clean, at startup and every *interval* seconds.
+
+    The prepared NWP files matching *output_pattern* with analyses older than
+    *max_age* hours are removed, and the oldest files until the directory
+    holds at most *max_size* bytes. The hidden, temporary and lock files of
+    the prepared NWP files older than *tmp_max_age* seconds, and not in use,
+    are removed as well.
+    """
+
+    def __init__(self, nwp_outdir, output_pattern, max_age=None, max_size=None,
+                 tmp_max_age=3600, interval=3600):
+        threading.Thread.__init__(self, name='NwpRetention')
+        self.daemon = True
+        self.loop = True
+        self.nwp_outdir = nwp_outdir
+        self.output_pattern = output_pattern
+        self.max_age = max_age
+        self.max_size = max_size
+        self.tmp_max_age = tmp_max_age
+        self.interval = interval
+        self._in_flight = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @contextmanager
+    def in_flight(self, starttime, endtime):
+        """Keep the NWP files covering the scene from *starttime* to *endtime* while in the context."""
+        with self._lock:
+            self._in_flight[(starttime, endtime)] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[(starttime, endtime)] -= 1
+                if self._in_flight[(starttime, endtime)] <= 0:
+                    del self._in_flight[(starttime, endtime)]
+
+    def stop(self):
+        """Stop the cleaning."""
+        self.loop = False
+        self._stopped.set()
+
+    def run(self):
+        """Clean the NWP output directory until stopped."""
+        while self.loop:
+            try:
+                self.cleanup()
+            except Exception:
+                LOG.exception("Something went wrong cleaning the NWP output directory...")
+            self._stopped.wait(self.interval)
+
+    def cleanup(self):
+        """Remove the orphan temporary and lock files, and the prepared NWP files not to be kept."""
+        self.reap_orphans()
+        self.evict()
+
+    def evict(self):
+        """Remove the prepared NWP files that are too old or exceed the size budget.
+
+        Return the files removed.
+        """
+        if self.max_age is None and self.max_size is None:
+            return []
+
+        nwp_files = get_nwp_files(self.nwp_outdir, self.output_pattern)
+        sizes = {}
+        for _, _, filename in nwp_files:
+            try:
+                sizes[filename] = os.path.getsize(filename)
+            except OSError:
+                sizes[filename] = 0
+        with self._lock:
+            scene_windows = list(self._in_flight)
+        protected = get_protected_files(nwp_files, scene_windows)
+        oldest_analysis = None
+        if self.max_age is not None:
+            oldest_analysis = datetime.utcnow() - timedelta(hours=self.max_age)
+
+        evicted = []
+        for filename in select_nwp_files_to_evict(nwp_files, sizes, protected, oldest_analysis, self.max_size):
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            LOG.info("Removed NWP file %s", filename)
+            evicted.append(filename)
+        return evicted
+
+    def reap_orphans(self):
+        """Remove the hidden, temporary and lock files left behind by failed NWP preparations.
+
+        Only the files named after a prepared NWP file, as done by
+        :mod:`nwcsafpps_runner.nwp_lock`, are looked at. Return the files
+        removed.
+        """
+        parser = Parser(self.output_pattern)
+        too_old = time.time() - self.tmp_max_age
+        reaped = []
+        for basename in os.listdir(self.nwp_outdir):
+            result_basename = get_result_basename(basename)
+            if result_basename is None or not parser.validate(result_basename):
+                continue
+            filename = os.path.join(self.nwp_outdir, basename)
+            lock_file = get_lock_filename(os.path.join(self.nwp_outdir, result_basename))
+            is_lock = basename.endswith(LOCK_SUFFIX)
+            try:
+                if os.path.getmtime(filename) > too_old:
+                    continue
+                if is_lock:
+                    if not remove_orphan_lock(filename):
+                        continue
+                elif os.path.exists(lock_file) and not is_orphan_lock(lock_file):
+                    continue
+                else:
+                    os.remove(filename)
+            except OSError:
+                continue
+            LOG.info("Removed orphan file %s", filename)
+            reaped.append(filename)
+        return reaped
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A background service preparing the NWP data for PPS.
+
+The service runs the NWP preparation in one thread of the runner, whenever
+triggered (by new NWP data messages) or at a regular interval. The scenes ask
+the service whether the NWP data covering their start time are ready, and
+only wait if not. The waiting scenes may request the lead times covering
+them to be prepared first, before all other lead times.
+"""
+
+import logging
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import timedelta
+from glob import glob
+
+from trollsift import Parser, globify
+
+LOG = logging.getLogger(__name__)
+
+NWP_OUTPUT_TIME_PATTERN = '{analysis_time:%Y%m%d%H%M}+{step_hour:03d}H{step_min:02d}M'
+
+
+def get_nwp_output_pattern(options):
+    """Get the filename pattern of the prepared NWP files from the config *options*."""
+    if options.get('nwp_output'):
+        return options['nwp_output']
+    return options['nwp_output_prefix'] + NWP_OUTPUT_TIME_PATTERN
+
+
+def get_nwp_files(nwp_outdir, output_pattern):
+    """Get the prepared NWP files in *nwp_outdir*.
+
+    Return a list of (analysis_time, lead_time, filename) tuples, where the
+    lead time is a timedelta.
+    """
+    parser = Parser(output_pattern)
+    nwp_files = []
+    for filename in glob(os.path.join(nwp_outdir, globify(output_pattern))):
+        try:
+            res = parser.parse(os.path.basename(filename))
+        except ValueError:
+            continue
+        lead_time = timedelta(hours=res.get('step_hour', 0), minutes=res.get('step_min', 0))
+        nwp_files.append((res['analysis_time'], lead_time, filename))
+    return nwp_files
+
+
+def get_nwp_valid_times(nwp_outdir, output_pattern):
+    """Get the sorted valid times of the prepared NWP files in *nwp_outdir*."""
+    return sorted(set(analysis_time + lead_time
+                      for analysis_time, lead_time, _ in get_nwp_files(nwp_outdir, output_pattern)))
+
+
+def get_scene_lead_times(analysis_time, nlengths, scene_window):
+    """Get the lead times of the *analysis_time* needed for the NWP data covering the *scene_window*.
+
+    The *scene_window* is the (start, end) time of the scene. Return the lead
+    times, in hours, among *nlengths* bracketing the scene: the last one
+    valid at or before the start, the first one valid at or after the end,
+    and those in between. Return an empty list if the forecast ends before
+    the scene starts.
+    """
+    starttime, endtime = scene_window
+    lead_times = sorted(nlengths)
+    valid_times = [analysis_time + timedelta(hours=lead_time) for lead_time in lead_times]
+    if not valid_times or valid_times[-1] < starttime:
+        return []
+    first = max(bisect_right(valid_times, starttime) - 1, 0)
+    last = min(bisect_left(valid_times, endtime), len(valid_times) - 1)
+    return lead_times[first:last + 1]
+
+
+class NwpPrepareService(threading.Thread):
+    """Prepare the NWP data for PPS in the background.
+
+    The *prepare_func* is called without arguments at startup, whenever
+    triggered, and at least every *interval* seconds. If *scene_steps_first*
+    is True, the scenes waiting for NWP data have the lead times covering
+    them prepared first, by calling *prepare_func* with the keyword argument
+    *scene_window*, and the other lead times are prepared right after.
+    """
+
+    def __init__(self, prepare_func, nwp_outdir, output_pattern, interval=600, scene_steps_first=False):
+        threading.Thread.__init__(self, name='NwpPrepareService')
+        self.daemon = True
+        self.loop = True
+        self.prepare_func = prepare_func
+        self.nwp_outdir = nwp_outdir
+        self.output_pattern = output_pattern
+        self.interval = interval
+        self.scene_steps_first = scene_steps_first
+        self.valid_times = []
+        self._requests = deque()
+        self._triggered = threading.Event()
+        self._updated = threading.Condition()
+
+    def trigger(self):
+        """Trigger a new NWP preparation."""
+        self._triggered.set()
+
+    def request(self, starttime, endtime):
+        """Request the lead times covering the scene from *starttime* to *endtime* to be prepared first."""
+        if (starttime, endtime) not in self._requests:
+            self._requests.append((starttime, endtime))
+        self._triggered.set()
+
+    def _next_request(self):
+        """Get the next requested scene window not yet covered by prepared NWP data, if any."""
+        while self._requests:
+            scene_window = self._requests.popleft()
+            if not self.is_ready(*scene_window):
+                return scene_window
+        return None
+
+    def stop(self):
+        """Stop the NWP preparation service."""
+        self.loop = False
+        self._triggered.set()
+
+    def run(self):
+        """Run the NWP preparation until stopped."""
+        while self.loop:
+            self._triggered.clear()
+            scene_window = self._next_request()
+            try:
+                if scene_window is None:
+                    self.prepare_func()
+                else:
+                    LOG.info("Prepare the NWP data covering the scene from %s to %s first",
+                             str(scene_window[0]), str(scene_window[1]))
+                    self.prepare_func(scene_window=scene_window)
+            except Exception:
+                LOG.exception("Something went wrong in the NWP preparation...")
+            self.refresh()
+            if scene_window is not None:
+                # Fill in the remaining lead times right away
+                continue
+            self._triggered.wait(self.interval)
+
+    def refresh(self):
+        """Update the valid times of the prepared NWP files and notify those waiting."""
+        valid_times = get_nwp_valid_times(self.nwp_outdir, self.output_pattern)
+        with self._updated:
+            self.valid_times = valid_times
+            self._updated.notify_all()
+        if valid_times:
+            LOG.debug("Prepared NWP data available from %s to %s",
+                      str(valid_times[0]), str(valid_times[-1]))
+
+    def is_ready(self, starttime, endtime=None):
+        """Check if there are prepared NWP data before and after *starttime*, and *endtime* if given."""
+        valid_times = self.valid_times
+        for time_slot in (starttime, endtime or starttime):
+            idx = bisect_left(valid_times, time_slot)
+            if idx < len(valid_times) and valid_times[idx] == time_slot:
+                continue
+            if not 0 < idx < len(valid_times):
+                return False
+        return True
+
+    def ask_for(self, starttime, endtime=None):
+        """Ask for the NWP data covering *starttime* to *endtime*, first if *scene_steps_first* is set."""
+        if self.scene_steps_first:
+            self.request(starttime, endtime or starttime)
+        else:
+            self.trigger()
+
+    def wait_until_ready(self, starttime, timeout=None, endtime=None):
+        """Wait until the NWP data covering *starttime* to *endtime* are ready, or until *timeout* seconds.
+
+        Return True if the NWP data are ready.
+        """
+        if self.is_ready(starttime, endtime):
+            return True
+        LOG.info("Waiting for NWP data covering %s...", str(starttime))
+        self.ask_for(starttime, endtime)
+        with self._updated:
+            return self._updated.wait_for(lambda: self.is_ready(starttime, endtime), timeout)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Logging the output of the child processes from one thread.
+
+The stdout and stderr pipes of all the child processes are read by a single
+pump thread waiting on them with a selector, instead of two blocking reader
+threads per process. Every line is logged tagged with the scene (or command)
+it comes from. Lines longer than the line buffer are logged in pieces, so
+a process writing without newlines cannot grow the buffer without bounds.
+"""
+
+import logging
+import os
+import selectors
+import threading
+
+LOG = logging.getLogger(__name__)
+
+#: Size of the line buffer of each stream, longer lines are logged in pieces
+MAX_LINE_LENGTH = 8192
+
+#: Size of the reads from the pipes
+READ_SIZE = 65536
+
+
+def pop_lines(buffer, max_line_length=MAX_LINE_LENGTH):
+    """Remove the complete lines from the *buffer* (a bytearray) and return them.
+
+    A line longer than *max_line_length* is returned in pieces of that length.
+    """
+    lines = []
+    start = 0
+    while True:
+        end = buffer.find(b'\n', start)
+        if end < 0:
+            break
+        lines.append(bytes(buffer[start:end]))
+        start = end + 1
+    del buffer[:start]
+    while len(buffer) >= max_line_length:
+        lines.append(bytes(buffer[:max_line_length]))
+        del buffer[:max_line_length]
+    return lines
+
+
+def decode_line(line):
+    """Decode the *line* of output for the log."""
+    return line.decode('utf-8', errors='replace').rstrip()
+
+
+class ProcessOutput(object):
+    """The output of a child process, logged with *log_func* and tagged with *tag*."""
+
+    def __init__(self, proc, tag, log_func):
+        self.proc = proc
+        self.tag = tag
+        self.log_func = log_func
+        self.streams = [stream for stream in (proc.stdout, proc.stderr) if stream is not None]
+        self.nlines = 0
+        self._nopen = len(self.streams)
+        self._done = threading.Event()
+        if not self.streams:
+            self._done.set()
+
+    def log_line(self, line):
+        """Log the *line* (bytes) of output."""
+        self.nlines += 1
+        self.log_func("[%s] %s", self.tag, decode_line(line))
+
+    def close_stream(self, stream):
+        """Close the *stream* at its end."""
+        stream.close()
+        self._nopen -= 1
+        if self._nopen <= 0:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Wait until all the output of the process is logged, at most *timeout* seconds.
+
+        Return True if all the output is logged.
+        """
+        return self._done.wait(timeout)
+
+
+class OutputPump(threading.Thread):
+    """Log the stdout and stderr of the child processes registered, line by line."""
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        threading.Thread.__init__(self, name='OutputPump')
+        self.daemon = True
+        self.loop = True
+        self.max_line_length = max_line_length
+        self._selector = selectors.DefaultSelector()
+        self._wake_read, self._wake_write = os.pipe()
+        self._selector.register(self._wake_read, selectors.EVENT_READ)
+        self._new = []
+        self._lock = threading.Lock()
+
+    def register(self, proc, tag, log_func=LOG.info):
+        """Log the output of the child process *proc*, tagged with *tag*.
+
+        Return the :class:`ProcessOutput` to wait on for the end of the output.
+        """
+        output = ProcessOutput(proc, tag, log_func)
+        with self._lock:
+            self._new.append(output)
+        self._wake()
+        return output
+
+    def stop(self):
+        """Stop logging."""
+        self.loop = False
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b'x')
+        except OSError:
+            pass
+
+    def _add_new(self):
+        os.read(self._wake_read, READ_SIZE)
+        with self._lock:
+            new, self._new = self._new, []
+        for output in new:
+            for stream in output.streams:
+                self._selector.register(stream.fileno(), selectors.EVENT_READ, (output, stream, bytearray()))
+
+    def _read(self, fd, output, stream, buffer):
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            self._selector.unregister(fd)
+            if buffer:
+                output.log_line(bytes(buffer))
+            output.close_stream(stream)
+            return
+        buffer.extend(data)
+        for line in pop_lines(buffer, self.max_line_length):
+            output.log_line(line)
+
+    def run(self):
+        """Log the output until stopped."""
+        while self.loop:
+            for key, _ in self._selector.select():
+                if key.fd == self._wake_read:
+                    self._add_new()
+                    continue
+                try:
+                    self._read(key.fd, *key.data)
+                except Exception:
+                    LOG.exception("Failed reading the output of %s", str(key.data[0].tag))
+                    self._selector.unregister(key.fd)
+                    key.data[0].close_stream(key.data[1])
+
+
+_PUMP = None
+_PUMP_PID = None
+_PUMP_LOCK = threading.Lock()
+
+
+def get_output_pump():
+    """Get the output pump shared by the process, started at the first call."""
+    global _PUMP, _PUMP_PID
+    with _PUMP_LOCK:
+        # A forked process does not have the thread of its parent's pump
+        if _PUMP is None or _PUMP_PID != os.getpid():
+            _PUMP = OutputPump()
+            _PUMP_PID = os.getpid()
+            _PUMP.start()
+        return _PUMP
+
+
+def pump_output(proc, tag, log_func=LOG.info):
+    """Log the output of the child process *proc* tagged with *tag*, from the shared pump.
+
+    Return the :class:`ProcessOutput` to wait on for the end of the output.
+    """
+    return get_output_pump().register(proc, tag, log_func)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Running the PPS PGEs of a scene as a dependency graph.
+
+Instead of the serial ppsRunAll script, every PGE (product generation
+element) is run as its own process as soon as the PGEs it depends on are
+done, so that for instance the physiography and the NWP remapping, or the
+cloud type and the cloud top products, are made side by side. Every PGE
+has its own timeout, and the number of processes of a PGE running at once,
+over all the scenes, can be limited. A PGE failing stops the PGEs depending
+on it, the others being run to the end, and the scene is then failed (see
+:func:`get_failed_pges`). The time taken by every PGE is logged with the
+latency of the scene, to be compared with their serial sum.
+
+The threads engine runs every PGE of a scene from its own thread, and the
+asyncio engine as a task of the event loop.
+
+Every PGE script is called as ``<python> <script> <arguments>``. The
+arguments are by default those giving ppsRunAll the level-1 file, like
+``--hrptfile <file>``, and can be set by PGE with the *pge_arguments* config
+option, as pge:template items. The templates are split on white space, and
+every argument formatted with the fields of the scene, for instance
+``ppsMakeNwp:--hrptfile {file4pps} --orbit {orbit_number}``. Only the
+sensors with a known level-1 conversion PGE (see :data:`MAKE_PGES`) can be
+run as a graph, the others only with ppsRunAll.
+"""
+
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from subprocess import PIPE, Popen, TimeoutExpired
+
+from nwcsafpps_runner.async_engine import run_process
+from nwcsafpps_runner.output_pump import pump_output
+from nwcsafpps_runner.utils import SENSOR_LIST, PpsRunError, get_pps_level1_arguments
+
+LOG = logging.getLogger(__name__)
+
+#: The PGE converting the level-1 data of a sensor to the PPS format
+MAKE_PGES = {'avhrr/3': 'ppsMakeAvhrr', 'viirs': 'ppsMakeViirs', 'modis': 'ppsMakeModis'}
+
+#: The PGEs each PGE depends on, the level-1 conversion being called 'make'
+PGE_DEPENDENCIES = {'make': (),
+                    'ppsMakePhysiography': ('make', ),
+                    'ppsMakeNwp': ('make', ),
+                    'ppsCmaskPrepare': ('ppsMakePhysiography', 'ppsMakeNwp'),
+                    'ppsCmask': ('ppsCmaskPrepare', ),
+                    'ppsCmaskProb': ('ppsCmask', ),
+                    'ppsCtth': ('ppsCmask', ),
+                    'ppsCtype': ('ppsCmask', ),
+                    'ppsCpp': ('ppsCtype', ),
+                    'ppsPrecipPrepare': ('ppsMakeNwp', ),
+                    'ppsPrecip': ('ppsPrecipPrepare', 'ppsCtype')}
+
+#: The config options turning on the optional PGEs
+OPTIONAL_PGES = {'ppsCmaskProb': 'run_cmask_prob',
+                 'ppsCpp': 'run_pps_cpp',
+                 'ppsPrecipPrepare': 'run_pps_precip',
+                 'ppsPrecip': 'run_pps_precip'}
+
+
+def get_pge_settings(value, convert=str):
+    """Get the settings by PGE from the config *value*.
+
+    The settings are given as a list, or a comma separated string, of
+    pge:value items, the values being converted with *convert*.
+    """
+    if value is None:
+        return {}
+    if isinstance(value, str):
+        value = value.split(',')
+    settings = {}
+    for item in value:
+        pge, _, setting = str(item).strip().partition(':')
+        if not setting:
+            raise ValueError("The PGE setting should be given as pge:value: %s" % str(item))
+        settings[pge] = convert(setting)
+    return settings
+
+
+def get_make_pge(platform_name):
+    """Get the PGE converting the level-1 data of *platform_name*.
+
+    :class:`nwcsafpps_runner.utils.PpsRunError` is raised if no such PGE is
+    known for the sensor of the platform.
+    """
+    sensor = SENSOR_LIST.get(platform_name, platform_name)
+    if isinstance(sensor, list):
+        sensor = sensor[0]
+    if sensor not in MAKE_PGES:
+        raise PpsRunError("No PGE graph for the %s data of %s, run PPS with ppsRunAll instead" %
+                          (str(sensor), str(platform_name)))
+    return MAKE_PGES[sensor]
+
+
+def get_pge_graph(scene, options):
+    """Get the PGEs to run on the *scene* with the PGEs each depends on, as a dict."""
+    make_pge = get_make_pge(scene['platform_name'])
+    graph = {}
+    for pge, dependencies in PGE_DEPENDENCIES.items():
+        if pge in OPTIONAL_PGES and not options.get(OPTIONAL_PGES[pge]):
+            continue
+        pge = make_pge if pge == 'make' else pge
+        graph[pge] = tuple(make_pge if dep == 'make' else dep for dep in dependencies)
+    return graph
+
+
+def get_pge_arguments(scene, template=None):
+    """Get the arguments of a PGE script on the *scene*, from the *template* if given.
+
+    Without *template*, the arguments are those giving ppsRunAll the
+    level-1 file of the *scene*.
+    """
+    if template is None:
+        return get_pps_level1_arguments(scene)
+    return [argument.format(**scene) for argument in template.split()]
+
+
+def get_pge_commands(scene, graph, options):
+    """Get the command running each PGE of the *graph* on the *scene*, as a list of arguments.
+
+    The PGE scripts are found in *pge_script_dir*, by default the directory
+    of the *run_all_script*, unless given in *pge_scripts*. Their arguments
+    are given by the templates of *pge_arguments* (see :func:`get_pge_arguments`).
+    """
+    py_exec = options.get('python', '/bin/python')
+    script_dir = options.get('pge_script_dir') or os.path.dirname(options.get('run_all_script') or '')
+    scripts = get_pge_settings(options.get('pge_scripts'))
+    templates = get_pge_settings(options.get('pge_arguments'))
+    return {pge: ([py_exec, scripts.get(pge, os.path.join(script_dir, pge + '.py'))] +
+                  get_pge_arguments(scene, templates.get(pge)))
+            for pge in graph}
+
+
+class PgeSlots(object):
+    """Limit the number of processes of each PGE running at once, from any thread or event loop.
+
+    The *limits* are the maximum numbers of processes by PGE, the PGEs not
+    listed being unlimited.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or {}
+        self._running = Counter()
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def running(self, pge):
+        """The number of processes of the *pge* running."""
+        return self._running[pge]
+
+    @contextlib.contextmanager
+    def hold(self, pge):
+        """Wait for a free slot for the *pge*, blocking the current thread, and hold it."""
+        if not self.limits.get(pge):
+            yield
+            return
+        freed = threading.Event()
+        if not self._try_acquire(pge, freed.set):
+            freed.wait()
+        try:
+            yield
+        finally:
+            self._release(pge)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, pge):
+        """Wait for a free slot for the *pge* in the event loop, and hold it."""
+        if not self.limits.get(pge):
+            yield
+            return
+        await self._acquire(pge)
+        try:
+            yield
+        finally:
+            self._release(pge)
+
+    def _try_acquire(self, pge, wake):
+        """Take a free slot for the *pge*, or queue the *wake* function, called once the slot is handed over."""
+        with self._lock:
+            waiters = self._waiters.setdefault(pge, deque())
+            if self._running[pge] < self.limits[pge] and not waiters:
+                self._running[pge] += 1
+                return True
+            waiters.append(wake)
+            return False
+
+    async def _acquire(self, pge):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        wake = functools.partial(loop.call_soon_threadsafe, _set_done, future)
+        if self._try_acquire(pge, wake):
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                waiters = self._waiters[pge]
+                handed_over = wake not in waiters
+                if not handed_over:
+                    waiters.remove(wake)
+            if handed_over:
+                self._release(pge)
+            raise
+
+    def _release(self, pge):
+        with self._lock:
+            waiters = self._waiters.get(pge)
+            if not waiters:
+                self._running[pge] -= 1
+                return
+            # The slot is handed over to the next waiting PGE
+            wake = waiters.popleft()
+        wake()
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class PgeTiming(object):
+    """The return code and the time taken by a PGE run, None if not run, and if skipped for a failed dependency."""
+
+    __slots__ = ('returncode', 'seconds', 'skipped')
+
+    def __init__(self, returncode=None, seconds=None, skipped=False):
+        self.returncode = returncode
+        self.seconds = seconds
+        self.skipped = skipped
+
+    @property
+    def failed(self):
+        """Check if the PGE failed, or could not be run, when not skipped."""
+        return not self.skipped and self.returncode != 0
+
+    def __repr__(self):
+        return 'PgeTiming(returncode=%s, seconds=%s, skipped=%s)' % (str(self.returncode), str(self.seconds),
+                                                                     str(self.skipped))
+
+
+def get_failed_pges(timings):
+    """Get the PGEs that failed among the *timings*, those skipped for them not included."""
+    return [pge for pge, timing in timings.items() if timing.failed]
+
+
+async def run_pge_graph(graph, commands, tag, slots=None, timeouts=None, default_timeout=None, on_start=None):
+    """Run the PGEs of the *graph* with their *commands*, each as soon as the PGEs it depends on succeeded.
+
+    The output of the PGEs is logged tagged with *tag*. The processes are
+    limited by the *slots* (a :class:`PgeSlots`), and killed after the
+    *timeouts* by PGE in seconds, or *default_timeout*. The *on_start*
+    function, if given, is called with the pid of every process.
+    Return the :class:`PgeTiming` of every PGE.
+    """
+    slots = slots or PgeSlots()
+    timeouts = timeouts or {}
+    timings = {pge: PgeTiming() for pge in graph}
+    tasks = {}
+    start = time.monotonic()
+
+    async def run_pge(pge):
+        for dependency in graph[pge]:
+            if dependency not in tasks or not await tasks[dependency]:
+                LOG.warning("[%s] Skip %s, %s not done", tag, pge, dependency)
+                timings[pge].skipped = True
+                return False
+        async with slots.slot(pge):
+            LOG.info("[%s] Run PPS module: %s", tag, pge)
+            pge_start = time.monotonic()
+            try:
+                returncode = await run_process(commands[pge], tag, timeout=timeouts.get(pge, default_timeout),
+                                               on_start=on_start)
+            except OSError:
+                LOG.exception("[%s] Failed running PPS module %s", tag, pge)
+                return False
+            timings[pge].returncode = returncode
+            timings[pge].seconds = time.monotonic() - pge_start
+        if returncode != 0:
+            LOG.error("[%s] PPS module %s failed with return code %d", tag, pge, returncode)
+        return returncode == 0
+
+    for pge in graph:
+        tasks[pge] = asyncio.ensure_future(run_pge(pge))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+    log_timings(tag, timings, start)
+    return timings
+
+
+def run_pge_graph_in_threads(graph, commands, tag, slots=None, timeouts=None, default_timeout=None,
+                             on_start=None):
+    """Run the PGEs of the *graph* with their *commands*, each from its own thread, blocking until all are done.
+
+    The PGEs are run like with :func:`run_pge_graph`, without an event loop.
+    Return the :class:`PgeTiming` of every PGE.
+    """
+    slots = slots or PgeSlots()
+    timeouts = timeouts or {}
+    timings = {pge: PgeTiming() for pge in graph}
+    results = {pge: Future() for pge in graph}
+    start = time.monotonic()
+
+    def run_pge(pge):
+        for dependency in graph[pge]:
+            if dependency not in results or not results[dependency].result():
+                LOG.warning("[%s] Skip %s, %s not done", tag, pge, dependency)
+                timings[pge].skipped = True
+                return False
+        with slots.hold(pge):
+            LOG.info("[%s] Run PPS module: %s", tag, pge)
+            pge_start = time.monotonic()
+            try:
+                returncode = run_pge_process(commands[pge], tag, timeout=timeouts.get(pge, default_timeout),
+                                             on_start=on_start)
+            except OSError:
+                LOG.exception("[%s] Failed running PPS module %s", tag, pge)
+                return False
+            timings[pge].returncode = returncode
+            timings[pge].seconds = time.monotonic() - pge_start
+        if returncode != 0:
+            LOG.error("[%s] PPS module %s failed with return code %d", tag, pge, returncode)
+        return returncode == 0
+
+    def run(pge):
+        try:
+            results[pge].set_result(run_pge(pge))
+        except Exception as err:
+            results[pge].set_exception(err)
+
+    # One thread by PGE, so that the PGEs waiting for their dependencies never hold back the others
+    with ThreadPoolExecutor(max_workers=len(graph) or 1) as executor:
+        for pge in graph:
+            executor.submit(run, pge)
+
+    log_timings(tag, timings, start)
+    for result in results.values():
+        result.result()
+    return timings
+
+
+def run_pge_process(cmd, tag, timeout=None, on_start=None):
+    """Run the PGE command *cmd*, logging its output tagged with *tag*, from the current thread.
+
+    The process is killed if still running after *timeout* seconds. The
+    *on_start* function, if given, is called with the pid of the process.
+    Return the return code of the process.
+    """
+    LOG.debug("Run command: %s", str(cmd))
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    if on_start is not None:
+        on_start(proc.pid)
+    output = pump_output(proc, tag, LOG.info)
+    try:
+        proc.wait(timeout)
+    except TimeoutExpired:
+        LOG.info("Process timed out and pre-maturely terminated. Scene: %s", tag)
+        proc.kill()
+    finally:
+        returncode = proc.wait()
+        output.wait()
+    return returncode
+
+
+def log_timings(tag, timings, start):
+    """Log the *timings* of the PGEs of the scene *tag*, processed since *start*."""
+    done = [(pge, timing.seconds) for pge, timing in timings.items() if timing.seconds is not None]
+    LOG.info("[%s] PGE timings: %s", tag, ', '.join('%s %.1f s' % item for item in done))
+    LOG.info("[%s] Scene processed in %.1f s, the PGEs took %.1f s in total",
+             tag, time.monotonic() - start, sum(seconds for _, seconds in done))
+    failed = get_failed_pges(timings)
+    if failed:
+        LOG.error("[%s] PGEs failed: %s, skipped: %s", tag, ', '.join(failed),
+                  ', '.join(pge for pge, timing in timings.items() if timing.skipped) or 'none')
+
+
+def get_scene_pges(scene, options):
+    """Get the graph of the PGEs of the *scene*, their commands and timeouts, as configured in *options*.
+
+    The PGEs are killed after their *pge_timeouts_minutes*, by default the
+    *maximum_pps_processing_time_in_minutes*.
+    """
+    graph = get_pge_graph(scene, options)
+    timeouts = {pge: minutes * 60.0 for pge, minutes in
+                get_pge_settings(options.get('pge_timeouts_minutes'), float).items()}
+    return dict(graph=graph, commands=get_pge_commands(scene, graph, options), timeouts=timeouts,
+                default_timeout=options['maximum_pps_processing_time_in_minutes'] * 60.0)
+
+
+def run_scene_pges(scene, tag, options, slots=None, on_start=None):
+    """Get the coroutine running the PGEs of the *scene* as a dependency graph, as configured in *options*."""
+    return run_pge_graph(tag=tag, slots=slots, on_start=on_start, **get_scene_pges(scene, options))
+
+
+def run_scene_pges_in_threads(scene, tag, options, slots=None, on_start=None):
+    """Run the PGEs of the *scene* as a dependency graph from threads, as configured in *options*."""
+    return run_pge_graph_in_threads(tag=tag, slots=slots, on_start=on_start, **get_scene_pges(scene, options))
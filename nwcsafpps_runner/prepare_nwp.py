@@ -26,16 +26,27 @@
 from glob import glob
 import os
 from datetime import datetime
+from functools import lru_cache
 import time
 import tempfile
+import multiprocessing
 from trollsift import Parser
-import pygrib  # @UnresolvedImport
+from eccodes import CodesInternalError
 from six.moves.configparser import NoOptionError
 
 from nwcsafpps_runner.config import get_config
 from nwcsafpps_runner.config import CONFIG_FILE
 from nwcsafpps_runner.config import CONFIG_PATH  # @UnresolvedImport
-from nwcsafpps_runner.utils import run_command
+from nwcsafpps_runner.grib_utils import assemble_nwp_file
+from nwcsafpps_runner.grib_utils import get_crop_area
+from nwcsafpps_runner.grib_utils import get_packing
+from nwcsafpps_runner.grib_utils import get_grib_entries
+from nwcsafpps_runner.grib_utils import get_missing_fields
+from nwcsafpps_runner.grib_utils import read_nwp_requirements
+from nwcsafpps_runner.grib_utils import read_static_fields
+from nwcsafpps_runner.nwp_ledger import NwpLedger
+from nwcsafpps_runner.nwp_lock import NwpLockTimeout, NwpOutputLock, get_temp_prefix
+from nwcsafpps_runner.nwp_service import get_scene_lead_times
 from nwcsafpps_runner.utils import NwpPrepareError
 
 import logging
@@ -63,15 +74,15 @@ nwp_outdir = OPTIONS.get('nwp_outdir', None)
 nwp_lsmz_filename = OPTIONS.get('nwp_static_surface', None)
 nwp_output_prefix = OPTIONS.get('nwp_output_prefix', None)
 nwp_req_filename = OPTIONS.get('pps_nwp_requirements', None)
+nwp_prepare_workers = int(OPTIONS.get('nwp_prepare_workers', 1))
+nwp_ledger_filename = OPTIONS.get('nwp_ledger_file', None)
+nwp_crop_area = get_crop_area(OPTIONS.get('nwp_crop_area', None))
+nwp_packing = get_packing(OPTIONS.get('nwp_packing', None))
+nwp_lock_timeout = float(OPTIONS.get('nwp_lock_timeout_minutes', 30)) * 60
 
-
-def logreader(stream, log_func):
-    while True:
-        s = stream.readline()
-        if not s:
-            break
-        log_func(s.strip())
-    stream.close()
+#: How the processes preparing the NWP files are started: from a fork server,
+#: not to inherit the threads and locks of the runner
+NWP_WORKERS_START_METHOD = 'forkserver'
 
 
 def make_temp_filename(*args, **kwargs):
@@ -80,11 +91,24 @@ def make_temp_filename(*args, **kwargs):
     return tmp_filename
 
 
-def update_nwp(starttime, nlengths):
+def update_nwp(starttime, nlengths, nworkers=None, scene_window=None):
     """Prepare NWP grib files for PPS. Consider only analysis times newer than
     *starttime*. And consider only the forecast lead times in hours given by
     the list *nlengths* of integers
 
+    The independent analysis time/forecast step pairs are prepared in a pool
+    of *nworkers* processes. If not given the number of workers is taken from
+    the config option *nwp_prepare_workers* (default 1, meaning serial
+    processing).
+
+    If the config option *nwp_ledger_file* is set, the input files already
+    handled are remembered between calls, and only new or changed input files
+    and the steps not yet prepared, or whose prepared file is gone, are
+    looked at.
+
+    If a *scene_window* (start, end) is given, only the lead times needed
+    for the NWP data covering the scene are prepared.
+
     """
 
     LOG.info("Path to prepare_nwp config file = %s", str(CONFIG_PATH))
@@ -99,167 +123,317 @@ def update_nwp(starttime, nlengths):
         return
 
     LOG.debug('NHSF NWP files found = %s', str(filelist))
+    if nwp_ledger_filename:
+        with NwpLedger(nwp_ledger_filename) as ledger:
+            ledger.update(filelist, parse_nhsf_filename, starttime)
+            nhsf_files = ledger.get_pending(starttime, nlengths, get_result_filename)
+            prepare_nwp_files(nhsf_files, starttime, nlengths, nworkers, nfiles_total=len(filelist),
+                              scene_window=scene_window)
+            for filename, (analysis_time, forecast_step, _) in nhsf_files:
+                if os.path.exists(get_result_filename(analysis_time, forecast_step)):
+                    ledger.set_prepared(filename)
+    else:
+        nhsf_files = [(filename, None) for filename in filelist]
+        prepare_nwp_files(nhsf_files, starttime, nlengths, nworkers, scene_window=scene_window)
+
+    return
+
+
+def prepare_nwp_files(nhsf_files, starttime, nlengths, nworkers=None, nfiles_total=None, scene_window=None):
+    """Prepare the NWP files for PPS from the nhsf files given.
+
+    *nhsf_files* is a list of (filename, nhsf_info) tuples, where nhsf_info is
+    the analysis time, forecast step and time info parsed from the filename,
+    or None if not yet parsed.
+    """
+    if nfiles_total is None:
+        nfiles_total = len(nhsf_files)
+
+    nwp_steps = []
+    for filename, nhsf_info in nhsf_files:
+        nwp_step = get_nwp_step(filename, starttime, nlengths, nhsf_info=nhsf_info, scene_window=scene_window)
+        if nwp_step is not None:
+            nwp_steps.append(nwp_step)
+    if nwp_steps:
+        settings = get_nwp_step_settings()
+        for nwp_step in nwp_steps:
+            nwp_step.update(settings)
+
+    if len(nwp_steps) == 0:
+        LOG.info("No new NWP files to prepare")
+        return
+
+    if not os.path.exists(nwp_lsmz_filename):
+        LOG.error("No static grib file with land-sea mask and " +
+                  "topography available. Can't prepare NWP data")
+        raise IOError('Failed getting static land-sea mask and topography')
+    # Read the static fields once, the workers each reading them when started
+    read_static_fields(nwp_lsmz_filename, nwp_crop_area, nwp_packing)
+
+    if nworkers is None:
+        nworkers = nwp_prepare_workers
+    LOG.info("Prepare %d NWP files using %d worker(s)", len(nwp_steps), nworkers)
+
     nfiles_error = 0
-    for filename in filelist:
-        if nhsf_file_name_sift is None:
-            raise NwpPrepareError()
-
-        try:
-            parser = Parser(nhsf_file_name_sift)
-        except NoOptionError as noe:
-            LOG.error("NoOptionError {}".format(noe))
-            continue
-        if not parser.validate(os.path.basename(filename)):
-            LOG.error("Parser validate on filename: {} failed.".format(filename))
-            continue
-        LOG.info("{}".format(os.path.basename(filename)))
-        res = parser.parse("{}".format(os.path.basename(filename)))
-        LOG.info("{}".format(res))
-        if 'analysis_time' in res:
-            if res['analysis_time'].year == 1900:
-                res['analysis_time'] = res['analysis_time'].replace(year=datetime.utcnow().year)
-
-            analysis_time = res['analysis_time']
-            timestamp = analysis_time.strftime("%Y%m%d%H%M")
-        else:
-            raise NwpPrepareError("Can not parse analysis_time in file name. Check config and filename timestamp")
-
-        if 'forecast_time' in res:
-            if res['forecast_time'].year == 1900:
-                res['forecast_time'] = res['forecast_time'].replace(year=datetime.utcnow().year)
-            forecast_time = res['forecast_time']
-            forecast_step = forecast_time - analysis_time
-            forecast_step = "{:03d}H{:02d}M".format(forecast_step.days*24 + forecast_step.seconds/3600, 0)
-            timeinfo = "{:s}{:s}{:s}".format(analysis_time.strftime(
-                "%m%d%H%M"), forecast_time.strftime("%m%d%H%M"), res['end'])
-        else:
-            LOG.info("Can not parse forecast_time in file name. Try forecast step...")
-            # This needs to be done more solid using the sift pattern! FIXME!
-            timeinfo = filename.rsplit("_", 1)[-1]
-            # Forecast step in hours:
-            if 'forecast_step' in res:
-                forecast_step = res['forecast_step']
-            else:
-                raise NwpPrepareError(
-                    'Failed parsing forecast_step in file name. Check config and filename timestamp.')
-
-        LOG.debug("Analysis time and start time: %s %s", str(analysis_time), str(starttime))
-        if analysis_time < starttime:
-            continue
-        if forecast_step not in nlengths:
-            LOG.debug("Skip step. Forecast step and nlengths: %s %s", str(forecast_step), str(nlengths))
-            continue
-
-        LOG.info("timestamp, step: %s %s", str(timestamp), str(forecast_step))
-        result_file = os.path.join(
-            nwp_outdir, nwp_output_prefix + timestamp + "+" + '%.3dH00M' % forecast_step)
-        if os.path.exists(result_file):
-            LOG.info("File: " + str(result_file) + " already there...")
-            continue
-
-        tmp_filename = make_temp_filename(suffix="_" + timestamp + "+" +
-                                          '%.3dH00M' % forecast_step, dir=nwp_outdir)
-
-        LOG.info("result and tmp files: " + str(result_file) + " " + str(tmp_filename))
-        nhsp_file = os.path.join(nhsp_path, nhsp_prefix + timeinfo)
-        if not os.path.exists(nhsp_file):
-            LOG.warning("Corresponding nhsp-file not there: " + str(nhsp_file))
-            continue
-
-        cmd = ("grib_copy -w gridType=regular_ll " + nhsp_file + " " + tmp_filename)
-        retv = run_command(cmd)
-        LOG.debug("Returncode = " + str(retv))
-        if retv != 0:
-            LOG.error(
-                "Failed doing the grib-copy! Will continue with the next file")
+    for retv in run_nwp_steps(nwp_steps, nworkers):
+        if not retv:
             nfiles_error = nfiles_error + 1
-            if nfiles_error > len(filelist) / 2:
+            if nfiles_error > nfiles_total / 2:
                 LOG.error(
-                    "More than half of the Grib files failed upon grib_copy!")
-                raise IOError('Failed running grib_copy on many Grib files')
-
-        if not os.path.exists(nwp_lsmz_filename):
-            LOG.error("No static grib file with land-sea mask and " +
-                      "topography available. Can't prepare NWP data")
-            raise IOError('Failed getting static land-sea mask and topography')
-
-        tmp_result_filename = make_temp_filename()
-        cmd = ('cat ' + tmp_filename + " " +
-               os.path.join(nhsf_path, nhsf_prefix + timeinfo) +
-               " " + nwp_lsmz_filename + " > " + tmp_result_filename)
-        LOG.debug("Add topography and land-sea mask to data:")
-        LOG.debug("Command = " + str(cmd))
-        _start = time.time()
-        retv = os.system(cmd)
-        _end = time.time()
-        LOG.debug("os.system call took: %f seconds", _end - _start)
-        LOG.debug("Returncode = " + str(retv))
-        if retv != 0:
-            LOG.warning("Failed generating nwp file %s ...", result_file)
-            if os.path.exists(tmp_result_filename):
-                os.remove(tmp_result_filename)
-            raise IOError("Failed adding topography and land-sea " +
-                          "mask data to grib file")
-
-        if os.path.exists(tmp_filename):
-            os.remove(tmp_filename)
-        else:
-            LOG.warning("tmp file %s gone! Cannot clean it...", tmp_filename)
-
-        if check_nwp_content(tmp_result_filename):
-            LOG.info('A check of the NWP file content has been attempted: %s',
-                     result_file)
-            _start = time.time()
-            os.rename(tmp_result_filename, result_file)
-            _end = time.time()
-            LOG.debug("Rename file %s to %s: This took %f seconds",
-                      tmp_result_filename, result_file, _end - _start)
+                    "More than half of the Grib files failed to be prepared!")
+                raise IOError('Failed preparing many Grib files')
+
+
+@lru_cache(maxsize=None)
+def get_parser(pattern):
+    """Get the trollsift parser for the filename *pattern*."""
+    return Parser(pattern)
+
+
+def parse_nhsf_filename(filename):
+    """Parse the analysis time, forecast step and time info from the nhsf *filename*.
+
+    Return None if the filename can not be parsed.
+    """
+    if nhsf_file_name_sift is None:
+        raise NwpPrepareError()
+
+    try:
+        parser = get_parser(nhsf_file_name_sift)
+    except NoOptionError as noe:
+        LOG.error("NoOptionError {}".format(noe))
+        return None
+    if not parser.validate(os.path.basename(filename)):
+        LOG.error("Parser validate on filename: {} failed.".format(filename))
+        return None
+    LOG.info("{}".format(os.path.basename(filename)))
+    res = parser.parse("{}".format(os.path.basename(filename)))
+    LOG.info("{}".format(res))
+    if 'analysis_time' in res:
+        if res['analysis_time'].year == 1900:
+            res['analysis_time'] = res['analysis_time'].replace(year=datetime.utcnow().year)
+
+        analysis_time = res['analysis_time']
+    else:
+        raise NwpPrepareError("Can not parse analysis_time in file name. Check config and filename timestamp")
+
+    if 'forecast_time' in res:
+        if res['forecast_time'].year == 1900:
+            res['forecast_time'] = res['forecast_time'].replace(year=datetime.utcnow().year)
+        forecast_time = res['forecast_time']
+        forecast_step = forecast_time - analysis_time
+        forecast_step = int(forecast_step.days * 24 + forecast_step.seconds / 3600)
+        timeinfo = "{:s}{:s}{:s}".format(analysis_time.strftime(
+            "%m%d%H%M"), forecast_time.strftime("%m%d%H%M"), res['end'])
+    else:
+        LOG.info("Can not parse forecast_time in file name. Try forecast step...")
+        # This needs to be done more solid using the sift pattern! FIXME!
+        timeinfo = filename.rsplit("_", 1)[-1]
+        # Forecast step in hours:
+        if 'forecast_step' in res:
+            forecast_step = res['forecast_step']
         else:
-            LOG.warning("Missing important fields. No nwp file %s written to disk",
-                        result_file)
-            if os.path.exists(tmp_result_filename):
-                os.remove(tmp_result_filename)
+            raise NwpPrepareError(
+                'Failed parsing forecast_step in file name. Check config and filename timestamp.')
 
-    return
+    return analysis_time, forecast_step, timeinfo
 
 
-def check_nwp_content(gribfile):
-    """Check the content of the NWP file. If all fields required for PPS is
-    available, then return True
+def get_result_filename(analysis_time, forecast_step):
+    """Get the name of the NWP file prepared for PPS."""
+    timestamp = analysis_time.strftime("%Y%m%d%H%M")
+    return os.path.join(nwp_outdir, nwp_output_prefix + timestamp + "+" + '%.3dH00M' % forecast_step)
+
+
+def get_nwp_step(filename, starttime, nlengths, nhsf_info=None, scene_window=None):
+    """Get the analysis time and forecast step to prepare from the nhsf *filename*.
 
+    Return a dict with the input and output filenames needed to prepare one
+    NWP file for PPS, or None if the file should be skipped. The analysis
+    time, forecast step and time info are parsed from the filename unless
+    already given in *nhsf_info*. If a *scene_window* (start, end) is given,
+    only the lead times covering the scene are kept (see
+    :func:`nwcsafpps_runner.nwp_service.get_scene_lead_times`).
+    """
+    if nhsf_info is None:
+        nhsf_info = parse_nhsf_filename(filename)
+        if nhsf_info is None:
+            return None
+    analysis_time, forecast_step, timeinfo = nhsf_info
+
+    LOG.debug("Analysis time and start time: %s %s", str(analysis_time), str(starttime))
+    if analysis_time < starttime:
+        return None
+    if forecast_step not in nlengths:
+        LOG.debug("Skip step. Forecast step and nlengths: %s %s", str(forecast_step), str(nlengths))
+        return None
+    if scene_window is not None and forecast_step not in get_scene_lead_times(analysis_time, nlengths, scene_window):
+        LOG.debug("Skip step %s, not needed for the scene", str(forecast_step))
+        return None
+
+    LOG.info("timestamp, step: %s %s", analysis_time.strftime("%Y%m%d%H%M"), str(forecast_step))
+    result_file = get_result_filename(analysis_time, forecast_step)
+    if os.path.exists(result_file):
+        LOG.info("File: " + str(result_file) + " already there...")
+        return None
+
+    nhsp_file = os.path.join(nhsp_path, nhsp_prefix + timeinfo)
+    if not os.path.exists(nhsp_file):
+        LOG.warning("Corresponding nhsp-file not there: " + str(nhsp_file))
+        return None
+
+    return {'analysis_time': analysis_time,
+            'forecast_step': forecast_step,
+            'nhsp_file': nhsp_file,
+            'nhsf_file': os.path.join(nhsf_path, nhsf_prefix + timeinfo),
+            'result_file': result_file}
+
+
+def get_nwp_step_settings():
+    """Get the settings needed to prepare any NWP step, to be sent along with the step to the workers."""
+    return {'static_file': nwp_lsmz_filename,
+            'area': nwp_crop_area,
+            'packing': nwp_packing,
+            'required_fields': get_nwp_requirements(),
+            'lock_timeout': nwp_lock_timeout}
+
+
+def run_nwp_steps(nwp_steps, nworkers=1):
+    """Prepare the NWP files for all *nwp_steps*, and yield the outcome of each.
+
+    With more than one worker the steps are prepared concurrently in a pool
+    of processes, started from a fork server. The steps are then sent with
+    all the settings they need (see :func:`get_nwp_step_settings`), the
+    workers not sharing the state of the runner. Each result file is written
+    to a temporary file and renamed into place when ready, so the concurrent
+    steps never see each others partly written output.
+    """
+    if nworkers > 1 and len(nwp_steps) > 1:
+        context = multiprocessing.get_context(NWP_WORKERS_START_METHOD)
+        static_args = (nwp_steps[0]['static_file'], nwp_steps[0]['area'], nwp_steps[0]['packing'])
+        with context.Pool(min(nworkers, len(nwp_steps)), initializer=read_static_fields,
+                          initargs=static_args) as pool:
+            for retv in pool.imap_unordered(prepare_nwp_step, nwp_steps):
+                yield retv
+    else:
+        for nwp_step in nwp_steps:
+            yield prepare_nwp_step(nwp_step)
+
+
+def prepare_nwp_step(nwp_step):
+    """Prepare one NWP grib file for PPS.
+
+    The file is produced under the lock shared with all other processes
+    preparing NWP files (see :mod:`nwcsafpps_runner.nwp_lock`), so it is
+    produced only once. If another process is producing it, wait at most
+    *nwp_lock_timeout_minutes* for it. Return False if the file could not be
+    prepared, otherwise True.
+    """
+    result_file = nwp_step['result_file']
+    try:
+        with NwpOutputLock(result_file, timeout=nwp_step['lock_timeout']) as producer:
+            if not producer:
+                LOG.info("File: " + str(result_file) + " already there...")
+                return True
+            return assemble_nwp_step(nwp_step)
+    except NwpLockTimeout:
+        LOG.exception("Failed getting the nwp file %s! Will continue with the next file", result_file)
+        return False
+
+
+def assemble_nwp_step(nwp_step):
+    """Assemble one NWP grib file for PPS.
+
+    The regular lat-lon fields of the nhsp file, the nhsf file and the static
+    land-sea mask and topography are merged into one file, in one pass over
+    the input files. If the config option *nwp_crop_area* is set, all fields
+    are cropped to that area, and if *nwp_packing* is set the fields are
+    packed accordingly. Return False if the input files could not be
+    read, otherwise True.
     """
+    result_file = nwp_step['result_file']
+    tmp_result_filename = make_temp_filename(prefix=get_temp_prefix(result_file),
+                                             dir=os.path.dirname(result_file))
 
-    with pygrib.open(gribfile) as grbs:
-        entries = []
-        for grb in grbs:
-            entries.append("%s %s %s %s" % (grb['paramId'],
-                                            grb['name'],
-                                            grb['level'],
-                                            grb['typeOfLevel']))
-        entries.sort()
+    LOG.info("result and tmp files: " + str(result_file) + " " + str(tmp_result_filename))
+    _start = time.time()
+    try:
+        missing_fields = assemble_nwp_file(tmp_result_filename, nwp_step['nhsp_file'],
+                                           nwp_step['nhsf_file'], nwp_step['static_file'],
+                                           grid_type='regular_ll', required_fields=nwp_step['required_fields'],
+                                           area=nwp_step['area'], packing=nwp_step['packing'])
+    except (IOError, ValueError, CodesInternalError):
+        LOG.exception("Failed generating nwp file %s! Will continue with the next file",
+                      result_file)
+        if os.path.exists(tmp_result_filename):
+            os.remove(tmp_result_filename)
+        return False
+    _end = time.time()
+    LOG.debug("Assembling the nwp file took: %f seconds", _end - _start)
+
+    for item in missing_fields:
+        LOG.warning("Mandatory field missing in NWP file: %s", str(item))
+
+    if len(missing_fields) == 0:
+        LOG.info('A check of the NWP file content has been attempted: %s',
+                 result_file)
+        _start = time.time()
+        os.rename(tmp_result_filename, result_file)
+        _end = time.time()
+        LOG.debug("Rename file %s to %s: This took %f seconds",
+                  tmp_result_filename, result_file, _end - _start)
+    else:
+        LOG.warning("Missing important fields. No nwp file %s written to disk",
+                    result_file)
+        if os.path.exists(tmp_result_filename):
+            os.remove(tmp_result_filename)
 
+    return True
+
+
+def get_nwp_requirements():
+    """Get the fields required by PPS, or None if the requirements file can not be read."""
     try:
-        with open(nwp_req_filename, 'r') as fpt:
-            lines = fpt.readlines()
-    except IOError:
+        return read_nwp_requirements(nwp_req_filename)
+    except (IOError, TypeError):
         LOG.exception(
             "Failed reading nwp-requirements file: %s", nwp_req_filename)
         LOG.warning("Cannot check if NWP files is ok!")
-        return True
+        return None
 
-    srplines = [ll.strip('M ').strip('\n')
-                for ll in lines if str(ll).startswith('M')]
 
-    file_ok = True
-    for item in srplines:
-        if item not in entries:
-            LOG.warning("Mandatory field missing in NWP file: %s", str(item))
-            file_ok = False
+def check_nwp_content(gribfile):
+    """Check the content of the NWP file. If all fields required for PPS is
+    available, then return True
+
+    Only the headers of the GRIB messages are read.
+    """
+
+    missing_fields = get_missing_nwp_fields(gribfile)
+    if missing_fields is None:
+        return True
 
-    if file_ok:
+    for item in missing_fields:
+        LOG.warning("Mandatory field missing in NWP file: %s", str(item))
+
+    if len(missing_fields) == 0:
         LOG.info("NWP file has all required fields for PPS: %s", gribfile)
+        return True
+
+    return False
+
+
+def get_missing_nwp_fields(gribfile):
+    """Get a report of the fields required by PPS that are missing in the NWP file.
+
+    Return a list of dicts with the paramId, name, level and typeOfLevel of
+    the missing fields, or None if the requirements are not known.
+    """
+    required_fields = get_nwp_requirements()
+    if required_fields is None:
+        return None
 
-    return file_ok
+    return get_missing_fields(get_grib_entries(gribfile), required_fields)
 
 
 if __name__ == "__main__":
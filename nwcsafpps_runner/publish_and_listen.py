@@ -33,6 +33,28 @@ import logging
 LOG = logging.getLogger(__name__)
 
 
+def check_message(msg):
+    """Check if the *msg* is on level-1 data of a scene PPS can process."""
+    if not msg:
+        return False
+
+    if ('platform_name' not in msg.data or
+            'start_time' not in msg.data):
+        LOG.warning("Message is lacking crucial fields...")
+        return False
+    #: Orbit_number not needed for seviri
+    if (msg.data['platform_name'] not in SUPPORTED_METEOSAT_SATELLITES):
+        if ('orbit_number' not in msg.data):
+            LOG.warning("Message is lacking crucial fields...")
+            return False
+    if (msg.data['platform_name'] not in SUPPORTED_PPS_SATELLITES):
+        LOG.info(str(msg.data['platform_name']) + ": " +
+                 "Not a NOAA/Metop/S-NPP/Terra/Aqua scene. Continue...")
+        return False
+
+    return True
+
+
 class FileListener(threading.Thread):
 
     def __init__(self, queue, subscribe_topics):
@@ -62,25 +84,35 @@ class FileListener(threading.Thread):
                     self.queue.put(msg)
 
     def check_message(self, msg):
+        return check_message(msg)
 
-        if not msg:
-            return False
 
-        if ('platform_name' not in msg.data or
-                'start_time' not in msg.data):
-            LOG.warning("Message is lacking crucial fields...")
-            return False
-        #: Orbit_number not needed for seviri
-        if (msg.data['platform_name'] not in SUPPORTED_METEOSAT_SATELLITES):
-            if ('orbit_number' not in msg.data):
-                LOG.warning("Message is lacking crucial fields...")
-                return False
-        if (msg.data['platform_name'] not in SUPPORTED_PPS_SATELLITES):
-            LOG.info(str(msg.data['platform_name']) + ": " +
-                     "Not a NOAA/Metop/S-NPP/Terra/Aqua scene. Continue...")
-            return False
+class NwpListener(threading.Thread):
+    """A listener for messages on new NWP data, triggering the NWP preparation."""
+
+    def __init__(self, nwp_service, subscribe_topics):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.loop = True
+        self.nwp_service = nwp_service
+        self.subscribe_topics = subscribe_topics
+
+    def stop(self):
+        """Stops the NWP listener."""
+        self.loop = False
+
+    def run(self):
 
-        return True
+        LOG.debug("NWP subscribe topics = %s", str(self.subscribe_topics))
+        with posttroll.subscriber.Subscribe("", self.subscribe_topics, True) as subscr:
+
+            for msg in subscr.recv(timeout=90):
+                if not self.loop:
+                    break
+                if msg:
+                    LOG.info("Message on new NWP data. Trigger the NWP preparation...")
+                    LOG.debug("Message = " + str(msg))
+                    self.nwp_service.trigger()
 
 
 class FilePublisher(threading.Thread):
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Admitting the scenes to be processed within the memory and CPU budgets.
+
+The memory (RSS) and CPU time of the PPS processes of every scene being
+processed, with all their child processes, are sampled from /proc. When a
+scene is done, its peak memory and mean number of cores used update the
+cost estimates of its platform, as exponentially weighted moving averages.
+A new scene is admitted only if the memory and CPU projected from these
+estimates stay within the budgets, and the memory within what the host has
+available. The admission only looks at the last sample, so it never reads
+/proc itself.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+PROC_DIR = '/proc'
+
+#: Clock ticks per second of the CPU times in /proc/<pid>/stat
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def read_loadavg(proc_dir=PROC_DIR):
+    """Get the 1 minute load average of the host, None if unknown."""
+    try:
+        with open(os.path.join(proc_dir, 'loadavg')) as fpt:
+            return float(fpt.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_available_memory(proc_dir=PROC_DIR):
+    """Get the memory available on the host in bytes, None if unknown."""
+    try:
+        with open(os.path.join(proc_dir, 'meminfo')) as fpt:
+            for line in fpt:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def read_process_rss(pid, proc_dir=PROC_DIR):
+    """Get the resident memory of the process *pid* in bytes, 0 if gone."""
+    try:
+        with open(os.path.join(proc_dir, str(pid), 'status')) as fpt:
+            for line in fpt:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def read_process_stat(pid, proc_dir=PROC_DIR):
+    """Get the parent pid, the CPU time in seconds and the CPU time of the waited for children of *pid*.
+
+    Return None if the process is gone.
+    """
+    try:
+        with open(os.path.join(proc_dir, str(pid), 'stat')) as fpt:
+            content = fpt.read()
+        fields = content[content.rindex(')') + 2:].split()
+        return (int(fields[1]), (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+                (int(fields[13]) + int(fields[14])) / CLOCK_TICKS)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_process_table(proc_dir=PROC_DIR):
+    """Get the stats of all processes (see :func:`read_process_stat`) by pid."""
+    stats = {}
+    for name in os.listdir(proc_dir):
+        if name.isdigit():
+            stat = read_process_stat(name, proc_dir)
+            if stat is not None:
+                stats[int(name)] = stat
+    return stats
+
+
+def get_process_tree(pids, stats):
+    """Get the processes *pids* still running and all their descendants, from the process *stats*."""
+    children = {}
+    for pid, stat in stats.items():
+        children.setdefault(stat[0], []).append(pid)
+    tree = set()
+    todo = [pid for pid in pids if pid in stats]
+    while todo:
+        pid = todo.pop()
+        if pid not in tree:
+            tree.add(pid)
+            todo.extend(children.get(pid, []))
+    return tree
+
+
+class JobUsage(object):
+    """The resources used by the processes of a scene being processed, since its first process started."""
+
+    __slots__ = ('platform_name', 'pids', 'started', 'rss', 'peak_rss', 'cpu_time')
+
+    def __init__(self, platform_name):
+        self.platform_name = platform_name
+        self.pids = set()
+        self.started = None
+        self.rss = 0
+        self.peak_rss = 0
+        self.cpu_time = 0.0
+
+
+class ResourceMonitor(threading.Thread):
+    """Sample the resources used by the scenes every *interval* seconds, and admit new scenes.
+
+    The projected memory of the scenes is kept under *memory_budget* bytes,
+    and their projected number of cores, or the load of the host if higher,
+    under *cpu_budget*. Platforms without a cost estimate yet are expected
+    to use *default_memory* bytes and *default_cpu* cores. The estimates are
+    updated with the weight *alpha* for the last scene.
+    """
+
+    def __init__(self, memory_budget=None, cpu_budget=None, default_memory=2e9, default_cpu=1.0,
+                 alpha=0.3, interval=10, proc_dir=PROC_DIR):
+        threading.Thread.__init__(self, name='ResourceMonitor')
+        self.daemon = True
+        self.loop = True
+        self.memory_budget = memory_budget
+        self.cpu_budget = cpu_budget
+        self.default_memory = default_memory
+        self.default_cpu = default_cpu
+        self.alpha = alpha
+        self.interval = interval
+        self.proc_dir = proc_dir
+        self.estimates = {}
+        #: The load and memory available of the host at the last sample, None if unknown
+        self.load = None
+        self.available_memory = None
+        self._jobs = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Stop the sampling."""
+        self.loop = False
+        self._stopped.set()
+
+    def run(self):
+        """Sample the resources used until stopped."""
+        while self.loop:
+            try:
+                self.sample()
+            except Exception:
+                LOG.exception("Something went wrong sampling the resources used...")
+            self._stopped.wait(self.interval)
+
+    def start_job(self, job_id, platform_name):
+        """Start following the resources of the scene *job_id*, processed in the current thread."""
+        with self._lock:
+            self._jobs[job_id] = JobUsage(platform_name)
+            self._threads[threading.get_ident()] = job_id
+
+    def add_process(self, pid):
+        """Follow the process *pid*, and its children, started for the scene processed in the current thread."""
+        self.process_adder()(pid)
+
+    def process_adder(self):
+        """Get the function following a process, and its children, for the scene processed in the current thread.
+
+        The function can be called from any thread, like those running the
+        PGEs of the scene.
+        """
+        with self._lock:
+            job_id = self._threads.get(threading.get_ident())
+        return functools.partial(self._add_job_process, job_id)
+
+    def _add_job_process(self, job_id, pid):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if job.started is None:
+                    job.started = time.monotonic()
+                job.pids.add(pid)
+
+    def finish_job(self, job_id):
+        """Stop following the scene *job_id*, and update the cost estimates of its platform.
+
+        The processes of the scene being done, the estimates are updated
+        from the last sample taken while they were running.
+        """
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            for ident in [ident for ident, value in self._threads.items() if value == job_id]:
+                del self._threads[ident]
+        if job is None or job.started is None or not job.peak_rss:
+            return
+        wall_time = time.monotonic() - job.started
+        cpu = job.cpu_time / wall_time if wall_time > 0 else self.default_cpu
+        memory, cores = self.get_estimate(job.platform_name)
+        if job.platform_name in self.estimates:
+            memory = (1 - self.alpha) * memory + self.alpha * job.peak_rss
+            cores = (1 - self.alpha) * cores + self.alpha * cpu
+        else:
+            memory, cores = job.peak_rss, cpu
+        self.estimates[job.platform_name] = (memory, cores)
+        LOG.debug("Scene %s used %.2f GB and %.1f cores, estimates for %s now %.2f GB and %.1f cores",
+                  str(job_id), job.peak_rss / 1e9, cpu, job.platform_name, memory / 1e9, cores)
+
+    def get_estimate(self, platform_name):
+        """Get the estimated peak memory in bytes and number of cores used by a scene of *platform_name*."""
+        return self.estimates.get(platform_name, (self.default_memory, self.default_cpu))
+
+    def sample(self):
+        """Sample the load and memory available of the host, and the memory and CPU time used by the scenes."""
+        load = read_loadavg(self.proc_dir)
+        available_memory = read_available_memory(self.proc_dir)
+        with self._lock:
+            self.load = load
+            self.available_memory = available_memory
+            jobs = list(self._jobs.values())
+        pids = set()
+        for job in jobs:
+            pids |= job.pids
+        if not pids:
+            return
+        stats = read_process_table(self.proc_dir)
+        for job in jobs:
+            tree = get_process_tree(job.pids, stats)
+            rss = sum(read_process_rss(pid, self.proc_dir) for pid in tree)
+            # The CPU time of the children already waited for is only in their parents
+            cpu_time = sum(stats[pid][1] + (stats[pid][2] if pid in job.pids else 0) for pid in tree)
+            job.rss = rss
+            job.peak_rss = max(job.peak_rss, rss)
+            job.cpu_time = max(job.cpu_time, cpu_time)
+
+    def can_admit(self, platform_name):
+        """Check if a scene of *platform_name* can start within the budgets.
+
+        A scene is always admitted when no other is being processed. Only
+        the last sample of the host and of the scenes is looked at.
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+            load = self.load or 0.0
+            available = self.available_memory
+        if not jobs:
+            return True
+        memory, cores = self.get_estimate(platform_name)
+        committed_memory = 0
+        growth = 0
+        committed_cores = 0.0
+        for job in jobs:
+            job_memory, job_cores = self.get_estimate(job.platform_name)
+            committed_memory += max(job.rss, job_memory)
+            growth += max(0, job_memory - job.rss)
+            committed_cores += job_cores
+
+        if self.memory_budget is not None and committed_memory + memory > self.memory_budget:
+            LOG.debug("Projected memory %.2f GB over the budget", (committed_memory + memory) / 1e9)
+            return False
+        if available is not None and available - growth < memory:
+            LOG.debug("Not enough memory available for a %s scene", platform_name)
+            return False
+        if self.cpu_budget is not None and max(load, committed_cores) + cores > self.cpu_budget:
+            LOG.debug("Projected load %.1f over the CPU budget", max(load, committed_cores) + cores)
+            return False
+        return True
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Gathering the level-1 files of the scenes to be processed by PPS.
+
+The files announced in the posttroll messages are collected per scene until
+the scene is complete. Scenes never completed, because of missing
+microwave data or dropped granules, are forgotten after a while.
+
+The files of one pass may come with slightly different start times, and
+even orbit numbers, from different sensors or processing chains. They are
+joined to the same scene if within a tolerance (see :class:`SceneIndex`).
+
+In the VIIRS SDR granule processing, consecutive granules of one orbit may
+be gathered in batches, each processed by one PPS run.
+
+The same pass may be received more than once, from different sources or
+resent. The scenes and files already processed are remembered for a while,
+so the pass is not processed again (see :class:`ProcessedScenes`).
+"""
+
+import calendar
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from nwcsafpps_runner.utils import (REQUIRED_MW_SENSORS, SUPPORTED_EOS_SATELLITES, SUPPORTED_JPSS_SATELLITES,
+                                    SUPPORTED_METOP_SATELLITES, SUPPORTED_NOAA_SATELLITES,
+                                    get_sceneid)
+
+LOG = logging.getLogger(__name__)
+
+
+def get_required_sensors(platform_name):
+    """Get the sensors PPS needs data from for a scene of *platform_name*.
+
+    Only the NOAA and Metop scenes need more than the imager, namely the
+    microwave sensors of :data:`nwcsafpps_runner.utils.REQUIRED_MW_SENSORS`.
+    """
+    if platform_name in SUPPORTED_NOAA_SATELLITES or platform_name in SUPPORTED_METOP_SATELLITES:
+        return {'avhrr/3'} | set(REQUIRED_MW_SENSORS[platform_name])
+    return set()
+
+
+def get_required_nfiles(platform_name):
+    """Get the least number of level-1 files needed for a scene of *platform_name*.
+
+    MODIS scenes need both the geolocation and the 1km data files.
+    """
+    if platform_name in SUPPORTED_EOS_SATELLITES:
+        return 2
+    return 1
+
+
+class SceneRecord(object):
+    """The level-1 files of one scene gathered so far.
+
+    The *files* are kept in a dict, used as an ordered set, so a file
+    announced twice is only counted once. If a *batch_size* is given, the
+    record is a batch of granules, complete when it holds *batch_size*
+    granules and spanning the time of all of them. The *message* is the
+    last message received for the scene.
+    """
+
+    __slots__ = ('sceneid', 'platform_name', 'orbit_number', 'starttime', 'endtime', 'files', 'missing_sensors',
+                 'nfiles_required', 'granules', 'batch_size', 'message', 'created', 'last_update')
+
+    def __init__(self, sceneid, platform_name, orbit_number, starttime, now=None, batch_size=None):
+        self.sceneid = sceneid
+        self.platform_name = platform_name
+        self.orbit_number = orbit_number
+        self.starttime = starttime
+        self.endtime = None
+        self.files = {}
+        self.missing_sensors = get_required_sensors(platform_name)
+        self.nfiles_required = get_required_nfiles(platform_name)
+        self.granules = set()
+        self.batch_size = batch_size
+        self.message = None
+        self.created = time.time() if now is None else now
+        self.last_update = self.created
+
+    def __repr__(self):
+        return "SceneRecord(%s, %d files, missing %s)" % (self.sceneid, len(self.files),
+                                                          sorted(self.missing_sensors))
+
+    def add(self, sensor, filenames, now=None, starttime=None, endtime=None, message=None):
+        """Add the level-1 *filenames* with data from the *sensor*.
+
+        The *starttime* and *endtime* are those of the granule the files
+        belong to, if known.
+        """
+        for filename in filenames:
+            self.files[filename] = None
+        self.missing_sensors.discard(sensor)
+        self.granules.add(starttime)
+        if self.batch_size is not None and isinstance(starttime, datetime) and starttime < self.starttime:
+            self.starttime = starttime
+        if isinstance(endtime, datetime) and (self.endtime is None or endtime > self.endtime):
+            self.endtime = endtime
+        if message is not None:
+            self.message = message
+        self.last_update = time.time() if now is None else now
+
+    def is_complete(self):
+        """Check if the files of all sensors, and all granules of a batch, needed by PPS are there."""
+        return (not self.missing_sensors and len(self.files) >= self.nfiles_required and
+                (self.batch_size is None or len(self.granules) >= self.batch_size))
+
+
+class SceneIndex(object):
+    """Find the scene of a pass from its platform, orbit number and start time, within a tolerance.
+
+    A scene matches if on the same platform, with an orbit number at most
+    *orbit_tolerance* off, and a start time less than *time_tolerance*
+    seconds off. The closest in time of the matching scenes is taken. The
+    scenes are put in buckets of *time_tolerance* seconds of start time, so
+    a lookup only looks at the scenes of three buckets.
+    """
+
+    def __init__(self, time_tolerance=300, orbit_tolerance=1):
+        self.time_tolerance = time_tolerance
+        self.orbit_tolerance = orbit_tolerance
+        self._buckets = {}
+        self._keys = {}
+
+    def _get_bucket(self, starttime):
+        return int(calendar.timegm(starttime.utctimetuple()) // self.time_tolerance)
+
+    def add(self, record):
+        """Add the scene of the :class:`SceneRecord` *record*."""
+        if record.starttime is None:
+            return
+        key = (record.platform_name, self._get_bucket(record.starttime))
+        self._buckets.setdefault(key, []).append(record)
+        self._keys[record.sceneid] = key
+
+    def remove(self, record):
+        """Remove the scene of the :class:`SceneRecord` *record*."""
+        key = self._keys.pop(record.sceneid, None)
+        if key is None:
+            return
+        bucket = self._buckets[key]
+        bucket.remove(record)
+        if not bucket:
+            del self._buckets[key]
+
+    def find(self, platform_name, orbit_number, starttime):
+        """Find the :class:`SceneRecord` of the scene matching the pass, or None."""
+        if starttime is None:
+            return None
+        tolerance = timedelta(seconds=self.time_tolerance)
+        bucket = self._get_bucket(starttime)
+        best = None
+        for key in range(bucket - 1, bucket + 2):
+            for record in self._buckets.get((platform_name, key), []):
+                if abs(record.orbit_number - orbit_number) > self.orbit_tolerance:
+                    continue
+                offset = abs(record.starttime - starttime)
+                if offset < tolerance and (best is None or offset < abs(best.starttime - starttime)):
+                    best = record
+        return best
+
+
+class SceneAssembler(object):
+    """The level-1 files of all scenes not yet processed, by scene id.
+
+    Scenes not updated for *expiry* seconds are dropped and reported by
+    :meth:`expire`. The scenes are kept in the order of their last update,
+    so finding the expired ones only looks at those. Passes with start
+    times within *time_tolerance* seconds and orbit numbers within
+    *orbit_tolerance* are joined to the same scene (see
+    :meth:`get_sceneid`).
+
+    If a *batch_size* larger than one, or a *batch_wait*, is given, the
+    VIIRS granules of one orbit are gathered in batches. A batch is complete
+    with *batch_size* granules, or is taken by :meth:`pop_waited_batches`
+    *batch_wait* seconds after its first granule arrived.
+    """
+
+    def __init__(self, expiry=3 * 3600, time_tolerance=300, orbit_tolerance=1, batch_size=1, batch_wait=None):
+        self.expiry = expiry
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._scenes = OrderedDict()
+        self._index = SceneIndex(time_tolerance, orbit_tolerance)
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def _is_batched(self, platform_name):
+        return (self.batch_size > 1 or self.batch_wait is not None) and platform_name in SUPPORTED_JPSS_SATELLITES
+
+    def _forget(self, record):
+        self._index.remove(record)
+        if self._batches.get((record.platform_name, record.orbit_number)) is record:
+            del self._batches[(record.platform_name, record.orbit_number)]
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def __contains__(self, sceneid):
+        return sceneid in self._scenes
+
+    def __getitem__(self, sceneid):
+        return self._scenes[sceneid]
+
+    def get_sceneid(self, platform_name, orbit_number, starttime):
+        """Get the id of the scene the pass belongs to.
+
+        This is the id of the scene gathered matching the pass, if any,
+        otherwise a new scene id made from the pass (see
+        :func:`nwcsafpps_runner.utils.get_sceneid`).
+        """
+        with self._lock:
+            if self._is_batched(platform_name):
+                record = self._batches.get((platform_name, orbit_number))
+            else:
+                record = self._index.find(platform_name, orbit_number, starttime)
+        if record is not None:
+            return record.sceneid
+        return get_sceneid(platform_name, orbit_number, starttime)
+
+    def add(self, sceneid, platform_name, orbit_number, starttime, sensor, filenames, now=None,
+            endtime=None, message=None):
+        """Add the level-1 *filenames* with data from the *sensor* to the scene *sceneid*.
+
+        *starttime* and *endtime* are those of the pass, or granule, and
+        *message* the message announcing the files. Return the
+        :class:`SceneRecord` of the scene.
+        """
+        with self._lock:
+            record = self._scenes.get(sceneid)
+            if record is None:
+                if self._is_batched(platform_name):
+                    record = SceneRecord(sceneid, platform_name, orbit_number, starttime, now, self.batch_size)
+                    self._batches[(platform_name, orbit_number)] = record
+                else:
+                    record = SceneRecord(sceneid, platform_name, orbit_number, starttime, now)
+                    self._index.add(record)
+                self._scenes[sceneid] = record
+            else:
+                self._scenes.move_to_end(sceneid)
+            record.add(sensor, filenames, now, starttime, endtime, message)
+        return record
+
+    def pop(self, sceneid, default=None):
+        """Remove the scene *sceneid*, and return its :class:`SceneRecord`."""
+        with self._lock:
+            record = self._scenes.pop(sceneid, None)
+            if record is None:
+                return default
+            self._forget(record)
+            return record
+
+    def pop_waited_batches(self, now=None):
+        """Remove the batches of granules waited for long enough, and return their records."""
+        if self.batch_wait is None:
+            return []
+        if now is None:
+            now = time.time()
+        with self._lock:
+            waited = [record for record in self._batches.values() if now - record.created >= self.batch_wait]
+            for record in waited:
+                del self._scenes[record.sceneid]
+                self._forget(record)
+        for record in waited:
+            LOG.info("Batch %s waited for %d seconds, process its %d granules", record.sceneid,
+                     now - record.created, len(record.granules))
+        return waited
+
+    def expire(self, now=None):
+        """Drop the scenes not updated for the expiry time, and return their records."""
+        if now is None:
+            now = time.time()
+        expired = []
+        with self._lock:
+            while self._scenes:
+                record = next(iter(self._scenes.values()))
+                if now - record.last_update < self.expiry:
+                    break
+                expired.append(self._scenes.popitem(last=False)[1])
+                self._forget(expired[-1])
+        for record in expired:
+            LOG.warning("Scene %s never completed, dropping its %d level-1 files. Missing sensors: %s",
+                        record.sceneid, len(record.files), ', '.join(sorted(record.missing_sensors)) or 'none')
+        return expired
+
+
+#: Policies for a pass received again after being processed: drop it, or
+#: process it again if it has more files than when processed
+DUPLICATE_POLICIES = ('drop', 'most_files')
+
+
+def get_message_uids(msg):
+    """Get the uids of the files in the file, dataset or collection message *msg*."""
+    if msg.type == 'file':
+        return [msg.data.get('uid') or os.path.basename(msg.data['uri'])]
+    if msg.type == 'dataset':
+        datasets = [msg.data['dataset']]
+    elif msg.type == 'collection':
+        datasets = [item['dataset'] for item in msg.data['collection'] if 'dataset' in item]
+    else:
+        return []
+    return [obj.get('uid') or os.path.basename(obj['uri']) for dataset in datasets for obj in dataset]
+
+
+#: A pass processed, indexed in the :class:`SceneIndex` of the :class:`ProcessedScenes`
+ProcessedPass = namedtuple('ProcessedPass', ['sceneid', 'platform_name', 'orbit_number', 'starttime'])
+
+
+class ProcessedScenes(object):
+    """The scenes and level-1 files processed lately, to catch the passes received again.
+
+    At most *maxsize* scenes are remembered, for *ttl* seconds, the least
+    recently processed being forgotten first. Files already processed are
+    never processed again. Besides, a scene matches a processed one as the
+    files of a pass match a scene of the :class:`SceneAssembler`: on the same
+    platform, with an orbit number at most *orbit_tolerance* off and a start
+    time less than *time_tolerance* seconds off (see :class:`SceneIndex`).
+    With the *policy* 'drop' a processed scene is not
+    processed again, with 'most_files' it is if more level-1 files are
+    gathered than when it was processed. Batches of granules are only
+    matched by their files.
+    """
+
+    def __init__(self, maxsize=1000, ttl=12 * 3600, time_tolerance=300, orbit_tolerance=1, policy='drop'):
+        if policy not in DUPLICATE_POLICIES:
+            raise ValueError("Unknown duplicate policy %s, should be one of %s" % (policy, str(DUPLICATE_POLICIES)))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.policy = policy
+        self._scenes = OrderedDict()
+        self._passes = SceneIndex(time_tolerance, orbit_tolerance)
+        self._uids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def _forget(self, key):
+        _, uids, _ = self._scenes.pop(key)
+        for uid in uids:
+            if self._uids.get(uid) == key:
+                del self._uids[uid]
+        self._passes.remove(ProcessedPass(key, *key))
+
+    def _prune(self, now):
+        while self._scenes:
+            key, (_, _, processed) = next(iter(self._scenes.items()))
+            if len(self._scenes) <= self.maxsize and now - processed < self.ttl:
+                break
+            self._forget(key)
+
+    def _find(self, platform_name, orbit_number, starttime):
+        processed_pass = self._passes.find(platform_name, orbit_number, starttime)
+        if processed_pass is None:
+            return None
+        return self._scenes[processed_pass.sceneid]
+
+    def _all_processed(self, uids):
+        return bool(uids) and all(uid in self._uids for uid in uids)
+
+    def add(self, record, now=None):
+        """Remember the scene of the :class:`SceneRecord` *record* as processed."""
+        if now is None:
+            now = time.time()
+        uids = frozenset(os.path.basename(filename) for filename in record.files)
+        key = (record.platform_name, record.orbit_number, record.starttime)
+        with self._lock:
+            if key in self._scenes:
+                self._forget(key)
+            self._scenes[key] = (len(record.files), uids, now)
+            for uid in uids:
+                self._uids[uid] = key
+            if record.batch_size is None:
+                self._passes.add(ProcessedPass(key, *key))
+            self._prune(now)
+
+    def forget(self, record):
+        """Forget the scene of the :class:`SceneRecord` *record*, not processed after all, to process it again."""
+        key = (record.platform_name, record.orbit_number, record.starttime)
+        with self._lock:
+            if key in self._scenes:
+                self._forget(key)
+
+    def run(self, record, func, *args):
+        """Process the scene of the :class:`SceneRecord` *record* by calling *func* with *args*.
+
+        The scene is forgotten if *func* raises or returns False, so that
+        the scene received again is processed again.
+        """
+        try:
+            done = func(*args)
+        except Exception:
+            self.forget(record)
+            raise
+        if done is False:
+            LOG.warning("Processing of the scene %s failed, it will be processed again if received again",
+                        record.sceneid)
+            self.forget(record)
+        return done
+
+    def is_duplicate(self, msg, now=None):
+        """Check if the level-1 files of the message *msg* were processed already.
+
+        With the 'drop' policy, any file of a processed scene is a duplicate.
+        """
+        if now is None:
+            now = time.time()
+        uids = get_message_uids(msg)
+        with self._lock:
+            self._prune(now)
+            if self._all_processed(uids):
+                return True
+            if self.policy != 'drop':
+                return False
+            return self._find(msg.data.get('platform_name'), int(msg.data.get('orbit_number', 99999)),
+                              msg.data.get('start_time')) is not None
+
+    def should_process(self, record, now=None):
+        """Check if the complete scene of the :class:`SceneRecord` *record* should be processed.
+
+        It should unless processed already, with as many files when the
+        policy is 'most_files'.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._prune(now)
+            if self._all_processed([os.path.basename(filename) for filename in record.files]):
+                return False
+            entry = None
+            if record.batch_size is None:
+                entry = self._find(record.platform_name, record.orbit_number, record.starttime)
+        if entry is None:
+            return True
+        return self.policy == 'most_files' and len(record.files) > entry[0]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Scheduling the scenes to be processed by PPS.
+
+The scenes ready to be processed wait in a priority queue, and a fixed
+number of workers take the most urgent one whenever free: the scenes of the
+platforms with the highest priority first, and among those the freshest.
+When more scenes are waiting than the workers can take, the scenes older
+than a maximum age are deferred until no fresh scene is waiting, or dropped.
+"""
+
+import calendar
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta
+
+from nwcsafpps_runner.executor import Job, JobExecutor
+
+LOG = logging.getLogger(__name__)
+
+#: Policies for the stale scenes when the workers are all busy: process them
+#: after the fresh ones, or not at all
+STALE_POLICIES = ('defer', 'drop')
+
+
+def get_platform_priorities(value):
+    """Get the priorities of the platforms from the config *value*.
+
+    The priorities are given as a list, or a comma separated string, of
+    platform:priority items, a higher priority being processed first.
+    Platforms not listed have priority 0.
+    """
+    if value is None:
+        return {}
+    if isinstance(value, str):
+        value = value.split(',')
+    priorities = {}
+    for item in value:
+        platform_name, _, priority = str(item).strip().rpartition(':')
+        if not platform_name:
+            raise ValueError("The platform priority should be given as platform:priority: %s" % str(item))
+        priorities[platform_name] = int(priority)
+    return priorities
+
+
+def get_priority_key(priorities, platform_name, starttime):
+    """Get the key ordering the scenes by the *priorities* of their platforms, and then newest first."""
+    timestamp = calendar.timegm(starttime.utctimetuple()) if isinstance(starttime, datetime) else 0
+    return (-priorities.get(platform_name, 0), -timestamp)
+
+
+class SceneJob(Job):
+    """A scene waiting to be processed by calling *func* with *args*."""
+
+    __slots__ = ('platform_name', 'starttime', 'stale')
+
+    def __init__(self, job_id, platform_name, starttime, func, args, on_drop=None):
+        super(SceneJob, self).__init__(job_id, func, args, on_drop)
+        self.platform_name = platform_name
+        self.starttime = starttime
+        self.stale = False
+
+
+class SceneScheduler(JobExecutor):
+    """Process the scenes with *nworkers* workers, the most urgent first.
+
+    The *priorities* are the priorities of the platforms (see
+    :func:`get_platform_priorities`). Scenes older than *max_age* seconds
+    are stale: when the workers are all busy, they are deferred after the
+    fresh scenes, or dropped, depending on the *stale_policy*. At most
+    *max_pending* scenes wait in the queue, and the scenes are run by the
+    *backend*, with their results put in the *results* queue if given (see
+    :class:`nwcsafpps_runner.executor.JobExecutor`). If a *resources*
+    monitor (a :class:`nwcsafpps_runner.resources.ResourceMonitor`) is
+    given, the most urgent scene starts only once admitted by the monitor.
+    """
+
+    def __init__(self, nworkers=1, priorities=None, max_age=None, stale_policy='defer',
+                 max_pending=None, backend='thread', results=None, resources=None):
+        if stale_policy not in STALE_POLICIES:
+            raise ValueError("Unknown stale scene policy %s, should be one of %s" %
+                             (stale_policy, str(STALE_POLICIES)))
+        super(SceneScheduler, self).__init__(nworkers, max_pending=max_pending, backend=backend,
+                                             results=results)
+        self.priorities = priorities or {}
+        self.max_age = max_age
+        self.stale_policy = stale_policy
+        self._queue = []
+        self._counter = itertools.count()
+        self.resources = resources
+        if resources is not None:
+            self.retry_interval = resources.interval
+
+    def is_stale(self, starttime, now=None):
+        """Check if the scene starting at *starttime* is older than the maximum age."""
+        if self.max_age is None or not isinstance(starttime, datetime):
+            return False
+        if now is None:
+            now = datetime.utcnow()
+        return now - starttime > timedelta(seconds=self.max_age)
+
+    def submit(self, job_id, scene, func, args=(), now=None, timeout=None, on_drop=None):
+        """Queue the *scene* to be processed by calling *func* with *args*.
+
+        Return False if a job with the same *job_id* is already waiting or
+        running, if the scene is dropped as stale, or if the queue stays
+        full for *timeout* seconds. If the scene is dropped as stale while
+        waiting, *on_drop* is called, if given.
+        """
+        job = SceneJob(job_id, scene['platform_name'], scene['starttime'], func, args, on_drop)
+        job.stale = self.is_stale(job.starttime, now)
+        return self._enqueue(job, timeout)
+
+    def _admit(self, job):
+        if not job.stale or not self._is_saturated():
+            job.stale = False
+            return True
+        if self.stale_policy == 'drop':
+            LOG.warning("Drop the stale scene %s, all workers are busy", str(job.job_id))
+            return False
+        LOG.info("Defer the stale scene %s until no fresh scene is waiting", str(job.job_id))
+        return True
+
+    def _push(self, job):
+        key = ((job.stale,) + get_priority_key(self.priorities, job.platform_name, job.starttime) +
+               (next(self._counter),))
+        heapq.heappush(self._queue, (key, job))
+
+    def _pop(self):
+        """Get the most urgent scene, shedding the scenes gone stale while waiting.
+
+        Return None if the resources are not available for the most urgent
+        scene yet, as of the last sample of the resource monitor.
+        """
+        while self._queue:
+            if self.resources is not None and not self.resources.can_admit(self._queue[0][1].platform_name):
+                return None
+            _, job = heapq.heappop(self._queue)
+            if not job.stale and self._queue and self.is_stale(job.starttime):
+                if self.stale_policy == 'drop':
+                    LOG.warning("Drop the stale scene %s, more scenes are waiting", str(job.job_id))
+                    self._drop(job)
+                    continue
+                job.stale = True
+                self._push(job)
+                continue
+            if self.resources is not None:
+                # Followed from now on, for the next admissions to count it
+                self.resources.start_job(job.job_id, job.platform_name)
+            return job
+        return None
+
+    def _run(self, job):
+        if self.resources is None:
+            return super(SceneScheduler, self)._run(job)
+        try:
+            return super(SceneScheduler, self)._run(job)
+        finally:
+            self.resources.finish_job(job.job_id)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the processing of the scenes in one event loop.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from nwcsafpps_runner.async_engine import (AsyncScheduler, QueuePublisher, receive_messages, run_process,
+                                           wait_until_nwp_ready)
+
+NOW = datetime.utcnow()
+
+
+class FakeNwpService(object):
+    """An NWP preparation service getting ready after *delay* seconds, once asked for the data."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.asked = []
+        self.ready_at = None
+
+    def ask_for(self, starttime, endtime=None):
+        self.asked.append((starttime, endtime))
+        self.ready_at = time.monotonic() + self.delay
+
+    def is_ready(self, starttime, endtime=None):
+        return self.ready_at is not None and time.monotonic() >= self.ready_at
+
+
+class FakePublisher(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class FakeSubscribe(object):
+    """A posttroll subscriber recording the threads it is used from."""
+
+    def __init__(self, *args):
+        self.threads = set()
+        FakeSubscribe.instance = self
+
+    def __enter__(self):
+        self.threads.add(threading.get_ident())
+        return self
+
+    def __exit__(self, *args):
+        self.threads.add(threading.get_ident())
+
+    def recv(self, timeout=None):
+        msg = MagicMock(data={'platform_name': 'NOAA-19', 'orbit_number': 62345, 'start_time': NOW})
+        for item in [None, msg]:
+            self.threads.add(threading.get_ident())
+            yield item
+
+
+def test_receive_messages():
+    """Test receiving the messages from one thread of its own, not held up by the default executor."""
+    blocker = threading.Event()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        # All the default executor threads busy, as with blocking NWP preparations
+        busy = [loop.run_in_executor(None, blocker.wait) for _ in range(64)]
+        received = []
+        messages = receive_messages(['/topic'])
+        try:
+            async for msg in messages:
+                received.append(msg)
+                if len(received) == 2:
+                    break
+            await messages.aclose()
+        finally:
+            blocker.set()
+        await asyncio.gather(*busy)
+        return received
+
+    async def run_with_timeout():
+        try:
+            return await asyncio.wait_for(run(), 10)
+        finally:
+            blocker.set()
+
+    with patch('posttroll.subscriber.Subscribe', FakeSubscribe):
+        received = asyncio.run(run_with_timeout())
+    assert received[0] is None
+    assert received[1].data['orbit_number'] == 62345
+    # Closed from the same thread, once done with the messages
+    time.sleep(0.1)
+    assert len(FakeSubscribe.instance.threads) == 1
+    assert threading.main_thread().ident not in FakeSubscribe.instance.threads
+
+
+def test_run_process():
+    """Test running a process, logging its output tagged with the scene."""
+    lines = []
+    pids = []
+    cmd = [sys.executable, '-c', "import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)"]
+    returncode = asyncio.run(run_process(cmd, 'npp_49001', log_func=lambda fmt, *args: lines.append(fmt % args),
+                                         on_start=pids.append))
+    assert returncode == 3
+    assert sorted(lines) == ['[npp_49001] err', '[npp_49001] out']
+    assert len(pids) == 1
+
+
+def test_run_process_timeout():
+    """Test killing a process still running after the timeout."""
+    start = time.monotonic()
+    returncode = asyncio.run(run_process([sys.executable, '-c', 'import time; time.sleep(30)'], 'slow',
+                                         timeout=0.5))
+    assert returncode < 0
+    assert time.monotonic() - start < 10
+
+
+def test_run_process_cancelled():
+    """Test killing the process when the scene is cancelled."""
+    pids = []
+
+    async def run():
+        task = asyncio.ensure_future(run_process([sys.executable, '-c', 'import time; time.sleep(30)'], 'slow',
+                                                 on_start=pids.append))
+        while not pids:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - start < 10
+    # The process was killed and reaped
+    with pytest.raises(ProcessLookupError):
+        os.kill(pids[0], 0)
+
+
+def test_wait_until_nwp_ready():
+    """Test waiting for the NWP data, and giving up at the timeout."""
+    nwp_service = FakeNwpService(0.2)
+    assert asyncio.run(wait_until_nwp_ready(nwp_service, NOW, timeout=5, poll_interval=0.05))
+    assert nwp_service.asked == [(NOW, None)]
+    assert asyncio.run(wait_until_nwp_ready(nwp_service, NOW, timeout=5))
+    assert len(nwp_service.asked) == 1
+
+    nwp_service = FakeNwpService(10)
+    assert not asyncio.run(wait_until_nwp_ready(nwp_service, NOW, timeout=0.2, poll_interval=0.05))
+
+
+def test_scheduler():
+    """Test processing the scenes by priority and newest first, once each, with bounded concurrency."""
+    started = []
+    running = []
+    max_running = []
+
+    async def process_scene(name):
+        started.append(name)
+        running.append(name)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(name)
+        if name == 'fails':
+            raise ValueError(name)
+
+    async def run():
+        scheduler = AsyncScheduler(process_scene, nworkers=2, priorities={'NOAA-20': 1})
+        scenes = [('old', 'NOAA-19', NOW - timedelta(hours=1)), ('new', 'NOAA-19', NOW),
+                  ('fails', 'Metop-B', NOW - timedelta(hours=2)), ('prio', 'NOAA-20', NOW - timedelta(hours=3))]
+        for name, platform_name, starttime in scenes:
+            assert await scheduler.submit(name, {'platform_name': platform_name, 'starttime': starttime}, name)
+        assert not await scheduler.submit('new', {'platform_name': 'NOAA-19', 'starttime': NOW}, 'new')
+        assert scheduler.pending == 4
+        scheduler.start()
+        await scheduler.join()
+        assert await scheduler.submit('new', {'platform_name': 'NOAA-19', 'starttime': NOW}, 'again')
+        await scheduler.join()
+        await scheduler.stop()
+
+    asyncio.run(run())
+    assert started == ['prio', 'new', 'old', 'fails', 'again']
+    assert max(max_running) == 2
+
+
+def test_queue_publisher():
+    """Test publishing the messages put from another thread in the event loop."""
+    publisher = FakePublisher()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        publish_q = QueuePublisher(publisher, loop)
+        await loop.run_in_executor(None, publish_q.put, 'msg')
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert publisher.sent == ['msg']
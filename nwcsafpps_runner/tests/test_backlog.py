@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the catching up with the level-1 files arrived while the runner was down.
+"""
+
+import os
+from datetime import datetime
+
+from nwcsafpps_runner.backlog import find_level1_files, get_platform_name, recover_backlog
+from nwcsafpps_runner.scene_assembler import SceneAssembler
+
+L1B_PATTERN = 'hrpt_{platform_name}_{start_time:%Y%m%d_%H%M}_{orbit_number:05d}.l1b'
+MW_PATTERN = '{sensor}_{platform_name}_{start_time:%Y%m%d_%H%M}_{end_time:%H%M}_{orbit_number:05d}.l1c'
+
+
+def write_level1_files(path):
+    """Write the level-1 files of a complete NOAA-19 scene, and of a Metop-B scene without microwave data."""
+    for name in ['hrpt_noaa19_20210503_1200_62345.l1b', 'amsu-a_noaa19_20210503_1200_1215_62345.l1c',
+                 'mhs_noaa19_20210503_1200_1215_62345.l1c', 'hrpt_metop01_20210503_1130_45001.l1b',
+                 'hrpt_noaa19_20210401_1200_61900.l1b', 'hrpt_noaa19_nodate.l1b']:
+        (path / name).write_text('x')
+
+
+def get_patterns(path):
+    """Get the backlog patterns of the config."""
+    return [{'pattern': os.path.join(str(path), L1B_PATTERN), 'sensor': 'avhrr/3'},
+            {'pattern': os.path.join(str(path), MW_PATTERN), 'data_processing_level': '1C'}]
+
+
+def test_get_platform_name():
+    """Test getting the platform names of the messages from the file names."""
+    assert get_platform_name('noaa19') == 'NOAA-19'
+    assert get_platform_name('metop01') == 'Metop-B'
+    assert get_platform_name('metopc') == 'Metop-C'
+    assert get_platform_name('NOAA-20') == 'NOAA-20'
+
+
+def test_find_level1_files(tmp_path):
+    """Test finding the level-1 files, in start time order."""
+    write_level1_files(tmp_path)
+    found = find_level1_files(get_patterns(tmp_path), since=datetime(2021, 5, 1))
+
+    assert [os.path.basename(filename) for filename, _ in found] == [
+        'hrpt_metop01_20210503_1130_45001.l1b', 'hrpt_noaa19_20210503_1200_62345.l1b',
+        'amsu-a_noaa19_20210503_1200_1215_62345.l1c', 'mhs_noaa19_20210503_1200_1215_62345.l1c']
+    metadata = found[2][1]
+    assert metadata['platform_name'] == 'NOAA-19'
+    assert metadata['sensor'] == 'amsu-a'
+    assert metadata['end_time'] == datetime(2021, 5, 3, 12, 15)
+
+
+def test_find_level1_files_from_string(tmp_path):
+    """Test finding the level-1 files with the patterns given as a comma separated string, as in a .ini config."""
+    write_level1_files(tmp_path)
+    (tmp_path / 'avhrr_noaa19_20210503_1200_1215_62345.l1c').write_text('x')
+    patterns = ', '.join(os.path.join(str(tmp_path), pattern) for pattern in [MW_PATTERN, L1B_PATTERN])
+    found = find_level1_files(patterns, since=datetime(2021, 5, 1))
+
+    # The sensor is not found in the names of the .l1b files
+    assert sorted(os.path.basename(filename) for filename, _ in found) == [
+        'amsu-a_noaa19_20210503_1200_1215_62345.l1c', 'avhrr_noaa19_20210503_1200_1215_62345.l1c',
+        'mhs_noaa19_20210503_1200_1215_62345.l1c']
+    assert len(find_level1_files(os.path.join(str(tmp_path), MW_PATTERN))) == 3
+
+
+def test_recover_backlog(tmp_path):
+    """Test processing the complete scenes not already processed, and keeping the others."""
+    l1dir = tmp_path / 'level1'
+    outdir = tmp_path / 'output'
+    l1dir.mkdir()
+    outdir.mkdir()
+    write_level1_files(l1dir)
+    processed = []
+    scenes = SceneAssembler()
+
+    nscenes = recover_backlog(get_patterns(l1dir), scenes, lambda record, msg: processed.append(record),
+                              str(outdir), since=datetime(2021, 5, 1))
+
+    assert nscenes == 1
+    assert [(record.platform_name, record.orbit_number, len(record.files)) for record in processed] == [
+        ('NOAA-19', 62345, 3)]
+    assert len(scenes) == 1
+
+    (outdir / 'S_NWC_CMA_noaa19_62345_20210503T1200123Z_20210503T1215000Z.nc').write_text('x')
+    processed = []
+    nscenes = recover_backlog(get_patterns(l1dir), SceneAssembler(), lambda record, msg: processed.append(record),
+                              str(outdir), since=datetime(2021, 5, 1))
+    assert nscenes == 0
+    assert processed == []
+
+
+def test_recover_metop_backlog(tmp_path):
+    """Test recovering a Metop scene with its AMSU-A and MHS files, the processing level not given in the config."""
+    write_level1_files(tmp_path)
+    for name in ['amsu-a_metop01_20210503_1130_1145_45001.l1c', 'mhs_metop01_20210503_1130_1145_45001.l1c']:
+        (tmp_path / name).write_text('x')
+    patterns = [{'pattern': os.path.join(str(tmp_path), L1B_PATTERN), 'sensor': 'avhrr/3'},
+                os.path.join(str(tmp_path), MW_PATTERN)]
+    processed = []
+
+    nscenes = recover_backlog(patterns, SceneAssembler(), lambda record, msg: processed.append(record),
+                              str(tmp_path), since=datetime(2021, 5, 1))
+
+    assert nscenes == 2
+    assert sorted((record.platform_name, record.orbit_number, len(record.files)) for record in processed) == [
+        ('Metop-B', 45001, 3), ('NOAA-19', 62345, 3)]
@@ -73,3 +73,15 @@ class TestGetConfig(unittest.TestCase):
                                                   'rotate': True}}
 
         self.assertDictEqual(result, expected)
+
+
+def test_pps_config_defaults(tmp_path):
+    """Test that the NWP preparation stays inline unless the background service is asked for."""
+    from nwcsafpps_runner.config import get_config_yaml
+
+    configfile = tmp_path / 'pps2018_config.yaml'
+    configfile.write_text("subscribe_topics: /segment/SDR/1B\n")
+    assert get_config_yaml(str(configfile))['nwp_prepare_in_background'] is False
+
+    configfile.write_text("subscribe_topics: /segment/SDR/1B\nnwp_prepare_in_background: yes\n")
+    assert get_config_yaml(str(configfile))['nwp_prepare_in_background'] is True
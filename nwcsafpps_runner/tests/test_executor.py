@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the running of jobs with a fixed number of workers.
+"""
+
+import os
+import queue
+import threading
+
+import pytest
+
+from nwcsafpps_runner.executor import JobExecutor
+
+
+def fail():
+    """Fail the job."""
+    raise RuntimeError("PPS crashed")
+
+
+def test_bounded_queue():
+    """Test refusing jobs when the queue is full, and jobs with the id of one waiting."""
+    executor = JobExecutor(1, max_pending=2)
+    assert executor.submit('a', len, args=((),))
+    assert not executor.submit('a', len, args=((),))
+    assert executor.submit('b', len, args=((),))
+    assert not executor.submit('c', len, args=((),), timeout=0.01)
+    stats = executor.get_stats()
+    assert stats['pending'] == 2
+    assert stats['refused'] == 2
+
+
+def test_job_id_released_after_failure():
+    """Test that a failed job can be submitted again."""
+    executor = JobExecutor(1)
+    executor.start()
+    try:
+        assert executor.submit('scene', fail)
+        done = threading.Event()
+        with executor._cond:
+            assert executor._cond.wait_for(lambda: executor.get_stats().get('failed') == 1, 5)
+        assert executor.submit('scene', done.set)
+        assert done.wait(5)
+    finally:
+        executor.stop()
+    stats = executor.get_stats()
+    assert stats['started'] == 2
+    assert stats['max_wait'] >= stats['mean_wait'] >= 0
+
+
+def test_submit_waits_for_free_place():
+    """Test that a submit to a full queue waits for a job to start."""
+    release = threading.Event()
+    done = threading.Event()
+    executor = JobExecutor(1, max_pending=1)
+    executor.start()
+    try:
+        executor.submit('busy', release.wait)
+        executor.submit('next', len, args=((),))
+        threading.Timer(0.1, release.set).start()
+        assert executor.submit('last', done.set, timeout=5)
+        assert done.wait(5)
+    finally:
+        executor.stop()
+
+
+def test_process_backend(tmp_path):
+    """Test running the jobs in other processes, their results being sent back in the results queue."""
+    results = queue.Queue()
+    executor = JobExecutor(2, backend='process', results=results)
+    executor.start()
+    try:
+        for name in ['a', 'b']:
+            assert executor.submit(name, os.mkdir, args=(str(tmp_path / name),))
+        assert executor.submit('sum', sum, args=([1, 2, 3],))
+        with executor._cond:
+            assert executor._cond.wait_for(lambda: executor.get_stats().get('done') == 3, 30)
+    finally:
+        executor.stop()
+    assert sorted(os.listdir(str(tmp_path))) == ['a', 'b']
+    assert sorted([results.get_nowait() for _ in range(3)], key=str) == [('a', None), ('b', None), ('sum', 6)]
+
+
+def test_process_backend_refuses_unpicklable_jobs():
+    """Test refusing the jobs the process backend cannot run, with a clear error."""
+    executor = JobExecutor(1, backend='process')
+    with pytest.raises(TypeError, match='module-level function'):
+        executor.submit('closure', lambda: None)
+    with pytest.raises(TypeError, match='picklable arguments'):
+        executor.submit('lock', len, args=(threading.Lock(),))
+    assert executor.pending == 0
+
+
+def test_unknown_backend():
+    """Test refusing an unknown backend."""
+    with pytest.raises(ValueError):
+        JobExecutor(1, backend='cluster')
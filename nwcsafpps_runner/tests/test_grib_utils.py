@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the GRIB utilities for the NWP preparation.
+"""
+
+import os
+import threading
+
+import eccodes as ecc
+import numpy as np
+import pytest
+
+from nwcsafpps_runner import grib_utils
+from nwcsafpps_runner.grib_utils import (append_file, assemble_nwp_file,
+                                         crop_values, encode_grib_message,
+                                         get_crop_area, get_crop_indices, get_packing,
+                                         get_grib_entries, get_missing_fields,
+                                         index_grib_messages, read_grib_headers,
+                                         read_nwp_requirements, read_static_fields)
+
+
+def write_grib_file(filename, param_ids, sample='regular_ll_sfc_grib2'):
+    """Write a GRIB file with one message per paramId, created from an eccodes sample."""
+    with open(str(filename), 'wb') as fout:
+        for param_id in param_ids:
+            gid = ecc.codes_grib_new_from_samples(sample)
+            ecc.codes_set(gid, 'paramId', param_id)
+            ecc.codes_write(gid, fout)
+            ecc.codes_release(gid)
+
+
+def read_grib_entries(filename, keys=('paramId', 'gridType')):
+    """Read the *keys* of all messages in a GRIB file."""
+    entries = []
+    with open(str(filename), 'rb') as fin:
+        while True:
+            gid = ecc.codes_grib_new_from_file(fin)
+            if gid is None:
+                break
+            entries.append(tuple(ecc.codes_get(gid, key) for key in keys))
+            ecc.codes_release(gid)
+    return entries
+
+
+@pytest.fixture
+def nwp_input_files(tmp_path):
+    """Create nhsp, nhsf and static GRIB files."""
+    nhsp_file = tmp_path / 'nhsp'
+    write_grib_file(nhsp_file, [130, 131])
+    with open(str(nhsp_file), 'ab') as fout:
+        gid = ecc.codes_grib_new_from_samples('reduced_gg_pl_32_grib2')
+        ecc.codes_set(gid, 'paramId', 133)
+        ecc.codes_write(gid, fout)
+        ecc.codes_release(gid)
+    nhsf_file = tmp_path / 'nhsf'
+    write_grib_file(nhsf_file, [167, 235])
+    static_file = tmp_path / 'lsm_z'
+    write_grib_file(static_file, [172, 129])
+    return nhsp_file, nhsf_file, static_file
+
+
+def test_assemble_nwp_file(tmp_path, nwp_input_files):
+    """Test assembling the NWP file with a check of the required fields."""
+    outfile = tmp_path / 'out'
+    required = ['130 Temperature 0 surface', '167 2 metre temperature 2 heightAboveGround',
+                '172 Land-sea mask 0 surface', '133 Specific humidity 0 surface']
+
+    missing = assemble_nwp_file(str(outfile), *[str(fname) for fname in nwp_input_files],
+                                required_fields=required)
+
+    assert missing == [{'paramId': '133', 'name': 'Specific humidity', 'level': '0', 'typeOfLevel': 'surface'}]
+    assert read_grib_entries(outfile) == [(130, 'regular_ll'), (131, 'regular_ll'),
+                                          (167, 'regular_ll'), (235, 'regular_ll'),
+                                          (172, 'regular_ll'), (129, 'regular_ll')]
+
+
+def test_assemble_nwp_file_without_requirements(tmp_path, nwp_input_files):
+    """Test assembling the NWP file when the nhsf and static files are appended as they are."""
+    outfile = tmp_path / 'out'
+    nhsp_file, nhsf_file, static_file = nwp_input_files
+
+    missing = assemble_nwp_file(str(outfile), str(nhsp_file), str(nhsf_file), str(static_file))
+
+    assert missing == []
+    content = outfile.read_bytes()
+    assert content.endswith(nhsf_file.read_bytes() + static_file.read_bytes())
+    assert [entry[0] for entry in read_grib_entries(outfile)] == [130, 131, 167, 235, 172, 129]
+
+
+def test_assemble_nwp_file_cropped(tmp_path, nwp_input_files):
+    """Test assembling the NWP file with all fields cropped to an area."""
+    outfile = tmp_path / 'out'
+
+    assemble_nwp_file(str(outfile), *[str(fname) for fname in nwp_input_files], area=(50, 4, 40, 10))
+
+    assert read_grib_entries(outfile, ('paramId', 'Ni', 'Nj')) == [(130, 4, 6), (131, 4, 6), (167, 4, 6),
+                                                                   (235, 4, 6), (172, 4, 6), (129, 4, 6)]
+
+
+@pytest.mark.parametrize('value', [[70, -10, 50, 40], '70, -10, 50,40'])
+def test_get_crop_area(value):
+    """Test getting the crop area from the config."""
+    assert get_crop_area(value) == (70., -10., 50., 40.)
+    assert get_crop_area(None) is None
+
+
+@pytest.mark.parametrize('value', [[70, -10, 50], [50, -10, 70, 40]])
+def test_get_crop_area_invalid(value):
+    """Test that an invalid crop area is refused."""
+    with pytest.raises(ValueError):
+        get_crop_area(value)
+
+
+GLOBAL_GRID = {'Ni': 36, 'Nj': 19, 'latitudeOfFirstGridPointInDegrees': 90., 'longitudeOfFirstGridPointInDegrees': 0.,
+               'iDirectionIncrementInDegrees': 10., 'jDirectionIncrementInDegrees': 10., 'jScansPositively': 0}
+
+
+def test_get_crop_indices():
+    """Test getting the rows and columns of the grid inside the crop area."""
+    rows, first_col, ncols, keys = get_crop_indices(GLOBAL_GRID, (65, 15, 35, 42))
+
+    assert rows == slice(3, 6)
+    assert (first_col, ncols) == (2, 3)
+    assert keys == {'Ni': 3, 'Nj': 3,
+                    'latitudeOfFirstGridPointInDegrees': 60., 'latitudeOfLastGridPointInDegrees': 40.,
+                    'longitudeOfFirstGridPointInDegrees': 20., 'longitudeOfLastGridPointInDegrees': 40.}
+
+
+def test_get_crop_indices_wrap_around():
+    """Test getting the columns of an area crossing the first longitude of a global grid."""
+    _, first_col, ncols, keys = get_crop_indices(GLOBAL_GRID, (10, -20, -10, 20))
+
+    assert (first_col, ncols) == (34, 5)
+    assert keys['longitudeOfFirstGridPointInDegrees'] == 340.
+    assert keys['longitudeOfLastGridPointInDegrees'] == 20.
+
+
+def test_get_crop_indices_regional_grid():
+    """Test cropping a regional grid to an area larger than the grid."""
+    grid = dict(GLOBAL_GRID, Ni=5, longitudeOfFirstGridPointInDegrees=350.)
+
+    _, first_col, ncols, _ = get_crop_indices(grid, (90, 0, -90, 180))
+    assert (first_col, ncols) == (1, 4)
+
+    _, first_col, ncols, _ = get_crop_indices(grid, (90, -30, -90, 10))
+    assert (first_col, ncols) == (0, 3)
+
+    with pytest.raises(ValueError):
+        get_crop_indices(grid, (90, 100, -90, 180))
+
+
+def test_crop_values():
+    """Test cropping a flat field, with and without wrapping around the grid."""
+    values = np.arange(12.)
+
+    np.testing.assert_array_equal(crop_values(values, (3, 4), slice(1, 3), 1, 2), [5, 6, 9, 10])
+    np.testing.assert_array_equal(crop_values(values, (3, 4), slice(0, 2), 3, 2), [3, 0, 7, 4])
+
+
+def test_crop_grib_message():
+    """Test cropping a GRIB message to an area."""
+    gid = ecc.codes_grib_new_from_samples('regular_ll_sfc_grib2')
+    ecc.codes_set_values(gid, np.arange(31 * 16.))
+
+    clone_id = encode_grib_message(gid, (50, 4, 40, 10))
+
+    assert ecc.codes_get(clone_id, 'Ni') == 4
+    assert ecc.codes_get(clone_id, 'Nj') == 6
+    np.testing.assert_array_equal(ecc.codes_get_array(clone_id, 'latitudes')[::4], [50, 48, 46, 44, 42, 40])
+    np.testing.assert_array_equal(ecc.codes_get_array(clone_id, 'longitudes')[:4], [4, 6, 8, 10])
+    np.testing.assert_array_equal(ecc.codes_get_values(clone_id)[:5], [82, 83, 84, 85, 98])
+    ecc.codes_release(clone_id)
+    ecc.codes_release(gid)
+
+
+def test_get_packing():
+    """Test getting the packing of the fields from the config."""
+    assert get_packing(['default:grid_simple:16', '167:grid_ccsds']) == {None: ('grid_simple', 16),
+                                                                         167: ('grid_ccsds', None)}
+    assert get_packing('235:grid_ccsds:12, 167:grid_simple:10') == {235: ('grid_ccsds', 12),
+                                                                    167: ('grid_simple', 10)}
+    assert get_packing(None) is None
+    with pytest.raises(ValueError):
+        get_packing(['167'])
+
+
+def test_encode_grib_message_packing():
+    """Test packing a GRIB message with the packing of its parameter."""
+    gid = ecc.codes_grib_new_from_samples('regular_ll_sfc_grib2')
+    ecc.codes_set(gid, 'paramId', 167)
+    ecc.codes_set_values(gid, np.linspace(200., 300., 31 * 16))
+
+    assert encode_grib_message(gid, packing={235: ('grid_ccsds', 12)}) is None
+
+    clone_id = encode_grib_message(gid, packing={None: ('grid_ccsds', 12)})
+    assert ecc.codes_get(clone_id, 'packingType') == 'grid_ccsds'
+    assert ecc.codes_get(clone_id, 'bitsPerValue') == 12
+    assert len(ecc.codes_get_message(clone_id)) < len(ecc.codes_get_message(gid))
+    np.testing.assert_allclose(ecc.codes_get_values(clone_id), ecc.codes_get_values(gid), atol=0.1)
+    ecc.codes_release(clone_id)
+
+    clone_id = encode_grib_message(gid, area=(50, 4, 40, 10), packing={167: ('grid_simple', 10)})
+    assert (ecc.codes_get(clone_id, 'Ni'), ecc.codes_get(clone_id, 'bitsPerValue')) == (4, 10)
+    ecc.codes_release(clone_id)
+    ecc.codes_release(gid)
+
+
+def test_assemble_nwp_file_packed(tmp_path, nwp_input_files):
+    """Test assembling the NWP file with all fields repacked, still passing the content check."""
+    outfile = tmp_path / 'out'
+    required = ['167 2 metre temperature 2 heightAboveGround', '172 Land-sea mask 0 surface']
+
+    missing = assemble_nwp_file(str(outfile), *[str(fname) for fname in nwp_input_files],
+                                required_fields=required, packing={None: ('grid_ccsds', 8)})
+
+    assert missing == []
+    assert set(read_grib_entries(outfile, ('packingType',))) == {('grid_ccsds',)}
+
+
+def test_index_grib_messages(tmp_path, nwp_input_files):
+    """Test indexing the GRIB messages in a file."""
+    nhsp_file, _, _ = nwp_input_files
+    content = nhsp_file.read_bytes()
+
+    index = index_grib_messages(str(nhsp_file))
+
+    assert len(index) == 3
+    assert index[0][0] == 0
+    assert sum(length for _, length in index) == len(content)
+    for offset, length in index:
+        assert content[offset:offset + 4] == b'GRIB'
+        assert content[offset + length - 4:offset + length] == b'7777'
+
+
+def test_index_grib_messages_corrupt_file(tmp_path, nwp_input_files):
+    """Test that a truncated GRIB file is detected."""
+    nhsp_file, _, _ = nwp_input_files
+    truncated = tmp_path / 'truncated'
+    truncated.write_bytes(nhsp_file.read_bytes()[:-10])
+
+    with pytest.raises(IOError):
+        index_grib_messages(str(truncated))
+
+
+def test_read_grib_headers_is_cached(tmp_path, nwp_input_files, monkeypatch):
+    """Test that the GRIB headers of a file are only read once, unless the file changes."""
+    _, nhsf_file, _ = nwp_input_files
+    assert get_grib_entries(str(nhsf_file)) == ['167 2 metre temperature 2 heightAboveGround',
+                                                '235 Skin temperature 0 surface']
+
+    monkeypatch.setattr(grib_utils, 'index_grib_messages', None)
+    assert [values for _, _, values in read_grib_headers(str(nhsf_file))][1] == (235, 'Skin temperature',
+                                                                                 0, 'surface')
+
+
+def test_read_grib_headers_from_threads(tmp_path, nwp_input_files, monkeypatch):
+    """Test reading the GRIB headers of several files from concurrent threads through the bounded cache."""
+    monkeypatch.setattr(grib_utils, 'HEADER_CACHE_SIZE', 2)
+    grib_utils.clear_caches()
+    expected = {str(filename): read_grib_headers(str(filename)) for filename in nwp_input_files}
+    errors = []
+
+    def read_all():
+        try:
+            for _ in range(20):
+                for filename, headers in expected.items():
+                    assert read_grib_headers(filename) == headers
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=read_all) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(grib_utils._HEADER_CACHE) <= 2
+
+
+def test_get_missing_fields():
+    """Test the report of missing fields."""
+    entries = ['167 2 metre temperature 2 heightAboveGround']
+    required = ['167 2 metre temperature 2 heightAboveGround', '129 Geopotential 1000 isobaricInhPa']
+
+    assert get_missing_fields(entries, required) == [{'paramId': '129', 'name': 'Geopotential',
+                                                      'level': '1000', 'typeOfLevel': 'isobaricInhPa'}]
+
+
+def test_read_static_fields(tmp_path, nwp_input_files, monkeypatch):
+    """Test that the static fields are read once, and again only when the file changes."""
+    _, _, static_file = nwp_input_files
+    static_file = str(static_file)
+    content = open(static_file, 'rb').read()
+
+    fields = read_static_fields(static_file)
+    assert [(param, level) for param, level, _ in fields] == [(172, 0), (129, 0)]
+    assert b''.join(message for _, _, message in fields) == content
+
+    cropped = read_static_fields(static_file, (50, 4, 40, 10))
+    assert [ecc.codes_get(ecc.codes_new_from_message(message), 'Ni') for _, _, message in cropped] == [4, 4]
+
+    monkeypatch.setattr(grib_utils, 'read_grib_headers', None)
+    assert read_static_fields(static_file) is fields
+
+    monkeypatch.undo()
+    write_grib_file(static_file, [172])
+    os.utime(static_file, (0, 0))
+    assert [param for param, _, _ in read_static_fields(static_file)] == [172]
+
+
+def test_append_file(tmp_path):
+    """Test appending a file to an open file."""
+    infile = tmp_path / 'in'
+    infile.write_bytes(b'world')
+    outfile = tmp_path / 'out'
+    with open(str(outfile), 'wb') as fout:
+        fout.write(b'hello ')
+        append_file(str(infile), fout)
+        fout.write(b'!')
+
+    assert outfile.read_bytes() == b'hello world!'
+
+
+def test_append_file_ranges(tmp_path):
+    """Test appending byte ranges of a file to an open file."""
+    infile = tmp_path / 'in'
+    infile.write_bytes(b'0123456789')
+    outfile = tmp_path / 'out'
+    with open(str(outfile), 'wb') as fout:
+        append_file(str(infile), fout, [(1, 2), (3, 2), (8, 2)])
+
+    assert outfile.read_bytes() == b'123489'
+
+
+def test_read_nwp_requirements(tmp_path):
+    """Test reading the mandatory fields from the requirements file."""
+    req_file = tmp_path / 'pps_nwp_list_of_required_fields.txt'
+    req_file.write_text("M 235 Skin temperature 0 surface\n"
+                        "O 34 Sea surface temperature 0 surface\n"
+                        "M 167 2 metre temperature 0 surface\n")
+
+    assert read_nwp_requirements(str(req_file)) == ['235 Skin temperature 0 surface',
+                                                    '167 2 metre temperature 0 surface']
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the metno version of the NWP preparation.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from nwcsafpps_runner.metno_update_nwp import (METNO_PARAMETERS, get_needed_fields,
+                                               get_parameters, update_nwp)
+from nwcsafpps_runner.tests.test_grib_utils import read_grib_entries, write_grib_file
+
+
+@pytest.fixture
+def metno_input_files(tmp_path):
+    """Create N2D, N1S and static input files."""
+    analysis_time = datetime.utcnow().replace(month=6, day=1, hour=0, minute=0, second=0, microsecond=0)
+    timestamp = analysis_time.strftime('%m%d%H%M') + (analysis_time + timedelta(hours=3)).strftime('%m%d%H%M')
+    n2d_file = tmp_path / ('N2D' + timestamp + '1')
+    write_grib_file(n2d_file, [167, 165, 235])
+    n1s_file = tmp_path / ('N1S' + timestamp + '1')
+    write_grib_file(n1s_file, [133, 130])
+    static_file = tmp_path / 'static.grib'
+    write_grib_file(static_file, [172, 129])
+    return n2d_file, n1s_file, static_file, analysis_time
+
+
+@pytest.mark.parametrize('value, expected', [(None, set(METNO_PARAMETERS)),
+                                             ([130, 133], {130, 133}),
+                                             ('130,133', {130, 133})])
+def test_get_parameters(value, expected):
+    """Test getting the parameters needed from the config."""
+    assert get_parameters({'nwp_parameters': value}) == expected
+
+
+def test_get_needed_fields(metno_input_files):
+    """Test selecting the needed fields from the input files, in a deterministic order."""
+    n2d_file, n1s_file, static_file, _ = metno_input_files
+    filenames = [str(n2d_file), str(n1s_file), str(static_file)]
+
+    fields = get_needed_fields(filenames, {129, 130, 133, 167, 235})
+
+    assert [(param, filename) for param, _, filename, _ in fields] == [(129, str(static_file)),
+                                                                       (130, str(n1s_file)),
+                                                                       (133, str(n1s_file)),
+                                                                       (167, str(n2d_file)),
+                                                                       (235, str(n2d_file))]
+
+
+def test_update_nwp(tmp_path, metno_input_files):
+    """Test preparing the NWP file with the needed fields, cropped."""
+    n2d_file, _, static_file, analysis_time = metno_input_files
+    outdir = tmp_path / 'out'
+    options = {'nwp_outdir': str(outdir),
+               'ecmwf_path': str(tmp_path),
+               'ecmwf_prefix': 'N2D',
+               'ecmwf_file_name_sift': 'N2D{analysis_time:%m%d%H%M}{forecast_time:%m%d%H%M}1',
+               'ecmwf_static_surface': str(static_file),
+               'nwp_output': 'PPS_ECMWF_{analysis_time:%Y%m%d%H%M}+{step_hour:03d}H{step_min:02d}M',
+               'nwp_crop_area': [50, 0, 40, 30]}
+
+    update_nwp({'options': options, 'starttime': analysis_time - timedelta(days=1), 'nlengths': [3]})
+
+    result_file = outdir / analysis_time.strftime('PPS_ECMWF_%Y%m%d%H%M+003H00M')
+    assert read_grib_entries(result_file, ('paramId', 'Nj')) == [(129, 6), (130, 6), (133, 6),
+                                                                 (167, 6), (172, 6), (235, 6)]
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the benchmark of the NWP preparation.
+"""
+
+import os
+
+from nwcsafpps_runner.nwp_benchmark import (OPERATION_STAGES, STAGES, BenchmarkSetup, find_regressions,
+                                            make_benchmark_files, make_record, read_results, run_benchmark,
+                                            store_result)
+from nwcsafpps_runner.tests.test_grib_utils import read_grib_entries
+
+
+def test_make_benchmark_files(tmp_path):
+    """Test writing the synthetic input files."""
+    setup = BenchmarkSetup(resolution=2., nlevels=2)
+
+    nhsp_file, nhsf_file, static_file = make_benchmark_files(str(tmp_path), setup)
+
+    nhsp_entries = read_grib_entries(nhsp_file, ('paramId', 'level', 'gridType', 'Nj', 'Ni'))
+    assert nhsp_entries[0] == (130, 1000, 'regular_ll', 46, 180)
+    assert [entry[2] for entry in nhsp_entries].count('regular_ll') == 10
+    assert [entry[0] for entry in read_grib_entries(static_file)] == [172, 129]
+    assert len(read_grib_entries(nhsf_file)) == 10
+
+
+def test_run_benchmark(tmp_path):
+    """Test timing the stages, and storing and comparing the results."""
+    setup = BenchmarkSetup(resolution=2., nlevels=2, area=(80, -10, 40, 30), packing={None: ('grid_simple', 12)})
+
+    stages = run_benchmark(str(tmp_path), setup, repeat=1)
+
+    assert sorted(stages) == sorted(STAGES)
+    assert stages['merge']['messages'] == 22
+    assert all(stats['mb_per_s'] > 0 for stage, stats in stages.items() if stage not in OPERATION_STAGES)
+    assert stages['rename']['operations'] == 2
+    assert 'mb_per_s' not in stages['rename']
+    assert os.listdir(str(tmp_path)) == []
+
+    results = str(tmp_path / 'results.jsonl')
+    record = make_record(stages, setup)
+    store_result(results, record)
+    previous = read_results(results)
+    assert previous[0]['setup']['packing'] == ['default:grid_simple:12']
+
+    slower = make_record({stage: dict(stats, seconds=1., mb_per_s=stats.get('mb_per_s', 0) / 2)
+                          for stage, stats in stages.items()}, setup)
+    assert [stage for stage, _, _ in find_regressions(previous, slower)] == [
+        stage for stage in STAGES if stage not in OPERATION_STAGES]
+    assert find_regressions(previous, make_record(stages, setup)) == []
+    assert find_regressions(previous, make_record(stages, BenchmarkSetup(resolution=2.))) == []
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the ledger of NWP input files.
+"""
+
+import os
+from datetime import datetime
+from unittest.mock import Mock
+
+from nwcsafpps_runner.nwp_ledger import NwpLedger
+
+
+def fake_parse(filename):
+    """Parse the analysis time and forecast step from a fake nhsf filename."""
+    basename = os.path.basename(filename)
+    if not basename.startswith('NHSF_'):
+        return None
+    timestamp, step = basename[5:].split('+')
+    return datetime.strptime(timestamp, '%Y%m%d%H%M'), int(step), basename[5:]
+
+
+def test_ledger_parses_only_new_and_changed_files(tmp_path):
+    """Test that the input files are only parsed once, unless changed."""
+    filelist = []
+    for name in ['NHSF_202104271200+3', 'NHSF_202104271200+6', 'NHSF_202104260000+3', 'junk']:
+        (tmp_path / name).write_text('x')
+        filelist.append(str(tmp_path / name))
+    parse = Mock(side_effect=fake_parse)
+
+    with NwpLedger(str(tmp_path / 'ledger.db')) as ledger:
+        assert ledger.update(filelist, parse) == 4
+        pending = ledger.get_pending(datetime(2021, 4, 27, 0, 0), [3, 6])
+        assert [os.path.basename(path) for path, _ in pending] == ['NHSF_202104271200+3', 'NHSF_202104271200+6']
+        assert pending[0][1] == (datetime(2021, 4, 27, 12, 0), 3, '202104271200+3')
+
+        ledger.set_prepared(filelist[0])
+
+    (tmp_path / 'NHSF_202104271200+6').write_text('changed')
+    parse.reset_mock()
+    with NwpLedger(str(tmp_path / 'ledger.db')) as ledger:
+        assert ledger.update(filelist[:3], parse) == 1
+        parse.assert_called_once_with(filelist[1])
+        pending = ledger.get_pending(datetime(2021, 4, 27, 0, 0), [3, 6])
+        assert [path for path, _ in pending] == [filelist[1]]
+        assert ledger.get_pending(datetime(2021, 4, 26, 0, 0), [3]) == [
+            (filelist[2], (datetime(2021, 4, 26, 0, 0), 3, '202104260000+3'))]
+
+
+def test_ledger_looks_only_at_the_window(tmp_path):
+    """Test that the known files older than the start time are not looked at again."""
+    filelist = []
+    for name in ['NHSF_202104271200+3', 'NHSF_202104260000+3', 'junk']:
+        (tmp_path / name).write_text('x')
+        filelist.append(str(tmp_path / name))
+    parse = Mock(side_effect=fake_parse)
+    starttime = datetime(2021, 4, 27, 0, 0)
+
+    with NwpLedger(str(tmp_path / 'ledger.db')) as ledger:
+        assert ledger.update(filelist, parse, starttime) == 3
+        for filename in filelist:
+            with open(filename, 'a') as fpt:
+                fpt.write('changed')
+        parse.reset_mock()
+        assert ledger.update(filelist, parse, starttime) == 1
+        parse.assert_called_once_with(filelist[0])
+
+
+def test_ledger_prepares_again_removed_results(tmp_path):
+    """Test that the files prepared are pending again once their result is removed."""
+    filename = str(tmp_path / 'NHSF_202104271200+3')
+    open(filename, 'w').close()
+    result = tmp_path / 'PPS_202104271200+003H00M'
+    result.write_text('x')
+
+    def get_result_filename(analysis_time, forecast_step):
+        return str(tmp_path / ('PPS_' + analysis_time.strftime('%Y%m%d%H%M') + '+%.3dH00M' % forecast_step))
+
+    starttime = datetime(2021, 4, 27, 0, 0)
+    with NwpLedger(str(tmp_path / 'ledger.db')) as ledger:
+        ledger.update([filename], fake_parse, starttime)
+        ledger.set_prepared(filename)
+        assert ledger.get_pending(starttime, [3]) == []
+        assert ledger.get_pending(starttime, [3], get_result_filename) == []
+
+        result.unlink()
+        assert [path for path, _ in ledger.get_pending(starttime, [3], get_result_filename)] == [filename]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the locking of the prepared NWP files.
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+from nwcsafpps_runner.nwp_lock import (NwpLockTimeout, NwpOutputLock, get_lock_filename, get_result_basename,
+                                       get_temp_prefix)
+
+
+def test_get_lock_filename():
+    """Test the name of the lock file."""
+    assert get_lock_filename('/data/nwp/LL02_NHSPSF_202104271200+003H00M') == \
+        '/data/nwp/.LL02_NHSPSF_202104271200+003H00M.lock'
+
+
+def test_get_result_basename():
+    """Test getting the prepared NWP file the hidden, lock and temporary files are for."""
+    result_file = '/data/nwp/LL02_NHSPSF_202104271200+003H00M'
+    temp_file = get_temp_prefix(result_file) + 'abcd_123'
+    assert get_result_basename(os.path.basename(get_lock_filename(result_file))) == os.path.basename(result_file)
+    assert get_result_basename(temp_file) == os.path.basename(result_file)
+    assert get_result_basename('.LL02_NHSPSF_202104271200+003H00M') == os.path.basename(result_file)
+    assert get_result_basename('tmpabcd_123') is None
+
+
+def test_produce_nwp_file(tmp_path):
+    """Test producing a file under the lock, and that the lock file is removed afterwards."""
+    result_file = str(tmp_path / 'nwp_file')
+
+    with NwpOutputLock(result_file) as producer:
+        assert producer
+        assert os.path.exists(get_lock_filename(result_file))
+        (tmp_path / 'nwp_file').write_text('x')
+
+    assert os.listdir(str(tmp_path)) == ['nwp_file']
+    with NwpOutputLock(result_file) as producer:
+        assert not producer
+
+
+def test_wait_for_other_producer(tmp_path):
+    """Test that a second process wanting the same file waits until the file is produced."""
+    result_file = str(tmp_path / 'nwp_file')
+    lock = NwpOutputLock(result_file)
+    assert lock.acquire()
+
+    def produce():
+        time.sleep(0.2)
+        (tmp_path / 'nwp_file').write_text('x')
+        lock.release()
+
+    producer_thread = threading.Thread(target=produce)
+    producer_thread.start()
+    _start = time.time()
+    with NwpOutputLock(result_file, timeout=10) as producer:
+        assert not producer
+    assert time.time() - _start < 5
+    producer_thread.join()
+
+
+def test_woken_up_by_rename(tmp_path):
+    """Test that a process waiting with a timeout returns as soon as the file is renamed into place."""
+    result_file = str(tmp_path / 'nwp_file')
+    lock = NwpOutputLock(result_file)
+    assert lock.acquire()
+    renamed = []
+
+    def produce():
+        time.sleep(0.2)
+        (tmp_path / 'tmp_nwp_file').write_text('x')
+        os.rename(str(tmp_path / 'tmp_nwp_file'), result_file)
+        renamed.append(time.monotonic())
+        # The lock is still held for a while
+        time.sleep(1)
+        lock.release()
+
+    producer_thread = threading.Thread(target=produce)
+    producer_thread.start()
+    with NwpOutputLock(result_file, timeout=10) as producer:
+        assert not producer
+    assert time.monotonic() - renamed[0] < 0.05
+    producer_thread.join()
+
+
+def test_take_over_from_failed_producer(tmp_path):
+    """Test that a waiting process produces the file itself if the producer failed."""
+    result_file = str(tmp_path / 'nwp_file')
+    lock = NwpOutputLock(result_file)
+    assert lock.acquire()
+
+    failing_thread = threading.Timer(0.2, lock.release)
+    failing_thread.start()
+    with NwpOutputLock(result_file, timeout=10) as producer:
+        assert producer
+    failing_thread.join()
+
+
+def test_wait_timeout(tmp_path):
+    """Test that waiting for another producer times out."""
+    result_file = str(tmp_path / 'nwp_file')
+    lock = NwpOutputLock(result_file)
+    assert lock.acquire()
+    nthreads = threading.active_count()
+    nfds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+    try:
+        for _ in range(3):
+            with pytest.raises(NwpLockTimeout):
+                with NwpOutputLock(result_file, timeout=0.1):
+                    pass
+    finally:
+        lock.release()
+    # Nothing is left waiting on the lock after the timeouts
+    assert threading.active_count() == nthreads
+    if nfds is not None:
+        assert len(os.listdir('/proc/self/fd')) == nfds - 1
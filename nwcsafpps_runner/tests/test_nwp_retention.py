@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the cleaning of the NWP output directory.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+from nwcsafpps_runner.nwp_lock import NwpOutputLock
+from nwcsafpps_runner.nwp_retention import NwpRetention
+from nwcsafpps_runner.nwp_service import get_nwp_output_pattern
+
+OUTPUT_PATTERN = get_nwp_output_pattern({'nwp_output_prefix': 'LL02_NHSPSF_'})
+
+
+def write_nwp_files(outdir, analysis_times, steps=(3, 6, 9)):
+    """Write fake prepared NWP files of 1000 bytes each."""
+    for analysis_time in analysis_times:
+        for step in steps:
+            name = 'LL02_NHSPSF_{:%Y%m%d%H%M}+{:03d}H00M'.format(analysis_time, step)
+            (outdir / name).write_bytes(b'x' * 1000)
+
+
+def test_evict_old_analyses(tmp_path):
+    """Test removing the NWP files of old analyses, except those covering a scene being processed."""
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    old_analysis = now - timedelta(hours=72)
+    write_nwp_files(tmp_path, [old_analysis, now])
+    retention = NwpRetention(str(tmp_path), OUTPUT_PATTERN, max_age=48)
+
+    scene_start = old_analysis + timedelta(hours=4)
+    with retention.in_flight(scene_start, scene_start + timedelta(minutes=10)):
+        evicted = retention.evict()
+    assert [os.path.basename(filename) for filename in evicted] == [
+        'LL02_NHSPSF_{:%Y%m%d%H%M}+009H00M'.format(old_analysis)]
+
+    evicted = retention.evict()
+    assert len(evicted) == 2
+    assert len(os.listdir(str(tmp_path))) == 3
+
+
+def test_evict_to_size_budget(tmp_path):
+    """Test removing the oldest NWP files until the size budget is met."""
+    analysis_times = [datetime(2021, 4, 27, 0, 0), datetime(2021, 4, 27, 12, 0)]
+    write_nwp_files(tmp_path, analysis_times)
+    retention = NwpRetention(str(tmp_path), OUTPUT_PATTERN, max_size=4000)
+
+    evicted = retention.evict()
+
+    assert sorted(os.path.basename(filename) for filename in evicted) == [
+        'LL02_NHSPSF_202104270000+003H00M', 'LL02_NHSPSF_202104270000+006H00M']
+
+
+def test_reap_orphans(tmp_path):
+    """Test removing old hidden, temporary and lock files of the prepared NWP files, unless in use."""
+    for name in ['.LL02_NHSPSF_202104271200+003H00M.tmpabcd1234', '.LL02_NHSPSF_202104271200+003H00M',
+                 '.LL02_NHSPSF_202104271200+003H00M.lock', '.LL02_NHSPSF_202104271200+006H00M',
+                 '.LL02_NHSPSF_202104271200+006H00M.tmp_x1y2z3', 'LL02_NHSPSF_202104271200+003H00M',
+                 '.bashrc', 'tmpabcdef', '.other.lock']:
+        (tmp_path / name).write_text('x')
+        os.utime(str(tmp_path / name), (0, 0))
+    (tmp_path / '.LL02_NHSPSF_202104271200+009H00M.tmpabcd1234').write_text('x')
+    retention = NwpRetention(str(tmp_path), OUTPUT_PATTERN)
+
+    lock = NwpOutputLock(str(tmp_path / 'LL02_NHSPSF_202104271200+006H00M'))
+    assert lock.acquire()
+    try:
+        retention.reap_orphans()
+    finally:
+        lock.release()
+
+    assert sorted(os.listdir(str(tmp_path))) == ['.LL02_NHSPSF_202104271200+006H00M',
+                                                 '.LL02_NHSPSF_202104271200+006H00M.tmp_x1y2z3',
+                                                 '.LL02_NHSPSF_202104271200+009H00M.tmpabcd1234', '.bashrc',
+                                                 '.other.lock', 'LL02_NHSPSF_202104271200+003H00M', 'tmpabcdef']
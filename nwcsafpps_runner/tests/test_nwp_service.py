@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the background NWP preparation service.
+"""
+
+from datetime import datetime
+
+import pytest
+
+from nwcsafpps_runner.nwp_service import (NwpPrepareService,
+                                          get_nwp_output_pattern,
+                                          get_nwp_valid_times,
+                                          get_scene_lead_times)
+
+OUTPUT_PATTERN = get_nwp_output_pattern({'nwp_output_prefix': 'LL02_NHSPSF_'})
+
+
+def test_get_nwp_output_pattern():
+    """Test getting the filename pattern of the prepared NWP files."""
+    assert OUTPUT_PATTERN == 'LL02_NHSPSF_{analysis_time:%Y%m%d%H%M}+{step_hour:03d}H{step_min:02d}M'
+    options = {'nwp_output_prefix': None,
+               'nwp_output': 'PPS_ECMWF_{analysis_time:%Y%m%d%H%M}+{step_hour:03d}H{step_min:02d}M'}
+    assert get_nwp_output_pattern(options) == options['nwp_output']
+
+
+def test_get_nwp_valid_times(tmp_path):
+    """Test getting the valid times of the prepared NWP files."""
+    for name in ['LL02_NHSPSF_202104271200+006H00M', 'LL02_NHSPSF_202104271200+003H00M',
+                 'LL02_NHSPSF_202104280000+003H00M', 'tmpabcd_202104280000+003H00M']:
+        (tmp_path / name).write_text('x')
+
+    expected = [datetime(2021, 4, 27, 15, 0), datetime(2021, 4, 27, 18, 0), datetime(2021, 4, 28, 3, 0)]
+    assert get_nwp_valid_times(str(tmp_path), OUTPUT_PATTERN) == expected
+
+
+def test_nwp_service_readiness(tmp_path):
+    """Test that the scenes wait only until the NWP data covering their start time are prepared."""
+    def prepare():
+        for step in [3, 6]:
+            (tmp_path / 'LL02_NHSPSF_202104271200+{:03d}H00M'.format(step)).write_text('x')
+
+    nwp_service = NwpPrepareService(prepare, str(tmp_path), OUTPUT_PATTERN, interval=600)
+    assert not nwp_service.is_ready(datetime(2021, 4, 27, 16, 0))
+
+    nwp_service.start()
+    try:
+        assert nwp_service.wait_until_ready(datetime(2021, 4, 27, 16, 0), timeout=10)
+        assert nwp_service.is_ready(datetime(2021, 4, 27, 15, 0))
+        assert not nwp_service.is_ready(datetime(2021, 4, 27, 19, 0))
+        assert not nwp_service.wait_until_ready(datetime(2021, 4, 27, 19, 0), timeout=0.1)
+    finally:
+        nwp_service.stop()
+        nwp_service.join(5)
+    assert not nwp_service.is_alive()
+
+
+@pytest.mark.parametrize('scene_window, expected', [((datetime(2021, 4, 27, 16, 0), datetime(2021, 4, 27, 16, 15)),
+                                                     [3, 6]),
+                                                    ((datetime(2021, 4, 27, 18, 0), datetime(2021, 4, 27, 21, 5)),
+                                                     [6, 9, 12]),
+                                                    ((datetime(2021, 4, 27, 13, 0), datetime(2021, 4, 27, 13, 15)),
+                                                     [3]),
+                                                    ((datetime(2021, 4, 27, 23, 0), datetime(2021, 4, 27, 23, 15)),
+                                                     [9, 12]),
+                                                    ((datetime(2021, 4, 28, 2, 0), datetime(2021, 4, 28, 2, 15)),
+                                                     [])])
+def test_get_scene_lead_times(scene_window, expected):
+    """Test getting the lead times bracketing a scene."""
+    assert get_scene_lead_times(datetime(2021, 4, 27, 12, 0), [12, 3, 6, 9], scene_window) == expected
+
+
+def test_nwp_service_scene_steps_first(tmp_path):
+    """Test that the lead times covering a waiting scene are prepared first, and the others right after."""
+    calls = []
+
+    def prepare(scene_window=None):
+        calls.append(scene_window)
+        steps = [3, 6, 9] if scene_window is None else [6]
+        for step in steps:
+            (tmp_path / 'LL02_NHSPSF_202104271200+{:03d}H00M'.format(step)).write_text('x')
+
+    nwp_service = NwpPrepareService(prepare, str(tmp_path), OUTPUT_PATTERN, interval=600, scene_steps_first=True)
+    nwp_service.refresh()
+    starttime = datetime(2021, 4, 27, 18, 0)
+    endtime = datetime(2021, 4, 27, 18, 0)
+    nwp_service.request(starttime, endtime)
+
+    nwp_service.start()
+    try:
+        assert nwp_service.wait_until_ready(starttime, timeout=10, endtime=endtime)
+        # Wait for the remaining lead times, without requesting them first
+        with nwp_service._updated:
+            assert nwp_service._updated.wait_for(
+                lambda: nwp_service.is_ready(datetime(2021, 4, 27, 19, 0), datetime(2021, 4, 27, 20, 0)), 10)
+    finally:
+        nwp_service.stop()
+        nwp_service.join(5)
+    assert calls[:2] == [(starttime, endtime), None]
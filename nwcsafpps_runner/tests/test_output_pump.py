@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the logging of the output of the child processes.
+"""
+
+import sys
+from subprocess import PIPE, Popen
+
+from nwcsafpps_runner.output_pump import OutputPump, pump_output
+from nwcsafpps_runner.utils import run_command
+
+SCRIPT = """
+import sys
+for idx in range(3):
+    print('%s out', idx, flush=True)
+    print('%s err', idx, file=sys.stderr, flush=True)
+sys.stdout.write('x' * 25)
+"""
+
+
+def start_process(name):
+    """Start a child process writing to stdout and stderr."""
+    return Popen([sys.executable, '-c', SCRIPT % (name, name)], stdout=PIPE, stderr=PIPE)
+
+
+def test_pump_many_processes():
+    """Test logging the lines of several processes from one pump, tagged and with bounded lines."""
+    lines = []
+    pump = OutputPump(max_line_length=20)
+    pump.start()
+    try:
+        outputs = [pump.register(start_process(name), name, lambda fmt, *args: lines.append(fmt % args))
+                   for name in ['noaa19_62345', 'npp_49001']]
+        for output in outputs:
+            assert output.wait(10)
+            output.proc.wait()
+    finally:
+        pump.stop()
+
+    for name in ['noaa19_62345', 'npp_49001']:
+        own_lines = [line for line in lines if line.startswith('[%s]' % name)]
+        assert len(own_lines) == 8
+        assert '[%s] %s out 2' % (name, name) in own_lines
+        assert '[%s] %s err 0' % (name, name) in own_lines
+        assert own_lines.count('[%s] %s' % (name, 'x' * 20)) == 1
+        assert '[%s] xxxxx' % name in own_lines
+
+
+def test_shared_pump():
+    """Test the pump shared by the process, and running a command with it."""
+    proc = start_process('cmd')
+    output = pump_output(proc, 'cmd')
+    assert output.wait(10)
+    assert proc.wait() == 0
+    assert output.nlines == 7
+
+    assert run_command('%s -c "print(42)"' % sys.executable) == 0
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing running the PPS PGEs of a scene as a dependency graph.
+"""
+
+import asyncio
+import importlib.util
+import os
+import sys
+import threading
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from nwcsafpps_runner.pge_graph import (PgeSlots, get_failed_pges, get_pge_arguments, get_pge_commands,
+                                        get_pge_graph, get_pge_settings, run_pge_graph, run_pge_graph_in_threads)
+from nwcsafpps_runner.tests.test_prepare_nwp import TEST_NWP_OPTIONS
+from nwcsafpps_runner.utils import PpsRunError
+
+PGE_SCRIPT = """
+import sys
+import time
+with open(%(log)r, 'a') as fpt:
+    fpt.write('start %(pge)s\\n')
+time.sleep(%(seconds)s)
+with open(%(log)r, 'a') as fpt:
+    fpt.write('end %(pge)s\\n')
+sys.exit(%(returncode)d)
+"""
+
+SCENE = {'platform_name': 'NOAA-19', 'orbit_number': 62345, 'file4pps': '/data/hrpt_noaa19_62345.l1b',
+         'starttime': datetime(2021, 5, 3, 12, 0)}
+
+RUNNER = os.path.join(os.path.dirname(__file__), '..', '..', 'bin', 'pps2018_runner.py')
+
+
+def write_pges(tmp_path, graph, seconds=0.2, failing=()):
+    """Write the fake PGE scripts of the *graph*, logging when they start and end."""
+    log = str(tmp_path / 'pges.log')
+    for pge in graph:
+        values = {'log': log, 'pge': pge, 'seconds': seconds, 'returncode': 1 if pge in failing else 0}
+        (tmp_path / (pge + '.py')).write_text(PGE_SCRIPT % values)
+    return tmp_path / 'pges.log'
+
+
+def get_options(tmp_path, **kwargs):
+    """Get the options running the fake PGE scripts."""
+    options = {'python': sys.executable, 'run_all_script': str(tmp_path / 'ppsRunAll.py'),
+               'run_cmask_prob': True, 'run_pps_cpp': False, 'run_pps_precip': False,
+               'pps_execution': 'pge_graph', 'maximum_pps_processing_time_in_minutes': 1}
+    options.update(kwargs)
+    return options
+
+
+def test_get_pge_settings():
+    """Test getting the settings by PGE from the config."""
+    assert get_pge_settings(None) == {}
+    assert get_pge_settings('ppsCmask:10, ppsCtth:2.5', float) == {'ppsCmask': 10.0, 'ppsCtth': 2.5}
+    assert get_pge_settings(['ppsCmask:/opt/pps/scr/ppsCmask.py']) == {'ppsCmask': '/opt/pps/scr/ppsCmask.py'}
+    with pytest.raises(ValueError):
+        get_pge_settings(['ppsCmask'])
+
+
+def test_get_pge_graph(tmp_path):
+    """Test getting the PGEs of a scene, their dependencies and commands."""
+    graph = get_pge_graph(SCENE, get_options(tmp_path))
+    assert graph['ppsMakeAvhrr'] == ()
+    assert graph['ppsCmaskPrepare'] == ('ppsMakePhysiography', 'ppsMakeNwp')
+    assert 'ppsCmaskProb' in graph
+    assert 'ppsCpp' not in graph and 'ppsPrecip' not in graph
+
+    viirs_graph = get_pge_graph({'platform_name': 'NOAA-20'}, get_options(tmp_path, run_pps_precip=True))
+    assert viirs_graph['ppsMakeNwp'] == ('ppsMakeViirs', )
+    assert viirs_graph['ppsPrecip'] == ('ppsPrecipPrepare', 'ppsCtype')
+
+    with pytest.raises(PpsRunError):
+        get_pge_graph({'platform_name': 'Meteosat-11'}, get_options(tmp_path))
+
+    commands = get_pge_commands(SCENE, graph, get_options(tmp_path, pge_scripts=['ppsCmask:/opt/ppsCmask.py'],
+                                                          pge_arguments=['ppsMakeNwp:-o {orbit_number}']))
+    assert commands['ppsCtth'] == [sys.executable, str(tmp_path / 'ppsCtth.py'),
+                                   '--hrptfile', '/data/hrpt_noaa19_62345.l1b']
+    assert commands['ppsCmask'][1] == '/opt/ppsCmask.py'
+    assert commands['ppsMakeNwp'][2:] == ['-o', '62345']
+
+
+def test_get_pge_arguments():
+    """Test getting the arguments of a PGE script from the scene and the template."""
+    assert get_pge_arguments(SCENE) == ['--hrptfile', '/data/hrpt_noaa19_62345.l1b']
+    assert get_pge_arguments({'platform_name': 'NOAA-20', 'file4pps': '/data/SVM01_j01.h5'}) == [
+        '--csppfile', '/data/SVM01_j01.h5']
+    assert get_pge_arguments(SCENE, '--hrptfile {file4pps}  --start {starttime:%Y%m%d%H%M}') == [
+        '--hrptfile', '/data/hrpt_noaa19_62345.l1b', '--start', '202105031200']
+
+
+def test_run_pge_graph(tmp_path):
+    """Test running the PGEs side by side as soon as their dependencies are done."""
+    graph = get_pge_graph(SCENE, get_options(tmp_path))
+    log = write_pges(tmp_path, graph)
+    commands = get_pge_commands(SCENE, graph, get_options(tmp_path))
+
+    timings = asyncio.run(run_pge_graph(graph, commands, 'noaa19_62345'))
+
+    events = log.read_text().split('\n')
+    for pge, dependencies in graph.items():
+        assert timings[pge].returncode == 0
+        assert timings[pge].seconds >= 0.2
+        for dependency in dependencies:
+            assert events.index('end ' + dependency) < events.index('start ' + pge)
+    # The physiography and the NWP remapping are made side by side
+    assert events.index('start ppsMakeNwp') < events.index('end ppsMakePhysiography')
+    assert events.index('start ppsCtype') < events.index('end ppsCtth')
+
+
+def test_run_pge_graph_failure(tmp_path):
+    """Test that a PGE failing or timing out stops only the PGEs depending on it."""
+    graph = get_pge_graph(SCENE, get_options(tmp_path, run_pps_cpp=True))
+    write_pges(tmp_path, graph, seconds=0.1, failing=['ppsCtype'])
+    (tmp_path / 'ppsCtth.py').write_text('import time\ntime.sleep(30)\n')
+    commands = get_pge_commands(SCENE, graph, get_options(tmp_path))
+
+    timings = asyncio.run(run_pge_graph(graph, commands, 'noaa19_62345', timeouts={'ppsCtth': 0.5}))
+
+    assert timings['ppsCtype'].returncode == 1
+    assert timings['ppsCtth'].returncode < 0
+    assert timings['ppsCpp'].returncode is None and timings['ppsCpp'].skipped
+    assert timings['ppsCmaskProb'].returncode == 0
+    assert sorted(get_failed_pges(timings)) == ['ppsCtth', 'ppsCtype']
+
+
+def test_run_pge_graph_in_threads(tmp_path):
+    """Test running the PGEs from threads, without an event loop."""
+    graph = get_pge_graph(SCENE, get_options(tmp_path, run_pps_cpp=True))
+    log = write_pges(tmp_path, graph, seconds=0.1, failing=['ppsCtype'])
+    (tmp_path / 'ppsCtth.py').write_text('import time\ntime.sleep(30)\n')
+    commands = get_pge_commands(SCENE, graph, get_options(tmp_path))
+    pids = []
+
+    timings = run_pge_graph_in_threads(graph, commands, 'noaa19_62345', timeouts={'ppsCtth': 0.5},
+                                       on_start=pids.append)
+
+    assert timings['ppsCtype'].returncode == 1
+    assert timings['ppsCtth'].returncode < 0
+    assert timings['ppsCpp'].returncode is None
+    assert timings['ppsCmaskProb'].returncode == 0
+    assert sorted(get_failed_pges(timings)) == ['ppsCtth', 'ppsCtype']
+    assert len(pids) == len(graph) - 1
+    events = log.read_text().split('\n')
+    assert events.index('end ppsCmask') < events.index('start ppsCmaskProb')
+    assert events.index('start ppsMakeNwp') < events.index('end ppsMakePhysiography')
+
+
+def test_pge_slots(tmp_path):
+    """Test limiting the processes of a PGE running at once over several scenes."""
+    graph = {'ppsMakeNwp': ()}
+    log = write_pges(tmp_path, graph)
+    commands = get_pge_commands(SCENE, graph, get_options(tmp_path))
+    slots = PgeSlots({'ppsMakeNwp': 1})
+
+    async def run():
+        await asyncio.gather(*[run_pge_graph(graph, commands, str(idx), slots=slots) for idx in range(3)])
+
+    asyncio.run(run())
+    assert log.read_text().split() == ['start', 'ppsMakeNwp', 'end', 'ppsMakeNwp'] * 3
+    assert slots.running('ppsMakeNwp') == 0
+
+    # The scenes processed in their own thread share the slots
+    log.unlink()
+    threads = [threading.Thread(target=run_pge_graph_in_threads, args=(graph, commands, str(idx), slots))
+               for idx in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert log.read_text().split() == ['start', 'ppsMakeNwp', 'end', 'ppsMakeNwp'] * 3
+    assert slots.running('ppsMakeNwp') == 0
+
+
+def test_pps_worker_pge_graph_from_thread(tmp_path, monkeypatch):
+    """Test running the PGEs of a scene from the worker thread of the threads engine."""
+    spec = importlib.util.spec_from_file_location('pps2018_runner', RUNNER)
+    runner = importlib.util.module_from_spec(spec)
+    with patch('nwcsafpps_runner.config.get_config', return_value=TEST_NWP_OPTIONS):
+        spec.loader.exec_module(runner)
+    published = []
+    monkeypatch.setattr(runner, 'publish_pps_statistics', lambda scene, *args: published.append(scene))
+    # No event loop is run from the worker threads, their child processes cannot be watched on Python 3.7
+    monkeypatch.setattr(runner, 'run_scene_pges', None)
+    options = get_options(tmp_path, pps_outdir=str(tmp_path))
+    log = write_pges(tmp_path, get_pge_graph(SCENE, options), seconds=0.05)
+    failures = []
+
+    def work():
+        try:
+            runner.pps_worker(SCENE, None, None, options, pge_slots=PgeSlots({'ppsCtth': 1}))
+        except Exception as err:
+            failures.append(err)
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join(30)
+
+    assert not thread.is_alive()
+    assert failures == []
+    assert published == [SCENE]
+    assert 'end ppsCmaskProb' in log.read_text()
+
+
+def test_pps_worker_pge_graph_failure(tmp_path, monkeypatch):
+    """Test that nothing is published when a PGE of the scene failed."""
+    spec = importlib.util.spec_from_file_location('pps2018_runner', RUNNER)
+    runner = importlib.util.module_from_spec(spec)
+    with patch('nwcsafpps_runner.config.get_config', return_value=TEST_NWP_OPTIONS):
+        spec.loader.exec_module(runner)
+    published = []
+    monkeypatch.setattr(runner, 'publish_pps_statistics', lambda scene, *args: published.append(scene))
+    options = get_options(tmp_path, pps_outdir=str(tmp_path))
+    log = write_pges(tmp_path, get_pge_graph(SCENE, options), seconds=0.01, failing=['ppsCmask'])
+
+    assert not runner.pps_worker(SCENE, None, None, options)
+
+    assert published == []
+    assert 'start ppsCtype' not in log.read_text()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the NWP preparation.
+"""
+
+import os
+from datetime import datetime
+from multiprocessing import get_context as get_multiprocessing_context
+from unittest.mock import patch
+
+import pytest
+
+from nwcsafpps_runner.tests.test_grib_utils import read_grib_entries, write_grib_file
+
+TEST_NWP_OPTIONS = {'nhsp_path': '/tmp', 'nhsp_prefix': 'LL02_NHSP_',
+                    'nhsf_path': '/tmp', 'nhsf_prefix': 'LL02_NHSF_',
+                    'nhsf_file_name_sift': '{ecmwf_prefix:9s}_{analysis_time:%Y%m%d%H%M}+{forecast_step:d}H00M',
+                    'nwp_outdir': '/tmp', 'nwp_static_surface': '/tmp/lsm_z.grib1',
+                    'nwp_output_prefix': 'LL02_NHSPSF_',
+                    'pps_nwp_requirements': '/tmp/pps_nwp_list_of_required_fields.txt'}
+
+with patch('nwcsafpps_runner.config.get_config', return_value=TEST_NWP_OPTIONS):
+    from nwcsafpps_runner import prepare_nwp
+
+
+ANALYSIS_TIME = datetime(2021, 4, 27, 12, 0)
+
+
+@pytest.fixture
+def fake_nwp_dirs(tmp_path, monkeypatch):
+    """Create nhsp/nhsf input files and an output directory for the NWP preparation."""
+    nhsp_dir = tmp_path / 'nhsp'
+    nhsf_dir = tmp_path / 'nhsf'
+    outdir = tmp_path / 'out'
+    for dirname in [nhsp_dir, nhsf_dir, outdir]:
+        dirname.mkdir()
+
+    timestamp = ANALYSIS_TIME.strftime('%Y%m%d%H%M')
+    for step in [3, 6, 9]:
+        write_grib_file(nhsp_dir / 'LL02_NHSP_{}+{:03d}H00M'.format(timestamp, step), [130])
+        write_grib_file(nhsf_dir / 'LL02_NHSF_{}+{:03d}H00M'.format(timestamp, step), [235])
+    static_file = tmp_path / 'lsm_z.grib1'
+    write_grib_file(static_file, [172, 129])
+    req_file = tmp_path / 'pps_nwp_list_of_required_fields.txt'
+    req_file.write_text("M 235 Skin temperature 0 surface\nM 172 Land-sea mask 0 surface\n")
+
+    monkeypatch.setattr(prepare_nwp, 'nhsp_path', str(nhsp_dir))
+    monkeypatch.setattr(prepare_nwp, 'nhsf_path', str(nhsf_dir))
+    monkeypatch.setattr(prepare_nwp, 'nwp_outdir', str(outdir))
+    monkeypatch.setattr(prepare_nwp, 'nwp_lsmz_filename', str(static_file))
+    monkeypatch.setattr(prepare_nwp, 'nwp_req_filename', str(req_file))
+    return outdir
+
+
+@pytest.mark.parametrize('nworkers', [1, 3])
+def test_update_nwp(fake_nwp_dirs, nworkers, monkeypatch):
+    """Test preparing the NWP files serially and in parallel."""
+    start_methods = []
+
+    def get_context(method):
+        start_methods.append(method)
+        # The config is only mocked in this process, so the workers are forked here
+        return get_multiprocessing_context('fork')
+
+    monkeypatch.setattr(prepare_nwp.multiprocessing, 'get_context', get_context)
+    prepare_nwp.update_nwp(datetime(2021, 4, 27, 0, 0), [3, 6], nworkers=nworkers)
+
+    assert start_methods == ([] if nworkers == 1 else ['forkserver'])
+
+    expected = ['LL02_NHSPSF_202104271200+003H00M', 'LL02_NHSPSF_202104271200+006H00M']
+    assert sorted(os.listdir(fake_nwp_dirs)) == expected
+    for filename in expected:
+        assert [entry[0] for entry in read_grib_entries(fake_nwp_dirs / filename)] == [130, 235, 172, 129]
+
+
+def test_update_nwp_scene_window(fake_nwp_dirs):
+    """Test preparing only the NWP files covering a scene."""
+    scene_window = (datetime(2021, 4, 27, 16, 0), datetime(2021, 4, 27, 16, 15))
+
+    prepare_nwp.update_nwp(datetime(2021, 4, 27, 0, 0), [3, 6, 9], scene_window=scene_window)
+
+    assert sorted(os.listdir(fake_nwp_dirs)) == ['LL02_NHSPSF_202104271200+003H00M',
+                                                 'LL02_NHSPSF_202104271200+006H00M']
+
+
+def test_update_nwp_missing_fields(fake_nwp_dirs, monkeypatch):
+    """Test that no NWP file is written if fields required by PPS are missing."""
+    monkeypatch.setattr(prepare_nwp, 'get_nwp_requirements', lambda: ['133 Specific humidity 0 surface'])
+
+    prepare_nwp.update_nwp(datetime(2021, 4, 27, 0, 0), [3, 6])
+
+    assert os.listdir(fake_nwp_dirs) == []
+
+
+def test_get_nwp_step_skips_old_analysis(fake_nwp_dirs):
+    """Test that analysis times older than the start time are skipped."""
+    nhsf_file = os.path.join(prepare_nwp.nhsf_path, 'LL02_NHSF_202104271200+003H00M')
+
+    assert prepare_nwp.get_nwp_step(nhsf_file, datetime(2021, 4, 28, 0, 0), [3]) is None
+
+    nwp_step = prepare_nwp.get_nwp_step(nhsf_file, datetime(2021, 4, 27, 0, 0), [3])
+    assert nwp_step['analysis_time'] == ANALYSIS_TIME
+    assert nwp_step['forecast_step'] == 3
+    assert nwp_step['result_file'] == os.path.join(str(fake_nwp_dirs), 'LL02_NHSPSF_202104271200+003H00M')
+
+
+def test_check_nwp_content(fake_nwp_dirs, tmp_path):
+    """Test checking the content of a prepared NWP file."""
+    prepare_nwp.update_nwp(datetime(2021, 4, 27, 0, 0), [3])
+    nwp_file = str(fake_nwp_dirs / 'LL02_NHSPSF_202104271200+003H00M')
+
+    assert prepare_nwp.check_nwp_content(nwp_file)
+    assert prepare_nwp.get_missing_nwp_fields(nwp_file) == []
+
+    (tmp_path / 'pps_nwp_list_of_required_fields.txt').write_text("M 133 Specific humidity 0 surface\n")
+    assert not prepare_nwp.check_nwp_content(nwp_file)
+
+
+def test_update_nwp_with_ledger(fake_nwp_dirs, tmp_path, monkeypatch):
+    """Test that input files already prepared are not looked at again when using the ledger."""
+    monkeypatch.setattr(prepare_nwp, 'nwp_ledger_filename', str(tmp_path / 'ledger.db'))
+
+    prepare_nwp.update_nwp(datetime(2021, 4, 27, 0, 0), [3, 6])
+    assert len(os.listdir(fake_nwp_dirs)) == 2
+
+    with patch.object(prepare_nwp, 'parse_nhsf_filename') as parse, \
+            patch.object(prepare_nwp, 'run_nwp_steps') as run_nwp_steps:
+        prepare_nwp.update_nwp(datetime(2021, 4, 27, 0, 0), [3, 6, 9])
+    parse.assert_not_called()
+    assert [nwp_step['forecast_step'] for nwp_step in run_nwp_steps.call_args[0][0]] == [9]
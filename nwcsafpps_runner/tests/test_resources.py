@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the admission of the scenes within the memory and CPU budgets.
+"""
+
+import threading
+from datetime import datetime
+
+from nwcsafpps_runner.resources import (CLOCK_TICKS, ResourceMonitor, get_process_tree, read_available_memory,
+                                        read_loadavg, read_process_table)
+from nwcsafpps_runner.scheduler import SceneScheduler
+
+GB = 1024 ** 3
+
+
+def write_process(proc_dir, pid, ppid, rss_kb, cpu_ticks, children_ticks=0):
+    """Write the /proc files of a fake process."""
+    pid_dir = proc_dir / str(pid)
+    pid_dir.mkdir()
+    fields = ['S', str(ppid)] + ['0'] * 9 + [str(cpu_ticks), '0', str(children_ticks), '0'] + ['0'] * 30
+    (pid_dir / 'stat').write_text('%d (python3 (pps)) %s\n' % (pid, ' '.join(fields)))
+    (pid_dir / 'status').write_text('Name:\tpython3\nVmPeak:\t 9999 kB\nVmRSS:\t %d kB\n' % rss_kb)
+
+
+def write_host(proc_dir, load, available_kb):
+    """Write the /proc files of the fake host."""
+    (proc_dir / 'loadavg').write_text('%.2f 1.00 1.00 2/300 12345\n' % load)
+    (proc_dir / 'meminfo').write_text('MemTotal: 67108864 kB\nMemFree: 1000 kB\nMemAvailable: %d kB\n'
+                                      % available_kb)
+
+
+def test_read_proc(tmp_path):
+    """Test reading the host load, available memory and the process tree."""
+    write_host(tmp_path, 3.5, 1024 * 1024)
+    write_process(tmp_path, 100, 1, 1000, CLOCK_TICKS, children_ticks=CLOCK_TICKS)
+    write_process(tmp_path, 101, 100, 2000, 0)
+    write_process(tmp_path, 102, 101, 3000, 0)
+    write_process(tmp_path, 200, 1, 4000, 0)
+
+    assert read_loadavg(str(tmp_path)) == 3.5
+    assert read_available_memory(str(tmp_path)) == GB
+    stats = read_process_table(str(tmp_path))
+    assert stats[100] == (1, 1.0, 1.0)
+    assert get_process_tree([100, 999], stats) == {100, 101, 102}
+
+
+def test_cost_estimates(tmp_path):
+    """Test updating the cost estimates of a platform from the resources used by its scenes."""
+    write_host(tmp_path, 0.0, 64 * 1024 * 1024)
+    write_process(tmp_path, 100, 1, 1024 * 1024, 0)
+    write_process(tmp_path, 101, 100, 1024 * 1024, 0)
+    monitor = ResourceMonitor(default_memory=GB, proc_dir=str(tmp_path), alpha=0.5)
+
+    monitor.start_job('viirs', 'NOAA-20')
+    monitor.add_process(100)
+    monitor.sample()
+    monitor.finish_job('viirs')
+    assert monitor.get_estimate('NOAA-20')[0] == 2 * GB
+
+    monitor.start_job('viirs', 'NOAA-20')
+    # The processes started from the other threads of the scene
+    thread = threading.Thread(target=monitor.process_adder(), args=(101, ))
+    thread.start()
+    thread.join()
+    monitor.sample()
+    monitor.finish_job('viirs')
+    assert monitor.get_estimate('NOAA-20')[0] == 1.5 * GB
+    assert monitor.get_estimate('NOAA-19') == (GB, 1.0)
+
+
+def test_cpu_from_first_process(tmp_path, monkeypatch):
+    """Test that the cores used by a scene are counted from its first process, not from the wait before."""
+    write_host(tmp_path, 0.0, 64 * 1024 * 1024)
+    write_process(tmp_path, 100, 1, 1024 * 1024, 20 * CLOCK_TICKS)
+    clock = [1000.0]
+    monkeypatch.setattr('nwcsafpps_runner.resources.time.monotonic', lambda: clock[0])
+    monitor = ResourceMonitor(proc_dir=str(tmp_path))
+
+    monitor.start_job('viirs', 'NOAA-20')
+    # Waiting for the NWP data
+    clock[0] += 60
+    monitor.add_process(100)
+    clock[0] += 10
+    monitor.sample()
+    monitor.finish_job('viirs')
+
+    assert monitor.get_estimate('NOAA-20') == (GB, 2.0)
+
+
+def test_can_admit(tmp_path):
+    """Test admitting the scenes within the memory and CPU budgets."""
+    write_host(tmp_path, 1.0, 64 * 1024 * 1024)
+    monitor = ResourceMonitor(memory_budget=10 * GB, cpu_budget=4, default_memory=GB, proc_dir=str(tmp_path))
+    monitor.sample()
+    monitor.estimates['NOAA-20'] = (6 * GB, 2.0)
+    assert monitor.can_admit('NOAA-20')
+
+    monitor.start_job('first', 'NOAA-20')
+    assert not monitor.can_admit('NOAA-20')
+    assert monitor.can_admit('NOAA-19')
+
+    monitor.memory_budget = None
+    write_host(tmp_path, 3.5, 64 * 1024 * 1024)
+    assert monitor.can_admit('NOAA-19')
+    monitor.sample()
+    assert not monitor.can_admit('NOAA-19')
+
+    write_host(tmp_path, 0.0, 6 * 1024 * 1024)
+    monitor.sample()
+    assert not monitor.can_admit('NOAA-19')
+
+
+def test_scheduler_waits_for_resources(tmp_path):
+    """Test that the scheduler starts the most urgent scene only once admitted."""
+    write_host(tmp_path, 0.0, 64 * 1024 * 1024)
+    monitor = ResourceMonitor(memory_budget=3 * GB, default_memory=2 * GB, interval=0.05, proc_dir=str(tmp_path))
+    scheduler = SceneScheduler(2, resources=monitor)
+    release = threading.Event()
+    started = []
+    done = threading.Event()
+
+    def first():
+        started.append('first')
+        release.wait()
+
+    scene = {'platform_name': 'NOAA-20', 'starttime': datetime.utcnow()}
+    scheduler.submit('first', scene, first)
+    scheduler.submit('second', scene, lambda: started.append('second') or done.set())
+    scheduler.start()
+    try:
+        assert not done.wait(0.3)
+        assert started == ['first']
+        release.set()
+        assert done.wait(5)
+    finally:
+        scheduler.stop()
+    assert started == ['first', 'second']
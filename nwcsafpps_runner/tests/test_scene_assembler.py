@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the gathering of the level-1 files of the scenes.
+"""
+
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from nwcsafpps_runner.scene_assembler import ProcessedScenes, SceneAssembler
+from nwcsafpps_runner.utils import SceneId, clear_host_cache, ready2run
+
+STARTTIME = datetime(2021, 4, 27, 12, 0, 10)
+
+
+def test_noaa_scene_complete():
+    """Test that a NOAA-19 scene is complete when the avhrr, amsu-a and mhs files are there, once each."""
+    scenes = SceneAssembler()
+
+    record = scenes.add('noaa19_12345', 'NOAA-19', 12345, STARTTIME, 'avhrr/3', ['/data/hrpt_noaa19.l1b'])
+    record = scenes.add('noaa19_12345', 'NOAA-19', 12345, STARTTIME, 'avhrr/3', ['/data/hrpt_noaa19.l1b'])
+    assert not record.is_complete()
+    record = scenes.add('noaa19_12345', 'NOAA-19', 12345, STARTTIME, 'amsu-a', ['/data/amsua_noaa19.l1b'])
+    assert not record.is_complete()
+    record = scenes.add('noaa19_12345', 'NOAA-19', 12345, STARTTIME, 'mhs', ['/data/mhs_noaa19.l1b'])
+    assert record.is_complete()
+    assert list(record.files) == ['/data/hrpt_noaa19.l1b', '/data/amsua_noaa19.l1b', '/data/mhs_noaa19.l1b']
+
+    assert scenes.pop('noaa19_12345') is record
+    assert len(scenes) == 0
+
+
+def test_other_scenes_complete():
+    """Test that a VIIRS scene needs one file, and a MODIS scene two."""
+    scenes = SceneAssembler()
+
+    assert scenes.add('npp_1', 'Suomi-NPP', 1, STARTTIME, 'viirs', ['/data/SVM01.h5']).is_complete()
+    assert not scenes.add('aqua_1', 'EOS-Aqua', 1, STARTTIME, 'modis', ['/data/MYD03.hdf']).is_complete()
+    assert scenes.add('aqua_1', 'EOS-Aqua', 1, STARTTIME, 'modis', ['/data/MYD021km.hdf']).is_complete()
+
+
+def test_expire():
+    """Test dropping the scenes not updated for the expiry time."""
+    scenes = SceneAssembler(expiry=600)
+    scenes.add('metopb_1', 'Metop-B', 1, STARTTIME, 'avhrr/3', ['/data/hrpt_1.l1b'], now=0)
+    scenes.add('metopb_2', 'Metop-B', 2, STARTTIME, 'avhrr/3', ['/data/hrpt_2.l1b'], now=100)
+    scenes.add('metopb_1', 'Metop-B', 1, STARTTIME, 'mhs', ['/data/mhs_1.l1b'], now=200)
+
+    assert scenes.expire(now=650) == []
+    expired = scenes.expire(now=750)
+
+    assert [(record.sceneid, record.missing_sensors) for record in expired] == [('metopb_2', {'amsu-a', 'mhs'})]
+    assert 'metopb_1' in scenes and 'metopb_2' not in scenes
+
+
+@patch('nwcsafpps_runner.utils.get_local_ips', return_value=['127.0.0.1'])
+@patch('nwcsafpps_runner.utils.socket.gethostbyname', return_value='127.0.0.1')
+def test_ready2run(gethostbyname, get_local_ips):
+    """Test that pps is ready to run on a Metop scene once the avhrr and microwave files are there."""
+    clear_host_cache()
+    scenes = SceneAssembler()
+
+    def message(sensor, uri, starttime=STARTTIME):
+        msg = MagicMock(type='file', host='localhost')
+        msg.data = {'platform_name': 'Metop-B', 'sensor': sensor, 'orbit_number': 12345, 'start_time': starttime,
+                    'data_processing_level': '1C', 'uri': uri}
+        return msg
+
+    assert not ready2run(message('avhrr/3', '/data/hrpt_metop01.l1b'), scenes)
+    assert not ready2run(message('amsu-a', '/data/amsual1c_metop01.l1c'), scenes)
+    assert ready2run(message('mhs', '/data/mhsl1c_metop01.l1c', datetime(2021, 4, 27, 12, 0, 40)), scenes)
+    assert len(scenes['Metop-B_12345_20210427120010'].files) == 3
+
+
+def test_match_scene_within_tolerance():
+    """Test that the files of one pass join the same scene, across minutes and with orbit numbers one off."""
+    scenes = SceneAssembler(time_tolerance=300, orbit_tolerance=1)
+    sceneid = scenes.get_sceneid('NOAA-19', 12345, datetime(2021, 4, 27, 11, 59, 58))
+    scenes.add(sceneid, 'NOAA-19', 12345, datetime(2021, 4, 27, 11, 59, 58), 'avhrr/3', ['/data/hrpt.l1b'])
+
+    assert scenes.get_sceneid('NOAA-19', 12345, datetime(2021, 4, 27, 12, 0, 3)) == sceneid
+    assert scenes.get_sceneid('NOAA-19', 12346, datetime(2021, 4, 27, 12, 4, 0)) == sceneid
+    assert scenes.get_sceneid('NOAA-19', 12347, datetime(2021, 4, 27, 12, 0, 3)) != sceneid
+    assert scenes.get_sceneid('NOAA-19', 12345, datetime(2021, 4, 27, 12, 5, 0)) != sceneid
+    assert scenes.get_sceneid('NOAA-18', 12345, datetime(2021, 4, 27, 12, 0, 3)) != sceneid
+
+    scenes.pop(sceneid)
+    assert scenes.get_sceneid('NOAA-19', 12345, datetime(2021, 4, 27, 12, 0, 3)) != sceneid
+
+
+def test_scene_id_exact():
+    """Test that scene ids are equal, and hashed alike, only with the same platform, orbit and start time."""
+    jobs = {SceneId('NOAA-19', 12345, datetime(2021, 4, 27, 11, 59, 58))}
+
+    assert SceneId('NOAA-19', 12345, datetime(2021, 4, 27, 11, 59, 58)) in jobs
+    assert SceneId('NOAA-19', 12345, datetime(2021, 4, 27, 12, 0, 3)) not in jobs
+    assert SceneId('NOAA-19', 12346, datetime(2021, 4, 27, 11, 59, 58)) not in jobs
+    starttime = datetime(2021, 4, 27, 12, 0)
+    assert hash(SceneId('NOAA-19', 12345, starttime)) != hash(SceneId('NOAA-19', 12346, starttime))
+
+
+def add_granule(scenes, orbit_number, index, now=0):
+    """Add the VIIRS granule number *index* of the orbit, starting 85 seconds after the previous one."""
+    starttime = STARTTIME + timedelta(seconds=85 * index)
+    sceneid = scenes.get_sceneid('Suomi-NPP', orbit_number, starttime)
+    return scenes.add(sceneid, 'Suomi-NPP', orbit_number, starttime, 'viirs', ['/data/SVM01_%d.h5' % index],
+                      now=now, endtime=starttime + timedelta(seconds=85))
+
+
+def test_granule_batch_size():
+    """Test gathering VIIRS granules of one orbit in batches of three."""
+    scenes = SceneAssembler(batch_size=3, batch_wait=600)
+
+    assert not add_granule(scenes, 1, 0).is_complete()
+    assert not add_granule(scenes, 1, 1).is_complete()
+    assert not add_granule(scenes, 2, 0).is_complete()
+    record = add_granule(scenes, 1, 2)
+
+    assert record.is_complete()
+    assert list(record.files) == ['/data/SVM01_0.h5', '/data/SVM01_1.h5', '/data/SVM01_2.h5']
+    assert (record.starttime, record.endtime) == (STARTTIME, STARTTIME + timedelta(seconds=255))
+    scenes.pop(record.sceneid)
+    assert not add_granule(scenes, 1, 3).is_complete()
+
+
+def test_granule_batch_wait():
+    """Test taking the batches waited for long enough."""
+    scenes = SceneAssembler(batch_size=10, batch_wait=300)
+    add_granule(scenes, 1, 0, now=0)
+    add_granule(scenes, 1, 1, now=85)
+    add_granule(scenes, 2, 0, now=200)
+
+    assert scenes.pop_waited_batches(now=299) == []
+    waited = scenes.pop_waited_batches(now=300)
+
+    assert [(record.orbit_number, len(record.granules)) for record in waited] == [(1, 2)]
+    assert len(scenes) == 1
+    assert not add_granule(scenes, 1, 2, now=301).is_complete()
+    assert len(scenes) == 2
+
+
+def file_message(platform_name, orbit_number, starttime, uri):
+    """Make a file message."""
+    msg = MagicMock(type='file')
+    msg.data = {'platform_name': platform_name, 'orbit_number': orbit_number, 'start_time': starttime,
+                'uri': uri, 'uid': uri.split('/')[-1]}
+    return msg
+
+
+def test_processed_scenes_drop():
+    """Test that a processed pass received again, from another source or with another start time, is dropped."""
+    processed = ProcessedScenes(policy='drop')
+    scenes = SceneAssembler()
+    for sensor in ['avhrr/3', 'amsu-a', 'mhs']:
+        record = scenes.add('noaa19', 'NOAA-19', 12345, STARTTIME, sensor, ['/data/%s.l1b' % sensor[:4]])
+    assert processed.should_process(record)
+    processed.add(record)
+
+    assert processed.is_duplicate(file_message('NOAA-19', 12345, STARTTIME, '/data/avhr.l1b'))
+    assert processed.is_duplicate(file_message('NOAA-19', 12345, STARTTIME + timedelta(seconds=20), '/ears/x.l1b'))
+    assert processed.is_duplicate(file_message('NOAA-19', 12346, STARTTIME, '/data/avhr_12346.l1b'))
+    assert not processed.is_duplicate(file_message('NOAA-19', 12347, STARTTIME, '/data/avhr_12347.l1b'))
+    assert not processed.is_duplicate(file_message('NOAA-19', 12345, STARTTIME + timedelta(minutes=5),
+                                                   '/data/avhr_later.l1b'))
+    assert not processed.should_process(record)
+
+
+def test_processed_scenes_failed_again():
+    """Test that a scene failing in PPS is processed again when received again."""
+    processed = ProcessedScenes(policy='drop')
+    record = SceneAssembler().add('npp', 'Suomi-NPP', 1, STARTTIME, 'viirs', ['/data/SVM01.h5'])
+    resent = file_message('Suomi-NPP', 1, STARTTIME, '/data/SVM01.h5')
+
+    processed.add(record)
+    assert processed.run(record, lambda: False) is False
+    assert not processed.is_duplicate(resent)
+    assert processed.should_process(record)
+
+    processed.add(record)
+    with pytest.raises(RuntimeError):
+        processed.run(record, fail_pps)
+    assert processed.should_process(record)
+
+    processed.add(record)
+    assert processed.run(record, lambda: True)
+    assert processed.is_duplicate(resent)
+    assert not processed.should_process(record)
+
+
+def fail_pps():
+    """Fail the processing of a scene."""
+    raise RuntimeError("PPS crashed")
+
+
+def test_processed_scenes_most_files():
+    """Test that a processed pass is processed again if received with more files."""
+    processed = ProcessedScenes(policy='most_files')
+    scenes = SceneAssembler()
+    record = scenes.add('metopb', 'Metop-B', 1, STARTTIME, 'avhrr/3', ['/ears/hrpt.l1b'])
+    processed.add(record)
+
+    assert not processed.is_duplicate(file_message('Metop-B', 1, STARTTIME, '/data/hrpt_local.l1b'))
+    assert processed.is_duplicate(file_message('Metop-B', 1, STARTTIME, '/data/hrpt.l1b'))
+    other = SceneAssembler().add('metopb', 'Metop-B', 1, STARTTIME, 'avhrr/3', ['/data/hrpt_local.l1b'])
+    assert not processed.should_process(other)
+    other.add('mhs', ['/data/mhs_local.l1b'])
+    assert processed.should_process(other)
+
+
+def test_processed_scenes_bounded():
+    """Test that the processed scenes are forgotten when too many or too old."""
+    processed = ProcessedScenes(maxsize=2, ttl=600)
+    starttimes = [STARTTIME + timedelta(minutes=101 * orbit_number) for orbit_number in range(3)]
+    for orbit_number in range(3):
+        processed.add(SceneAssembler().add('npp', 'Suomi-NPP', orbit_number, starttimes[orbit_number], 'viirs',
+                                           ['/data/SVM01_%d.h5' % orbit_number]), now=orbit_number)
+    assert len(processed) == 2
+    assert not processed.is_duplicate(file_message('Suomi-NPP', 0, starttimes[0], '/data/SVM01_0.h5'), now=3)
+    assert processed.is_duplicate(file_message('Suomi-NPP', 2, starttimes[2], '/data/SVM01_2.h5'), now=3)
+    assert not processed.is_duplicate(file_message('Suomi-NPP', 2, starttimes[2], '/data/SVM01_2.h5'), now=602)
+    assert len(processed) == 0
+
+
+def test_processed_batches_matched_by_files():
+    """Test that the next batch of granules of a processed orbit is not taken as a duplicate."""
+    processed = ProcessedScenes(policy='drop')
+    scenes = SceneAssembler(batch_size=2, batch_wait=600)
+    add_granule(scenes, 1, 0)
+    processed.add(scenes.pop(add_granule(scenes, 1, 1).sceneid))
+
+    assert processed.is_duplicate(file_message('Suomi-NPP', 1, STARTTIME + timedelta(seconds=85),
+                                               '/data/SVM01_1.h5'))
+    assert not processed.is_duplicate(file_message('Suomi-NPP', 1, STARTTIME + timedelta(seconds=170),
+                                                   '/data/SVM01_2.h5'))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll Developers
+
+# Author(s):
+
+#   Adam Dybbroe <Firstname.Lastname at smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit testing the scheduling of the scenes to be processed.
+"""
+
+import threading
+from datetime import datetime, timedelta
+from functools import partial
+
+import pytest
+
+from nwcsafpps_runner.scene_assembler import ProcessedScenes, SceneAssembler
+from nwcsafpps_runner.scheduler import SceneScheduler, get_platform_priorities
+
+NOW = datetime.utcnow()
+
+
+def make_scene(platform_name, minutes_ago):
+    """Make a scene starting *minutes_ago* before NOW."""
+    return {'platform_name': platform_name, 'starttime': NOW - timedelta(minutes=minutes_ago)}
+
+
+def run_scheduled(scheduler, scenes, now=NOW):
+    """Submit the *scenes* while the only worker is busy, and get the order they are processed in."""
+    processed = []
+    release = threading.Event()
+    done = threading.Event()
+
+    scheduler.submit('busy', make_scene('Metop-B', 0), release.wait, now=now)
+    for job_id, scene in scenes:
+        scheduler.submit(job_id, scene, processed.append, args=(job_id,), now=now)
+    scheduler.submit('last', make_scene('Metop-B', 1000), done.set, now=now)
+    scheduler.start()
+    release.set()
+    assert done.wait(5)
+    scheduler.stop()
+    return processed
+
+
+def test_get_platform_priorities():
+    """Test reading the platform priorities from the config."""
+    assert get_platform_priorities(None) == {}
+    assert get_platform_priorities(['Metop-B:2', 'NOAA-20:1']) == {'Metop-B': 2, 'NOAA-20': 1}
+    assert get_platform_priorities('Metop-B:2, NOAA-20:-1') == {'Metop-B': 2, 'NOAA-20': -1}
+    with pytest.raises(ValueError):
+        get_platform_priorities(['Metop-B'])
+
+
+def test_priority_then_freshness():
+    """Test processing the scenes of the highest priority platforms first, and then the newest."""
+    scheduler = SceneScheduler(1, priorities={'NOAA-20': 1}, stale_policy='defer')
+    processed = run_scheduled(scheduler, [('old', make_scene('Metop-B', 30)),
+                                          ('new', make_scene('Metop-B', 10)),
+                                          ('prio', make_scene('NOAA-20', 60))])
+    assert processed == ['prio', 'new', 'old']
+
+
+def test_defer_stale_scenes():
+    """Test processing the stale scenes after the fresh ones when saturated."""
+    scheduler = SceneScheduler(1, priorities={'NOAA-20': 1}, max_age=3600, stale_policy='defer')
+    processed = run_scheduled(scheduler, [('stale', make_scene('NOAA-20', 120)),
+                                          ('fresh', make_scene('Metop-B', 10))])
+    assert processed == ['fresh', 'stale']
+
+
+def test_drop_stale_scenes():
+    """Test dropping the stale scenes when saturated, but not when a worker is free."""
+    scheduler = SceneScheduler(1, max_age=3600, stale_policy='drop')
+    assert scheduler.submit('stale', make_scene('Metop-B', 120), len, args=((),), now=NOW)
+    assert not scheduler.submit('stale2', make_scene('Metop-B', 120), len, args=((),), now=NOW)
+    assert scheduler.pending == 1
+
+
+def test_dropped_scene_processed_again():
+    """Test that a scene dropped as stale while waiting is forgotten, to be processed if received again."""
+    processed = ProcessedScenes()
+    scheduler = SceneScheduler(1, max_age=3600, stale_policy='drop')
+    release = threading.Event()
+    done = threading.Event()
+    old = make_scene('Metop-B', 120)
+    older = make_scene('Metop-B', 180)
+    record = SceneAssembler().add('metopb', 'Metop-B', 1, old['starttime'], 'avhrr/3', ['/data/hrpt.l1b'])
+
+    scheduler.submit('busy', make_scene('Metop-B', 0), release.wait)
+    processed.add(record)
+    # Fresh when submitted, stale once a worker is free
+    assert scheduler.submit('old', old, processed.run, args=(record, len, ()),
+                            now=old['starttime'] + timedelta(minutes=5), on_drop=partial(processed.forget, record))
+    assert scheduler.submit('older', older, done.set, now=older['starttime'] + timedelta(minutes=5))
+    assert not processed.should_process(record)
+    scheduler.start()
+    release.set()
+    assert done.wait(5)
+    scheduler.stop()
+
+    assert scheduler.get_stats()['dropped'] == 1
+    assert processed.should_process(record)
+
+
+def test_reject_pending_job():
+    """Test refusing a scene already waiting."""
+    scheduler = SceneScheduler(2)
+    assert scheduler.submit('scene', make_scene('Metop-B', 10), len, args=((),))
+    assert not scheduler.submit('scene', make_scene('Metop-B', 10), len, args=((),))
+
+
+def test_unknown_stale_policy():
+    """Test refusing an unknown stale scene policy."""
+    with pytest.raises(ValueError):
+        SceneScheduler(1, stale_policy='ignore')
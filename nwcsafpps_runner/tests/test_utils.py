@@ -22,7 +22,12 @@
 
 """Test utility functions."""
 from nwcsafpps_runner.utils import get_outputfiles
+from nwcsafpps_runner.utils import check_uri, clear_host_cache, get_host_ip, get_local_ip_set
 import os
+import socket
+from unittest.mock import patch
+
+import pytest
 
 
 def test_outputfiles(tmp_path):
@@ -94,5 +99,59 @@ def test_outputfiles(tmp_path):
     assert set(res) == set(expected)
 
 
+@patch('nwcsafpps_runner.utils.get_local_ips', return_value=['127.0.0.1', '192.168.1.10'])
+@patch('nwcsafpps_runner.utils.socket.gethostbyname', return_value='192.168.1.10')
+def test_check_uri_resolves_once(gethostbyname, get_local_ips):
+    """Test that the host names and local addresses are looked up once for a collection of uris."""
+    clear_host_cache()
+    uris = ['ssh://myhost/data/granule_%d.h5' % idx for idx in range(20)]
+
+    assert check_uri(uris) == ['/data/granule_%d.h5' % idx for idx in range(20)]
+    assert gethostbyname.call_count == 1
+    assert get_local_ips.call_count == 1
+
+
+@patch('nwcsafpps_runner.utils.socket.gethostbyname', side_effect=socket.gaierror('no such host'))
+def test_get_host_ip_negative_cache(gethostbyname):
+    """Test that a host name failing to resolve is not looked up again for a while."""
+    clear_host_cache()
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            get_host_ip('nohost')
+    assert gethostbyname.call_count == 1
+
+    with patch('nwcsafpps_runner.utils.HOST_CACHE_NEGATIVE_TTL', -1):
+        clear_host_cache()
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                get_host_ip('nohost')
+    assert gethostbyname.call_count == 3
+
+
+@patch('nwcsafpps_runner.utils.get_local_ips', return_value=['127.0.0.1'])
+def test_local_ips_refreshed_on_interface_change(get_local_ips):
+    """Test that the local addresses are read again when the network interfaces change."""
+    clear_host_cache()
+    with patch('nwcsafpps_runner.utils.HOST_CACHE_TTL', -1):
+        with patch('nwcsafpps_runner.utils.socket.if_nameindex', return_value=[(1, 'lo')]):
+            assert get_local_ip_set() == {'127.0.0.1'}
+            assert get_local_ip_set() == {'127.0.0.1'}
+        assert get_local_ips.call_count == 1
+        with patch('nwcsafpps_runner.utils.socket.if_nameindex', return_value=[(1, 'lo'), (2, 'eth0')]):
+            get_local_ip_set()
+    assert get_local_ips.call_count == 2
+
+
+@patch('nwcsafpps_runner.utils.get_local_ips', return_value=['127.0.0.1'])
+def test_local_interfaces_checked_after_ttl(get_local_ips):
+    """Test that the network interfaces are not checked on every lookup, only once the cache expired."""
+    clear_host_cache()
+    with patch('nwcsafpps_runner.utils.socket.if_nameindex', return_value=[(1, 'lo')]) as if_nameindex:
+        for _ in range(3):
+            assert get_local_ip_set() == {'127.0.0.1'}
+        assert if_nameindex.call_count == 1
+    assert get_local_ips.call_count == 1
+
+
 if __name__ == "__main__":
     pass
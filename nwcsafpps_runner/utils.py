@@ -32,12 +32,15 @@ import stat
 import shlex
 from glob import glob
 import socket
+import time
 from datetime import datetime, timedelta
 #: Python 2/3 differences
 from six.moves.urllib.parse import urlparse
 
 from posttroll.address_receiver import get_local_ips
 
+from nwcsafpps_runner.output_pump import pump_output
+
 import logging
 LOG = logging.getLogger(__name__)
 
@@ -46,6 +49,20 @@ class NwpPrepareError(Exception):
     pass
 
 
+#: Seconds a resolved host name is remembered
+HOST_CACHE_TTL = 300
+
+#: Seconds a host name that could not be resolved is remembered
+HOST_CACHE_NEGATIVE_TTL = 30
+
+#: Seconds the local IP addresses are remembered, unless the network interfaces change
+LOCAL_IPS_MAX_AGE = 600
+
+_HOST_CACHE = {}
+_LOCAL_IPS = {}
+_HOST_CACHE_LOCK = threading.Lock()
+
+
 PPS_OUT_PATTERN = ("S_NWC_{segment}_{orig_platform_name}_{orbit_number:05d}_" +
                    "{start_time:%Y%m%dT%H%M%S%f}Z_{end_time:%Y%m%dT%H%M%S%f}Z.{extention}")
 PPS_OUT_PATTERN_MULTIPLE = ("S_NWC_{segment1}_{segment2}_{orig_platform_name}_{orbit_number:05d}_" +
@@ -121,21 +138,74 @@ def run_command(cmdstr):
     except NwpPrepareError:
         LOG.exception("Failed when preparing NWP data for PPS...")
 
-    out_reader = threading.Thread(
-        target=logreader, args=(proc.stdout, LOG.info))
-    err_reader = threading.Thread(
-        target=logreader, args=(proc.stderr, LOG.info))
-    out_reader.start()
-    err_reader.start()
-    out_reader.join()
-    err_reader.join()
+    pump_output(proc, os.path.basename(myargs[0]), LOG.info).wait()
 
     return proc.wait()
 
 
+def clear_host_cache():
+    """Forget the resolved host names and the local IP addresses."""
+    with _HOST_CACHE_LOCK:
+        _HOST_CACHE.clear()
+        _LOCAL_IPS.clear()
+
+
+def get_host_ip(hostname):
+    """Get the IP address of *hostname*.
+
+    The address is remembered for :data:`HOST_CACHE_TTL` seconds, and a
+    failure to resolve the name for :data:`HOST_CACHE_NEGATIVE_TTL` seconds,
+    raising the same socket.gaierror meanwhile.
+    """
+    now = time.monotonic()
+    with _HOST_CACHE_LOCK:
+        cached = _HOST_CACHE.get(hostname)
+    if cached is not None and cached[0] > now:
+        if isinstance(cached[1], socket.gaierror):
+            raise cached[1]
+        return cached[1]
+
+    try:
+        url_ip = socket.gethostbyname(hostname)
+    except socket.gaierror as err:
+        with _HOST_CACHE_LOCK:
+            _HOST_CACHE[hostname] = (now + HOST_CACHE_NEGATIVE_TTL, err)
+        raise
+    with _HOST_CACHE_LOCK:
+        _HOST_CACHE[hostname] = (now + HOST_CACHE_TTL, url_ip)
+    return url_ip
+
+
+def get_local_ip_set():
+    """Get the set of IP addresses of this host.
+
+    The network interfaces are checked for changes every
+    :data:`HOST_CACHE_TTL` seconds, like the host names are resolved again,
+    and the addresses are read again only when the interfaces changed, or
+    after :data:`LOCAL_IPS_MAX_AGE` seconds.
+    """
+    now = time.monotonic()
+    with _HOST_CACHE_LOCK:
+        if _LOCAL_IPS and _LOCAL_IPS['checked'] > now:
+            return _LOCAL_IPS['ips']
+    interfaces = tuple(socket.if_nameindex())
+    with _HOST_CACHE_LOCK:
+        if _LOCAL_IPS.get('interfaces') == interfaces and _LOCAL_IPS['expires'] > now:
+            _LOCAL_IPS['checked'] = now + HOST_CACHE_TTL
+            return _LOCAL_IPS['ips']
+    local_ips = frozenset(get_local_ips())
+    with _HOST_CACHE_LOCK:
+        _LOCAL_IPS.update(interfaces=interfaces, checked=now + HOST_CACHE_TTL, expires=now + LOCAL_IPS_MAX_AGE,
+                          ips=local_ips)
+    return local_ips
+
+
 def check_uri(uri):
     """Check that the provided *uri* is on the local host and return the
     file path.
+
+    The host names are resolved once, and then taken from the cache (see
+    :func:`get_host_ip`).
     """
     if isinstance(uri, (list, set, tuple)):
         paths = [check_uri(ressource) for ressource in uri]
@@ -143,9 +213,9 @@ def check_uri(uri):
     url = urlparse(uri)
     try:
         if url.hostname:
-            url_ip = socket.gethostbyname(url.hostname)
+            url_ip = get_host_ip(url.hostname)
 
-            if url_ip not in get_local_ips():
+            if url_ip not in get_local_ip_set():
                 try:
                     os.stat(url.path)
                 except OSError:
@@ -163,12 +233,17 @@ class PpsRunError(Exception):
 
 
 class SceneId(object):
+    """The id of a scene, from its platform name, orbit number and start time.
+
+    The passes of one scene received with slightly different start times or
+    orbit numbers are matched by the :class:`nwcsafpps_runner.scene_assembler.SceneIndex`,
+    the ids themselves are equal only if all three are.
+    """
 
-    def __init__(self, platform_name, orbit_number, starttime, threshold=5):
+    def __init__(self, platform_name, orbit_number, starttime):
         self.platform_name = platform_name
         self.orbit_number = orbit_number
         self.starttime = starttime
-        self.threshold = threshold
 
     def __str__(self):
 
@@ -177,15 +252,13 @@ class SceneId(object):
                 str(self.starttime.strftime('%Y%m%d%H%M')))
 
     def __hash__(self):
-        return hash(str(self.platform_name) + '_' +
-                    str(self.orbit_number) + '_' +
-                    str(self.starttime.strftime('%Y%m%d%H%M')))
+        return hash((self.platform_name, self.orbit_number, self.starttime))
 
     def __eq__(self, other):
 
         return (self.platform_name == other.platform_name and
                 self.orbit_number == other.orbit_number and
-                abs(self.starttime - other.starttime) < timedelta(minutes=self.threshold))
+                self.starttime == other.starttime)
 
 
 def message_uid(msg):
@@ -212,8 +285,12 @@ def get_sceneid(platform_name, orbit_number, starttime):
     return sceneid
 
 
-def ready2run(msg, files4pps, **kwargs):
-    """Check whether pps is ready to run or not."""
+def ready2run(msg, scenes, **kwargs):
+    """Check whether pps is ready to run or not.
+
+    The level-1 files of the message are added to the scene in the *scenes*
+    (a :class:`nwcsafpps_runner.scene_assembler.SceneAssembler`).
+    """
     # """Start the PPS processing on a NOAA/Metop/S-NPP/EOS scene"""
     # LOG.debug("Received message: " + str(msg))
 
@@ -267,8 +344,8 @@ def ready2run(msg, files4pps, **kwargs):
         return False
 
     try:
-        url_ip = socket.gethostbyname(msg.host)
-        if url_ip not in get_local_ips():
+        url_ip = get_host_ip(msg.host)
+        if url_ip not in get_local_ip_set():
             LOG.warning("Server %s not the current one: %s", str(url_ip), socket.gethostname())
             return False
     except (AttributeError, socket.gaierror) as err:
@@ -309,13 +386,13 @@ def ready2run(msg, files4pps, **kwargs):
         required_mw_sensors = REQUIRED_MW_SENSORS.get(
             msg.data['platform_name'])
         if (msg.data['sensor'] in required_mw_sensors and
-                msg.data['data_processing_level'] != '1C'):
-            if msg.data['data_processing_level'] == '1c':
+                msg.data.get('data_processing_level') != '1C'):
+            if msg.data.get('data_processing_level') == '1c':
                 LOG.warning("Level should be in upper case!")
             else:
                 LOG.info('Level not the required type for PPS for this sensor: ' +
                          str(msg.data['sensor']) + ' ' +
-                         str(msg.data['data_processing_level']))
+                         str(msg.data.get('data_processing_level')))
                 return False
 
     # The orbit number is mandatory!
@@ -330,44 +407,39 @@ def ready2run(msg, files4pps, **kwargs):
         return False
 
     starttime = msg.data.get('start_time')
-    sceneid = get_sceneid(platform_name, orbit_number, starttime)
-
-    if sceneid not in files4pps:
-        files4pps[sceneid] = []
+    sceneid = scenes.get_sceneid(platform_name, orbit_number, starttime)
 
     LOG.debug("level1_files = %s", level1_files)
     if platform_name in SUPPORTED_EOS_SATELLITES:
+        eos_files = []
         for item in level1_files:
             fname = os.path.basename(item)
             LOG.debug("EOS level-1 file: %s", item)
             if (fname.startswith(GEOLOC_PREFIX[platform_name]) or
                     fname.startswith(DATA1KM_PREFIX[platform_name])):
-                files4pps[sceneid].append(item)
-    else:
-        for item in level1_files:
-            # fname = os.path.basename(item)
-            files4pps[sceneid].append(item)
+                eos_files.append(item)
+        level1_files = eos_files
 
-    LOG.debug("files4pps: %s", str(files4pps[sceneid]))
+    record = scenes.add(sceneid, platform_name, orbit_number, starttime, msg.data['sensor'], level1_files,
+                        endtime=msg.data.get('end_time'), message=msg)
+
+    LOG.debug("files4pps: %s", str(list(record.files)))
     if (stream_tag_name in msg.data and msg.data[stream_tag_name] in [stream_name, ] and
             platform_name in SUPPORTED_METOP_SATELLITES):
         LOG.info("EARS Metop data. Only require the HRPT/AVHRR level-1b file to be ready!")
-    elif (platform_name in SUPPORTED_METOP_SATELLITES or
-          platform_name in SUPPORTED_NOAA_SATELLITES):
-        if len(files4pps[sceneid]) < len(REQUIRED_MW_SENSORS[platform_name]) + 1:
-            LOG.info("Not enough NOAA/Metop sensor data available yet...")
-            return False
-    elif platform_name in SUPPORTED_EOS_SATELLITES:
-        if len(files4pps[sceneid]) < 2:
+    elif not record.is_complete():
+        if platform_name in SUPPORTED_EOS_SATELLITES:
             LOG.info("Not enough MODIS level 1 files available yet...")
-            return False
+        else:
+            LOG.info("Not enough NOAA/Metop sensor data available yet...")
+        return False
 
-    if len(files4pps[sceneid]) > 10:
+    if len(record.files) > 10:
         LOG.info(
-            "Number of level 1 files ready = " + str(len(files4pps[sceneid])))
+            "Number of level 1 files ready = " + str(len(record.files)))
         LOG.info("Scene = " + str(sceneid))
     else:
-        LOG.info("Level 1 files ready: " + str(files4pps[sceneid]))
+        LOG.info("Level 1 files ready: " + str(list(record.files)))
 
     if msg.data['platform_name'] in SUPPORTED_PPS_SATELLITES:
         LOG.info(
@@ -440,24 +512,24 @@ def create_pps_call_command_sequence(pps_script_name, scene, options):
     return shlex.split(str(cmdstr))
 
 
-def create_pps2018_call_command(python_exec, pps_script_name, scene, sequence=True):
-
+def get_pps_level1_arguments(scene):
+    """Get the arguments giving the level-1 file of the *scene* to the PPS scripts."""
     if scene['platform_name'] in SUPPORTED_EOS_SATELLITES:
-        cmdstr = ("%s " % python_exec + " %s " % pps_script_name +
-                  " --modisfile %s" % scene['file4pps'])
+        return ['--modisfile', scene['file4pps']]
     elif scene['platform_name'] in SUPPORTED_JPSS_SATELLITES:
-        cmdstr = ("%s " % python_exec + " %s " % pps_script_name +
-                  " --csppfile %s" % scene['file4pps'])
+        return ['--csppfile', scene['file4pps']]
     elif scene['platform_name'] in SUPPORTED_METEOSAT_SATELLITES:
-        cmdstr = ("%s" % python_exec + " %s " % pps_script_name +
-                  "-af %s" % scene['file4pps'])
-    else:
-        cmdstr = ("%s " % python_exec + " %s " % pps_script_name +
-                  " --hrptfile %s" % scene['file4pps'])
+        return ['-af', scene['file4pps']]
+    return ['--hrptfile', scene['file4pps']]
+
+
+def create_pps2018_call_command(python_exec, pps_script_name, scene, sequence=True):
+    """Get the command running the PPS script on the *scene*, as a list of arguments or a string."""
+    cmd = [python_exec, pps_script_name] + get_pps_level1_arguments(scene)
     if sequence:
-        return shlex.split(str(cmdstr))
+        return cmd
 
-    return cmdstr
+    return ' '.join(cmd)
 
 
 def get_pps_inputfile(platform_name, ppsfiles):
@@ -498,7 +570,9 @@ def get_outputfiles(path, platform_name, orb, st_time='', **kwargs):
     more than one scene with the same orbit number and platform name. In order
     to avoid picking up an older scene we check the file modifcation time, and
     if the file is too old we discard it! For a more specific search patern the
-    start time can be used, just add st_time=start-time
+    start time can be used, just add st_time=start-time. The age limit is
+    given with max_age=timedelta (90 minutes by default), max_age=None keeping
+    all files.
     """
 
     filelist = []
@@ -524,8 +598,11 @@ def get_outputfiles(path, platform_name, orb, st_time='', **kwargs):
     if xml_output:
         filelist = filelist + get_xml_outputfiles(path, platform_name, orb, st_time)
 
+    time_threshold = kwargs.get('max_age', timedelta(minutes=90.))
+    if time_threshold is None:
+        return filelist
+
     now = datetime.utcnow()
-    time_threshold = timedelta(minutes=90.)
     filtered_flist = []
     for fname in filelist:
         mtime = datetime.utcfromtimestamp(os.stat(fname)[stat.ST_MTIME])
@@ -636,12 +713,3 @@ def publish_pps_files(input_msg, publish_q, scene, result_files, **kwargs):
         except Exception:
             LOG.warning("Failed putting message on the queue, will send it now...")
             publish_q.send(pubmsg)
-
-
-def logreader(stream, log_func):
-    while True:
-        mystring = stream.readline()
-        if not mystring:
-            break
-        log_func(mystring.strip())
-    stream.close()
@@ -60,10 +60,11 @@ setup(name=NAME,
       packages=find_packages(),
       scripts=['bin/pps_runner.py',
                'bin/pps2018_runner.py',
-               'bin/level1c_runner.py', ],
+               'bin/level1c_runner.py',
+               'bin/nwp_benchmark.py', ],
       data_files=[],
-      install_requires=['posttroll', 'trollsift', 'pygrib', ],
-      python_requires='>=3.6',
+      install_requires=['posttroll', 'trollsift', 'eccodes', 'numpy', ],
+      python_requires='>=3.7',
       zip_safe=False,
       setup_requires=['setuptools_scm', 'setuptools_scm_git_archive'],
       use_scm_version=True